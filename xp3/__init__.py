@@ -1 +1,13 @@
-
+# The classes are imported on first access so the command line tool starts fast
+_exports = {
+    'XP3': '.xp3',
+    'XP3Reader': '.xp3reader',
+    'XP3Writer': '.xp3writer',
+}
+
+
+def __getattr__(name):
+    if name in _exports:
+        from importlib import import_module
+        return getattr(import_module(_exports[name], __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,3 @@
+from .xp3 import main
+
+main()
@@ -0,0 +1,151 @@
+import os, glob, posixpath
+from .xp3 import XP3, set_key
+from .filters import filter_from_args
+from .remote import is_url
+
+OPERATIONS = ('unpack', 'verify', 'list', 'repack')
+
+
+def expand_inputs(paths: list, folders: bool = False) -> list:
+    """
+    Expand glob patterns and folders in the input paths
+    :param folders: Inputs are folders to repack, otherwise archives (a folder means the .xp3 archives in it)
+    :return: List of paths (URLs are kept as is), raises FileNotFoundError for paths that don't exist
+    """
+    inputs = []
+    for path in paths:
+        if is_url(path):
+            matches = [path]
+        elif glob.has_magic(path):
+            matches = sorted(match for match in glob.glob(path) if os.path.isdir(match) == folders)
+        elif not os.path.exists(os.path.realpath(path)):
+            raise FileNotFoundError(path)
+        elif os.path.isdir(path) and not folders:
+            matches = sorted(os.path.join(path, name) for name in os.listdir(path)
+                             if name.lower().endswith('.xp3') and os.path.isfile(os.path.join(path, name)))
+        else:
+            matches = [path]
+        inputs.extend(match for match in matches if match not in inputs)
+    return inputs
+
+
+def output_path(operation: str, input: str, output: str = None, several: bool = False) -> str:
+    """Output of one input: the output itself for a single input, a file/folder named after the input inside it otherwise"""
+    if operation == 'repack':
+        name = os.path.basename(os.path.normpath(input)) + '.xp3'
+        default = os.path.normpath(input) + '.xp3'
+    else:
+        if is_url(input):  # Output into the current folder
+            from urllib.parse import urlparse
+            input = posixpath.basename(urlparse(input).path)
+        name = os.path.splitext(os.path.basename(input))[0]
+        default = os.path.splitext(input)[0]
+    if not output:
+        return default
+    return os.path.join(output, name) if several else output
+
+
+def run_job(job: tuple):
+    """
+    Run one operation on one input, arguments are the parsed command line options
+    :return: (input, success, summary line, output lines)
+    """
+    operation, input, output, args = job
+    from .structs import codec
+    codec.set_backend(args.zlib)
+    cypher = set_key(args.key) if args.key else args.cypher
+    is_silent = args.silent
+    lines = []
+
+    try:
+        if operation == 'repack' and getattr(args, 'estimate', False):
+            from .estimate import report
+            compressor = None
+            if args.max_compression:
+                from .compression import StrategySearch
+                compressor = StrategySearch()  # Without the remembered strategies, as in a first build
+            summary, lines = report(input, args.flatten, compressor,
+                                    args.segment_size << 20 if getattr(args, 'segment_size', None) else None)
+            if compressor:
+                compressor.close()
+            return input, True, summary, ['| ' + line for line in lines]
+        if operation == 'repack':
+            compressor = None
+            if args.max_compression:
+                from .compression import StrategySearch, CACHE_DIR
+                compressor = StrategySearch(args.strategy_cache or os.path.join(CACHE_DIR, 'strategies.json'))
+            cache = None
+            if getattr(args, 'cache', False) or getattr(args, 'cache_dir', None):
+                from .buildcache import BuildCache
+                cache = BuildCache(getattr(args, 'cache_dir', None), args.cache_size << 20)
+            with XP3(output, 'w', is_silent) as xp3:
+                if not is_silent:
+                    print('Packing {} → {}'.format(os.path.abspath(input), output))
+                xp3.compressor = compressor
+                xp3.cache = cache
+                if getattr(args, 'segment_size', None):
+                    xp3.segment_size = args.segment_size << 20
+                xp3.add_folder(input, args.flatten, cypher)
+                count = xp3.entry_count
+            if compressor:
+                compressor.close()
+                if not is_silent:
+                    print('Searched strategies for {} file(s), {} remembered'.format(compressor.searches, compressor.cache_hits))
+            summary = '{} file(s) → {}'.format(count, output)
+            if cache:
+                cache.close()
+                summary += ', {} of {} file(s) from the build cache ({:.0%})'.format(
+                    cache.hits, cache.hits + cache.misses, cache.hit_rate)
+            return input, True, summary, lines
+
+        with XP3(input, 'r', is_silent, io_policy=getattr(args, 'io', None)) as xp3:
+            if getattr(args, 'names', None):
+                xp3.load_names(args.names)
+            filter = filter_from_args(args)
+            selected = [file for file in xp3 if not filter or filter(file.file_path)]
+            if operation == 'unpack':
+                if args.index:
+                    if not is_silent:
+                        print("Dumping index of {}".format(output))
+                    xp3.file_index.unpack(output)
+                    return input, True, 'index → {}_index.bin'.format(output), lines
+                if not is_silent:
+                    print("Unpacking {} → {}".format(input, os.path.abspath(output)))
+                xp3.unpack(output, cypher, filter, getattr(args, 'convert_tlg', None))
+                return input, True, '{} file(s) → {}'.format(len(selected), output), lines
+            elif operation == 'verify':
+                failed = xp3.verify(cypher, filter)
+                lines.extend('! {}'.format(file_path) for file_path in failed)
+                return input, not failed, '{} file(s), {} failed'.format(len(selected), len(failed)), lines
+            elif operation == 'list':
+                lines.extend('{:>12} {:>12}  {}'.format(file.info.uncompressed_size, file.info.compressed_size,
+                                                        file.file_path) for file in selected)
+                return input, True, '{} file(s)'.format(len(selected)), lines
+    except Exception as error:
+        return input, False, 'ERROR: {}'.format(error or type(error).__name__), lines
+    raise ValueError(f'Unknown operation {operation}')
+
+
+def run_jobs(jobs: list, workers: int = None, silent: bool = False) -> int:
+    """
+    Run the jobs (see run_job) in a process pool, or in this process if there is only one
+    :return: Exit status, 0 if all jobs succeeded, 1 otherwise
+    """
+    if len(jobs) == 1:
+        results = [run_job(jobs[0])]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(min(workers or os.cpu_count(), len(jobs))) as executor:
+            results = list(executor.map(run_job, jobs))
+
+    failed = 0
+    for input, success, summary, lines in results:
+        for line in lines:
+            print(line)
+        if not success:
+            failed += 1
+        if not silent or not success:
+            print('{} {}: {}'.format('|' if success else '!', input, summary))
+    if len(results) > 1 and not silent:
+        print('{} archive(s), {} failed'.format(len(results), failed))
+    return 1 if failed else 0
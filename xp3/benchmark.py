@@ -0,0 +1,150 @@
+import time, random, zlib
+from .structs import codec
+
+
+def sample_data(size: int, seed: int = 0) -> bytes:
+    """Script-like UTF-16 text mixed with some incompressible data"""
+    rng = random.Random(seed)
+    words = ['[wait time=500]', '[p]', '@bg storage=', 'chara', 'voice', '「', '」', 'の', 'は', 'です', '\r\n'] \
+        + [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(2, 9))) for _ in range(500)]
+    text = bytearray()
+    while len(text) < size * 3 // 4:
+        text += ' '.join(rng.choices(words, k=64)).encode('utf-16le')
+    return bytes(text[:size * 3 // 4]) + rng.randbytes(size - size * 3 // 4)
+
+
+def _best_time(function, repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_codec(data: bytes, level: int = 9, repeat: int = 3) -> list:
+    """
+    Time compression and decompression of the data with every installed deflate backend
+    :return: List of (backend, compressed size, compress MiB/s, decompress MiB/s, readable by stdlib zlib) tuples
+    """
+    results = []
+    megabytes = len(data) / 2**20
+    try:
+        for name in codec.available_backends():
+            codec.set_backend(name)
+            compressed = codec.compress(data, level)
+            compress_time = _best_time(lambda: codec.compress(data, level), repeat)
+            # Decompress a stream made by the standard zlib, as stored in the existing archives
+            reference = zlib.compress(data, level)
+            decompress_time = _best_time(lambda: codec.decompress(reference), repeat)
+            compatible = zlib.decompress(compressed) == data
+            results.append((name, len(compressed), megabytes / compress_time, megabytes / decompress_time, compatible))
+    finally:
+        codec.set_backend()
+    return results
+
+
+def codec_main(args):
+    if args.files:
+        data = b''
+        for path in args.files:
+            with open(path, 'rb') as file:
+                data += file.read()
+    else:
+        data = sample_data(args.size * 2**20)
+
+    print('{} bytes, level {}'.format(len(data), args.level))
+    print('{:<10}{:>14}{:>16}{:>18}  {}'.format('backend', 'size', 'deflate MiB/s', 'inflate MiB/s', 'zlib compatible'))
+    for name, size, compress_speed, decompress_speed, compatible in bench_codec(data, args.level, args.repeat):
+        print('{:<10}{:>14}{:>16.1f}{:>18.1f}  {}'.format(name, size, compress_speed, decompress_speed, 'yes' if compatible else 'NO'))
+    return 0
+
+
+def drop_cache(path: str):
+    """Drop a file from the page cache of the OS, its next read comes from the disk"""
+    import os
+    with open(path, 'rb') as file:
+        os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def _read_archive(path: str, io_policy: str, order: list, encryption_type: str) -> int:
+    from .xp3 import XP3
+    size = 0
+    with XP3(path, silent=True, io_policy=io_policy) as xp3:
+        xp3.plan(order)
+        for index in order:
+            file = xp3[index]
+            file.read(encryption_type=encryption_type)
+            size += file.info.compressed_size
+    return size
+
+
+def bench_io(path: str, modes=(None,) + ('sequential', 'random', 'once'), shuffle: bool = False,
+             repeat: int = 3, encryption_type: str = 'none', seed: int = 0) -> list:
+    """
+    Time reading all the files of an archive with each I/O policy, from the disk and from the page cache
+    :param shuffle: Read the files in a random order instead of the order of the file index
+    :return: List of (policy, cold MiB/s, warm MiB/s) tuples, the warm runs come right after the cold one
+    """
+    from .xp3 import XP3
+    with XP3(path, silent=True) as xp3:
+        order = list(range(len(xp3.file_index.entries)))
+    if shuffle:
+        random.Random(seed).shuffle(order)
+    results = []
+    for mode in modes:
+        drop_cache(path)
+        start = time.perf_counter()
+        size = _read_archive(path, mode, order, encryption_type)
+        cold_time = time.perf_counter() - start
+        warm_time = _best_time(lambda: _read_archive(path, mode, order, encryption_type), repeat)
+        megabytes = size / 2**20
+        results.append((mode or 'none', megabytes / cold_time, megabytes / warm_time))
+    return results
+
+
+def io_main(args):
+    import os
+    from .iopolicy import MODES
+    if not hasattr(os, 'posix_fadvise'):
+        print('ERROR: posix_fadvise is not available on this system')
+        return 2
+    modes = [None] + [mode for mode in MODES if not args.mode or mode in args.mode]
+    print('{} ({} bytes), files read in {} order'.format(args.archive, os.path.getsize(args.archive),
+                                                        'random' if args.shuffle else 'index'))
+    print('{:<12}{:>14}{:>14}'.format('policy', 'cold MiB/s', 'warm MiB/s'))
+    for mode, cold_speed, warm_speed in bench_io(args.archive, modes, args.shuffle, args.repeat, args.cypher):
+        print('{:<12}{:>14.1f}{:>14.1f}'.format(mode, cold_speed, warm_speed))
+    return 0
+
+
+def benchmark_main(argv: list):
+    import argparse
+    parser = argparse.ArgumentParser(prog='xp3 benchmark', description='Performance benchmarks')
+    benchmarks = parser.add_subparsers(dest='benchmark', required=True)
+
+    parser_codec = benchmarks.add_parser('codec', help='Compare the installed deflate backends')
+    parser_codec.add_argument('files', nargs='*', help='Files to use as sample data (default: generated data)')
+    parser_codec.add_argument('--size', type=int, default=16, help='Size of the generated data in MiB (default: 16)')
+    parser_codec.add_argument('--level', type=int, default=9, help='Compression level (default: 9)')
+    parser_codec.add_argument('--repeat', type=int, default=3, help='Runs per measurement, the best is kept (default: 3)')
+    parser_codec.set_defaults(function=codec_main)
+
+    parser_io = benchmarks.add_parser('io', help='Compare the I/O policies (--io) on an archive, with a cold and a warm page cache')
+    parser_io.add_argument('archive', help='Archive to read')
+    parser_io.add_argument('--mode', action='append', choices=('sequential', 'random', 'once'),
+                           help='Policy to compare with no hints, can be repeated (default: all)')
+    parser_io.add_argument('--shuffle', action='store_true', default=False,
+                           help='Read the files in a random order, like a game does')
+    parser_io.add_argument('-c', '--cypher', default='none', help='Encryption type (default: none)')
+    parser_io.add_argument('--repeat', type=int, default=3, help='Warm runs, the best is kept (default: 3)')
+    parser_io.set_defaults(function=io_main)
+
+    args = parser.parse_args(argv)
+    return args.function(args)
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(benchmark_main(sys.argv[1:]))
@@ -0,0 +1,94 @@
+import os, struct, hashlib
+from .compression import CACHE_DIR
+
+DEFAULT_SIZE = 1 << 30  # 1 GiB
+HEADER = struct.Struct('<IQ?')  # adler32, uncompressed size, is compressed
+
+
+class BuildCache:
+    """
+    Packed data of files by their contents and packing settings, so repacks only compress and encrypt changed files.
+    Every entry is a file in the cache folder, their modification times are the last use for LRU eviction
+    """
+
+    def __init__(self, directory: str = None, max_size: int = DEFAULT_SIZE):
+        """
+        :param directory: Folder to keep the cache in (default: ~/.cache/krkr-xp3/build)
+        :param max_size: Size in bytes to evict the least recently used entries down to on close
+        """
+        self.directory = directory or os.path.join(CACHE_DIR, 'build')
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(data, *settings) -> str:
+        """Key of the data packed with the settings (cypher, key, compression...)"""
+        key = hashlib.sha256(data)
+        key.update(repr(settings).encode('utf-8'))
+        return key.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key: str):
+        """:return: (adler32, uncompressed size, is compressed, data to write) or None"""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as entry:
+                adler32, uncompressed_size, is_compressed = HEADER.unpack(entry.read(HEADER.size))
+                data = entry.read()
+            os.utime(path)
+        except (OSError, struct.error):  # Missing, evicted by another process or truncated
+            self.misses += 1
+            return None
+        self.hits += 1
+        return adler32, uncompressed_size, is_compressed, data
+
+    def put(self, key: str, adler32: int, uncompressed_size: int, is_compressed: bool, data: bytes):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write under a temporary name so other processes never read half of an entry
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'wb') as entry:
+            entry.write(HEADER.pack(adler32, uncompressed_size, is_compressed))
+            entry.write(data)
+        os.replace(temp_path, path)
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / (self.hits + self.misses) if self.hits + self.misses else 0.0
+
+    def evict(self) -> int:
+        """Remove the least recently used entries until the cache fits into max_size, returns the number removed"""
+        entries = []
+        for dirpath, dirs, filenames in os.walk(self.directory):
+            for filename in filenames:
+                try:
+                    stat = os.stat(os.path.join(dirpath, filename))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, os.path.join(dirpath, filename)))
+
+        size = sum(entry[1] for entry in entries)
+        removed = 0
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= entry_size
+            removed += 1
+        return removed
+
+    def close(self):
+        if os.path.isdir(self.directory):
+            self.evict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,178 @@
+import os, sqlite3
+from .xp3 import XP3
+from .structs import codec
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS archives (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    entries INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS entries (
+    archive_id INTEGER NOT NULL REFERENCES archives(id),
+    path TEXT NOT NULL,
+    uncompressed_size INTEGER NOT NULL,
+    compressed_size INTEGER NOT NULL,
+    adler32 INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    segments INTEGER NOT NULL,
+    encrypted INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_archive ON entries(archive_id);
+CREATE INDEX IF NOT EXISTS entries_path ON entries(path COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS entries_content ON entries(adler32, uncompressed_size);
+"""
+ENTRY_COLUMNS = 'archives.path, entries.path, entries.uncompressed_size, entries.adler32'
+
+
+class Catalog:
+    """SQLite catalog of the entries of many archives, to find files without opening every archive"""
+
+    def __init__(self, path: str, silent: bool = False):
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+        self.silent = silent
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def build(self, directory: str):
+        """
+        Index every .xp3 archive in the directory and its subdirectories,
+        archives with unchanged size and modification time are skipped, deleted ones are removed
+        :return: Number of indexed, unchanged and removed archives
+        """
+        directory = os.path.abspath(directory)
+        known = {path: (archive_id, size, mtime_ns) for archive_id, path, size, mtime_ns
+                 in self.connection.execute('SELECT id, path, size, mtime_ns FROM archives')}
+        indexed = unchanged = 0
+        found = set()
+        for dirpath, dirs, filenames in os.walk(directory):
+            for filename in filenames:
+                if not filename.lower().endswith('.xp3'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                found.add(path)
+                stat = os.stat(path)
+                if path in known and known[path][1:] == (stat.st_size, stat.st_mtime_ns):
+                    unchanged += 1
+                    continue
+                if self.add(path, stat):
+                    indexed += 1
+
+        removed = [archive_id for path, (archive_id, _, _) in known.items()
+                   if path.startswith(directory + os.sep) and path not in found]
+        with self.connection:
+            for archive_id in removed:
+                self._remove(archive_id)
+        return indexed, unchanged, len(removed)
+
+    def add(self, path: str, stat=None) -> bool:
+        """(Re)index a single archive, returns False if it can't be read"""
+        path = os.path.abspath(path)
+        stat = stat or os.stat(path)
+        try:
+            with XP3(path, 'r', silent=True) as xp3:
+                rows = [(entry.file_path, entry.info.uncompressed_size, entry.info.compressed_size, entry.adler32,
+                         entry.segm[0].offset if entry.segm.segments else 0, len(entry.segm.segments),
+                         entry.is_encrypted) for entry in xp3.file_index]
+        except (AssertionError, OSError, ValueError) + codec.error as error:
+            if not self.silent:
+                print('! Skipping {}: {}'.format(path, error))
+            return False
+
+        with self.connection:  # One transaction per archive
+            row = self.connection.execute('SELECT id FROM archives WHERE path = ?', (path,)).fetchone()
+            if row:
+                self._remove(row[0])
+            archive_id = self.connection.execute(
+                'INSERT INTO archives (path, size, mtime_ns, entries) VALUES (?, ?, ?, ?)',
+                (path, stat.st_size, stat.st_mtime_ns, len(rows))).lastrowid
+            self.connection.executemany('INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                        ((archive_id,) + row for row in rows))
+        if not self.silent:
+            print('| Indexed {} ({} files)'.format(path, len(rows)))
+        return True
+
+    def _remove(self, archive_id: int):
+        self.connection.execute('DELETE FROM entries WHERE archive_id = ?', (archive_id,))
+        self.connection.execute('DELETE FROM archives WHERE id = ?', (archive_id,))
+
+    def find_path(self, path: str) -> list:
+        """
+        Archives containing the file path (case insensitive, like the engine)
+        :return: List of (archive path, file path, size, adler32) tuples
+        """
+        return self.connection.execute(
+            f'SELECT {ENTRY_COLUMNS} FROM entries JOIN archives ON archives.id = archive_id '
+            'WHERE entries.path = ? COLLATE NOCASE ORDER BY archives.path', (path,)).fetchall()
+
+    def find_glob(self, pattern: str) -> list:
+        """Files with paths matching the glob pattern (case sensitive)"""
+        return self.connection.execute(
+            f'SELECT {ENTRY_COLUMNS} FROM entries JOIN archives ON archives.id = archive_id '
+            'WHERE entries.path GLOB ? ORDER BY archives.path, entries.path', (pattern,)).fetchall()
+
+    def find_content(self, adler32: int, size: int = None) -> list:
+        """Files with the checksum (and size)"""
+        query = f'SELECT {ENTRY_COLUMNS} FROM entries JOIN archives ON archives.id = archive_id WHERE adler32 = ?'
+        if size is not None:
+            return self.connection.execute(query + ' AND uncompressed_size = ?', (adler32, size)).fetchall()
+        return self.connection.execute(query, (adler32,)).fetchall()
+
+    def duplicates(self) -> list:
+        """Files with the same content (checksum and size) stored more than once, grouped by content"""
+        return self.connection.execute(
+            f'SELECT {ENTRY_COLUMNS} FROM entries JOIN archives ON archives.id = archive_id '
+            'JOIN (SELECT adler32, uncompressed_size FROM entries WHERE uncompressed_size > 0 '
+            '      GROUP BY adler32, uncompressed_size HAVING COUNT(*) > 1) AS duplicate '
+            'USING (adler32, uncompressed_size) '
+            'ORDER BY entries.adler32, entries.uncompressed_size, archives.path').fetchall()
+
+
+def catalog_main(argv: list):
+    import argparse
+    parser = argparse.ArgumentParser(prog='xp3 catalog', description='Catalog of the files in many archives')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    parser_build = commands.add_parser('build', help='Index the archives in a folder (only new and changed ones)')
+    parser_build.add_argument('directory', help='Folder to search for .xp3 archives')
+
+    parser_query = commands.add_parser('query', help='Find files in the catalog')
+    query = parser_query.add_mutually_exclusive_group(required=True)
+    query.add_argument('--path', help='Internal file path (case insensitive)')
+    query.add_argument('--glob', help='Glob pattern for internal file paths, e.g. "*/bgm*.ogg"')
+    query.add_argument('--adler32', help='Checksum of the file contents (hex)')
+    query.add_argument('--duplicates', action='store_true', help='List the files stored more than once')
+
+    for subparser in (parser_build, parser_query):
+        subparser.add_argument('--db', default='catalog.sqlite', help='Catalog database (default: catalog.sqlite)')
+        subparser.add_argument('-s', '--silent', action='store_true', default=False)
+    args = parser.parse_args(argv)
+
+    with Catalog(args.db, args.silent) as catalog:
+        if args.command == 'build':
+            indexed, unchanged, removed = catalog.build(args.directory)
+            if not args.silent:
+                print('{} indexed, {} unchanged, {} removed'.format(indexed, unchanged, removed))
+            return 0
+
+        if args.path:
+            rows = catalog.find_path(args.path)
+        elif args.glob:
+            rows = catalog.find_glob(args.glob)
+        elif args.adler32:
+            rows = catalog.find_content(int(args.adler32, 16))
+        else:
+            rows = catalog.duplicates()
+        for archive, path, size, adler32 in rows:
+            print('{}:{}\t{}\t{:08x}'.format(archive, path, size, adler32))
+        return 0 if rows else 1
@@ -0,0 +1,78 @@
+import os, json, zlib, hashlib
+from concurrent.futures import ThreadPoolExecutor
+from .structs import codec
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'krkr-xp3')
+
+# Deflate configurations tried at level 9: (wbits, memLevel, strategy)
+STRATEGIES = (
+    (zlib.MAX_WBITS, 8, zlib.Z_DEFAULT_STRATEGY),
+    (zlib.MAX_WBITS, 9, zlib.Z_DEFAULT_STRATEGY),
+    (zlib.MAX_WBITS, 8, zlib.Z_FILTERED),
+    (zlib.MAX_WBITS, 9, zlib.Z_FILTERED),
+    (zlib.MAX_WBITS, 9, zlib.Z_RLE),
+    (zlib.MAX_WBITS, 9, zlib.Z_HUFFMAN_ONLY),
+    (13, 9, zlib.Z_DEFAULT_STRATEGY),
+    (11, 9, zlib.Z_DEFAULT_STRATEGY),
+)
+
+
+def compress_with(data, strategy: tuple) -> bytes:
+    wbits, mem_level, z_strategy = strategy
+    compressor = codec.compressobj(9, zlib.DEFLATED, wbits, mem_level, z_strategy)
+    return compressor.compress(data) + compressor.flush()
+
+
+class StrategySearch:
+    """
+    Compressor that tries several deflate configurations in parallel and keeps the smallest stream,
+    the winning configuration is remembered by content hash so the search is done only once per file
+    """
+
+    def __init__(self, cache_path: str = None, workers: int = None):
+        """
+        :param cache_path: JSON file to keep the winning strategies in (None to not keep them)
+        :param workers: Number of threads to compress with (default: number of CPUs)
+        """
+        self.cache_path = cache_path
+        self.cache = {}
+        if cache_path and os.path.isfile(cache_path):
+            with open(cache_path, encoding='utf-8') as cache:
+                self.cache = {key: tuple(strategy) for key, strategy in json.load(cache).items()}
+        self.executor = ThreadPoolExecutor(workers or os.cpu_count())
+        self.searches = 0
+        self.cache_hits = 0
+
+    def __call__(self, data) -> bytes:
+        key = hashlib.sha1(data).hexdigest()
+        strategy = self.cache.get(key)
+        if strategy in STRATEGIES:
+            self.cache_hits += 1
+            return compress_with(data, strategy)
+
+        self.searches += 1
+        results = list(self.executor.map(lambda strategy: (compress_with(data, strategy), strategy), STRATEGIES))
+        for compressed, strategy in sorted(results, key=lambda result: len(result[0])):
+            if codec.decompress(compressed) == data:
+                self.cache[key] = strategy
+                return compressed
+        raise AssertionError('No valid zlib stream was produced')
+
+    def save(self):
+        if not self.cache_path:
+            return
+        dirname = os.path.dirname(self.cache_path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        with open(self.cache_path, 'w', encoding='utf-8') as cache:
+            json.dump(self.cache, cache)
+
+    def close(self):
+        self.save()
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,70 @@
+from .xp3 import XP3
+from .merge import same_file
+
+ADDED, MODIFIED, DELETED = 'A', 'M', 'D'
+
+
+def compare(old_index, new_index):
+    """
+    Compare two file indexes by path, size and adler32 without reading any file data
+    :return: List of (status, file path) tuples, status is one of ADDED, MODIFIED or DELETED
+    """
+    old_entries = {entry.file_path: entry for entry in old_index}
+    new_entries = {entry.file_path: entry for entry in new_index}  # duplicate paths: last wins
+    changes = []
+    for entry in new_entries.values():
+        old = old_entries.pop(entry.file_path, None)
+        if old is None:
+            changes.append((ADDED, entry.file_path))
+        elif old.adler32 != entry.adler32 or old.info.uncompressed_size != entry.info.uncompressed_size:
+            changes.append((MODIFIED, entry.file_path))
+    changes.extend((DELETED, file_path) for file_path in old_entries)
+    return changes
+
+
+def diff(old: str, new: str, output: str = None, silent: bool = False):
+    """
+    Find the files that were added or changed in the new archive and copy them as is into a patch archive
+    :param old: Path of the old archive
+    :param new: Path of the new archive
+    :param output: Path of the patch archive to create (if not specified, only compares the archives)
+    :param silent: Supress prints
+    :return: List of changes, see compare()
+    """
+    if output and (same_file(output, old) or same_file(output, new)):
+        raise ValueError('The output can not be one of the archives being compared')
+    with XP3(old, 'r', silent=True) as old_xp3, XP3(new, 'r', silent=True) as new_xp3:
+        changes = compare(old_xp3.file_index, new_xp3.file_index)
+        if output:
+            with XP3(output, 'w', silent) as xp3:
+                for status, file_path in changes:
+                    if status != DELETED:
+                        xp3.add_entry(new_xp3.file_index[file_path], new_xp3.buffer)
+    return changes
+
+
+def diff_main(argv: list):
+    import argparse
+    parser = argparse.ArgumentParser(prog='xp3 diff',
+                                     description='Create a patch archive with the files that differ between two archives')
+    parser.add_argument('old', help='Old archive')
+    parser.add_argument('new', help='New archive')
+    parser.add_argument('-o', '--output', help='Patch archive to create (if omitted, only the changes are listed)')
+    parser.add_argument('-l', '--list', action='store_true', default=False, help='Print the list of changes')
+    parser.add_argument('-s', '--silent', action='store_true', default=False)
+    args = parser.parse_args(argv)
+
+    try:
+        changes = diff(args.old, args.new, args.output, args.silent or args.list)
+    except ValueError as error:
+        print('ERROR: {}'.format(error))
+        return 2
+    if args.list or not args.output:
+        for status, file_path in changes:
+            print(status, file_path)
+    if not args.silent:
+        counts = {status: sum(1 for change in changes if change[0] == status) for status in (ADDED, MODIFIED, DELETED)}
+        print('{} added, {} modified, {} deleted'.format(counts[ADDED], counts[MODIFIED], counts[DELETED]))
+        if counts[DELETED] and args.output:
+            print('! Deleted files can not be expressed in a patch archive')
+    return 0
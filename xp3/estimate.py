@@ -0,0 +1,120 @@
+import os, time, random
+from collections import namedtuple, defaultdict
+from .structs import XP3Signature, XP3FileIndex, XP3FileEntry, XP3FileTime, XP3FileAdler, XP3FileSegments, \
+    XP3FileInfo, codec
+from .xp3writer import STORED_EXTENSIONS
+
+SAMPLE_BLOCK_SIZE = 1 << 16  # 64 KiB
+SAMPLE_SIZE = 32 << 20  # Bytes to compress for the whole folder
+BLOCKS_PER_FILE = 4
+HEADER_SIZE = len(XP3Signature) + 8 + 4
+
+FileEstimate = namedtuple('FileEstimate', 'path, size, packed_size, seconds')
+
+
+def folder_files(path: str, flatten: bool = False) -> list:
+    """:return: List of (file path, internal path) in the order XP3.add_folder() adds them"""
+    files = []
+    for dirpath, dirs, filenames in os.walk(path):
+        internal_root = '/'.join(dirpath[len(path) + 1:].split(os.sep))
+        for filename in filenames:
+            files.append((os.path.join(dirpath, filename),
+                          internal_root + '/' + filename if internal_root and not flatten else filename))
+    return files
+
+
+def _sample(file_path: str, size: int, rng) -> list:
+    """Blocks at random places of the file, the whole file if it is small"""
+    with open(file_path, 'rb') as file:
+        if size <= SAMPLE_BLOCK_SIZE * BLOCKS_PER_FILE:
+            return [file.read()]
+        blocks = []
+        for offset in sorted(rng.sample(range(size // SAMPLE_BLOCK_SIZE), BLOCKS_PER_FILE)):
+            file.seek(offset * SAMPLE_BLOCK_SIZE)
+            blocks.append(file.read(SAMPLE_BLOCK_SIZE))
+        return blocks
+
+
+def estimate(path: str, flatten: bool = False, compressor=None, segment_size: int = None,
+             sample_size: int = SAMPLE_SIZE, seed: int = 0) -> tuple:
+    """
+    Estimate the size of the archive repacked from a folder and the time it takes, by compressing
+    blocks sampled from the files: each extension gets a share of the samples by its total size
+    and its files without samples get its compression ratio and speed
+    :param compressor: Function packing will compress with (default: level 9)
+    :param segment_size: Segment size of the writer
+    :param sample_size: Number of bytes to compress in total
+    :return: (list of FileEstimate, archive size, seconds to pack, bytes sampled)
+    """
+    rng = random.Random(seed)
+    files = [(file_path, internal_path, os.path.getsize(file_path)) for file_path, internal_path in folder_files(path, flatten)]
+    by_extension = defaultdict(list)
+    for file in files:
+        by_extension[os.path.splitext(file[1])[1]].append(file)
+    compressible_size = sum(file[2] for extension, ext_files in by_extension.items()
+                            if extension not in STORED_EXTENSIONS for file in ext_files) or 1
+
+    ratios = {}  # Compression ratio of the sampled files and of the extensions
+    speeds = {}  # Compressed bytes per second of the extensions
+    sampled = read_size = 0
+    read_time = 0.0
+    for extension, ext_files in by_extension.items():
+        if extension in STORED_EXTENSIONS:
+            continue
+        budget = max(SAMPLE_BLOCK_SIZE, sample_size * sum(file[2] for file in ext_files) // compressible_size)
+        ext_size = ext_packed = 0
+        ext_time = 0.0
+        for file_path, internal_path, size in rng.sample(ext_files, len(ext_files)):
+            if ext_size >= budget:
+                break
+            start = time.perf_counter()
+            blocks = _sample(file_path, size, rng)
+            read_time += time.perf_counter() - start
+            start = time.perf_counter()
+            packed = sum(len(compressor(block) if compressor else codec.compress(block, level=9)) for block in blocks)
+            ext_time += time.perf_counter() - start
+            block_size = sum(map(len, blocks))
+            read_size += block_size
+            ext_size += block_size
+            ext_packed += packed
+            ratios[file_path] = packed / block_size if block_size else 1.0
+        ratios[extension] = ext_packed / ext_size if ext_size else 1.0
+        speeds[extension] = ext_size / ext_time if ext_time else float('inf')
+        sampled += ext_size
+    read_speed = read_size / read_time if read_time else float('inf')
+
+    estimates = []
+    entries = []
+    for file_path, internal_path, size in files:
+        extension = os.path.splitext(internal_path)[1]
+        seconds = size / read_speed
+        if extension in STORED_EXTENSIONS:
+            packed_size = size
+        else:
+            # Stored if it doesn't get smaller, as _pack_data() decides
+            packed_size = min(size, round(size * ratios.get(file_path, ratios[extension])))
+            seconds += size / speeds[extension]
+        estimates.append(FileEstimate(internal_path, size, packed_size, seconds))
+        segments = max(1, -(-size // segment_size)) if segment_size and extension not in STORED_EXTENSIONS else 1
+        entries.append(XP3FileEntry(
+            encryption=None, time=XP3FileTime(0), adlr=XP3FileAdler(0),
+            segm=XP3FileSegments([XP3FileSegments.segment(packed_size < size, 0, size // segments, packed_size // segments)
+                                  for _ in range(segments)]),
+            info=XP3FileInfo(is_encrypted=False, uncompressed_size=size, compressed_size=packed_size,
+                             file_path=internal_path)))
+    index_size = len(XP3FileIndex.from_entries(entries).to_bytes()) if entries else 0
+    archive_size = HEADER_SIZE + sum(file.packed_size for file in estimates) + index_size
+    return estimates, archive_size, sum(file.seconds for file in estimates), sampled
+
+
+def report(path: str, flatten: bool = False, compressor=None, segment_size: int = None, top: int = 10) -> tuple:
+    """:return: (summary line, lines with the files that take the longest to pack)"""
+    start = time.perf_counter()
+    estimates, archive_size, seconds, sampled = estimate(path, flatten, compressor, segment_size)
+    size = sum(file.size for file in estimates)
+    lines = ['{:>8.1f} s {:>12} → {:>12}  {}'.format(file.seconds, file.size, file.packed_size, file.path)
+             for file in sorted(estimates, key=lambda file: file.seconds, reverse=True)[:top]]
+    summary = '{} file(s), {} → ~{} bytes ({:.0%}), ~{:.0f} s to pack (sampled {} bytes in {:.1f} s)'.format(
+        len(estimates), size, archive_size, archive_size / size if size else 1, seconds, sampled,
+        time.perf_counter() - start)
+    return summary, lines
@@ -0,0 +1,134 @@
+import sys, time, tarfile, zipfile
+from io import RawIOBase
+from .xp3 import XP3
+from .structs.file import XP3ChecksumError
+
+FORMATS = ('tar', 'zip')
+ZIP_MIN_TIMESTAMP = 315532800  # 1980-01-01, the earliest date a zip file can store
+
+
+class ChunkReader(RawIOBase):
+    """Read-only file object over an iterator of byte chunks"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.pending = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending:
+            self.pending = next(self.chunks, None)
+            if self.pending is None:
+                self.pending = b''
+                return 0
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+
+def export(archive: str, output, format: str = 'tar', encryption_type: str = 'none', silent: bool = False,
+           filter=None):
+    """
+    Write the files of an archive into a tar or zip archive without extracting them to disk,
+    the files are read in chunks so memory use doesn't depend on their size
+    :param archive: Path of the XP3 archive
+    :param output: Path or binary file object (e.g. sys.stdout.buffer) to write to
+    :param format: 'tar' or 'zip', zip files are stored without compression
+    :param encryption_type: Encryption type to decrypt with
+    :param silent: Supress prints
+    :param filter: Function taking an internal file path and returning True if the file should be exported
+    :return: Number of exported files
+    :raises XP3ChecksumError: After the whole export, if some files didn't match their checksum.
+                              Their data is in the output as it can't be taken back from a stream
+    """
+    if format not in FORMATS:
+        raise ValueError(f'Unsupported format {format}')
+
+    count = 0
+    invalid = []
+    with XP3(archive, 'r', silent=True) as xp3:
+        xp3.silent = silent  # Checksum errors are reported by the files
+        if format == 'tar':
+            writer = tarfile.open(output, 'w|') if isinstance(output, str) else tarfile.open(fileobj=output, mode='w|')
+        else:
+            writer = zipfile.ZipFile(output, 'w', zipfile.ZIP_STORED, allowZip64=True)
+
+        with writer:
+            for index, entry in enumerate(xp3.file_index):
+                if entry.file_path == '' or 'This is a protected archive' in entry.file_path:
+                    continue
+                if filter and not filter(entry.file_path):
+                    continue
+                file = xp3[index]
+                if file.is_script:
+                    chunks = file.stream(encryption_type)
+                    data = next(chunks, None)
+                    if data is None:  # Checksum error, read() left it out
+                        invalid.append(file.file_path)
+                        continue
+                    chunks, size = iter((data,)), len(data)
+                else:
+                    chunks, size = file.stream(encryption_type), file.segm.uncompressed_size
+
+                if not silent:
+                    print('| Exporting {} ({} bytes)'.format(file.file_path, size))
+                try:
+                    if format == 'tar':
+                        info = tarfile.TarInfo(file.file_path)
+                        info.size = size
+                        info.mtime = file.time.timestamp
+                        writer.addfile(info, ChunkReader(chunks))
+                    else:
+                        date_time = time.localtime(max(file.time.timestamp, ZIP_MIN_TIMESTAMP))[:6]
+                        with writer.open(zipfile.ZipInfo(file.file_path, date_time), 'w',
+                                         force_zip64=size >= 2**31) as entry:
+                            for chunk in chunks:
+                                entry.write(chunk)
+                    next(chunks, None)  # The checksum is verified once the chunks run out, tar stops at the size
+                except XP3ChecksumError:
+                    invalid.append(file.file_path)
+                count += 1
+    if invalid:
+        raise XP3ChecksumError('Checksum error in {} file(s): {}'.format(len(invalid), ', '.join(invalid)))
+    return count
+
+
+def export_main(argv: list):
+    import argparse
+    from contextlib import redirect_stdout
+    from .xp3 import set_key
+    from .filters import add_filter_arguments, filter_from_args
+    from .structs.encryption_parameters import encryption_parameters
+    parser = argparse.ArgumentParser(prog='xp3 export',
+                                     description='Export the files of an archive into a tar or zip archive')
+    parser.add_argument('archive', help='Archive to export')
+    parser.add_argument('-o', '--output', default='-', help='Output file, - for stdout (default: -)')
+    parser.add_argument('--format', choices=FORMATS,
+                        help='Output format (default: zip if the output ends with .zip, tar otherwise)')
+    parser.add_argument('-c', '--cypher', choices=encryption_parameters.keys(), default='none',
+                        help='Specify the cypher mode')
+    parser.add_argument('-k', '--key', default='', help='Archive XOR key')
+    parser.add_argument('-s', '--silent', action='store_true', default=False)
+    add_filter_arguments(parser)
+    args = parser.parse_args(argv)
+
+    cypher = set_key(args.key) if args.key else args.cypher
+    format = args.format or ('zip' if args.output.lower().endswith('.zip') else 'tar')
+    messages = sys.stderr if args.output == '-' else sys.stdout
+    try:
+        if args.output == '-':
+            # Keep stdout for the data, messages go to stderr
+            stdout = sys.stdout.buffer
+            with redirect_stdout(sys.stderr):
+                count = export(args.archive, stdout, format, cypher, args.silent, filter_from_args(args))
+        else:
+            count = export(args.archive, args.output, format, cypher, args.silent, filter_from_args(args))
+    except XP3ChecksumError as error:
+        print('ERROR: {}'.format(error), file=messages)
+        return 2
+    if not args.silent:
+        print('Exported {} file(s)'.format(count), file=messages)
+    return 0
@@ -0,0 +1,39 @@
+import re, fnmatch
+
+
+def path_filter(include: list = (), exclude: list = (), include_regex: list = (), exclude_regex: list = ()):
+    """
+    Make a filter for internal file paths from glob patterns and regular expressions,
+    a path passes if it matches any of the include patterns (or there are none) and none of the exclude ones
+    :return: Function taking a path and returning True if it passes, or None if there are no patterns
+    """
+    includes = [fnmatch.translate(pattern) for pattern in include] + list(include_regex)
+    excludes = [fnmatch.translate(pattern) for pattern in exclude] + list(exclude_regex)
+    if not includes and not excludes:
+        return None
+
+    # Globs are anchored by translate(), regular expressions match anywhere unless anchored themselves
+    include_match = re.compile('|'.join(f'(?:{pattern})' for pattern in includes)).search if includes else None
+    exclude_match = re.compile('|'.join(f'(?:{pattern})' for pattern in excludes)).search if excludes else None
+
+    def matches(file_path: str) -> bool:
+        if include_match and not include_match(file_path):
+            return False
+        return not (exclude_match and exclude_match(file_path))
+    return matches
+
+
+def add_filter_arguments(parser):
+    """Add the --include/--exclude options to an argument parser, see filter_from_args()"""
+    parser.add_argument("--include", action="append", default=[], metavar="GLOB",
+                        help="Only process the files matching the pattern, e.g. *.ks (can be repeated)")
+    parser.add_argument("--exclude", action="append", default=[], metavar="GLOB",
+                        help="Skip the files matching the pattern (can be repeated)")
+    parser.add_argument("--include-regex", action="append", default=[], metavar="REGEX",
+                        help="Only process the files with paths matching the regular expression (can be repeated)")
+    parser.add_argument("--exclude-regex", action="append", default=[], metavar="REGEX",
+                        help="Skip the files with paths matching the regular expression (can be repeated)")
+
+
+def filter_from_args(args):
+    return path_filter(args.include, args.exclude, args.include_regex, args.exclude_regex)
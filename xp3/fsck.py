@@ -0,0 +1,145 @@
+import os, struct
+from io import BytesIO
+from itertools import chain
+from collections import Counter
+from .structs import XP3Signature, XP3FileIndex, XP3FileEntry
+
+HEADER_SIZE = len(XP3Signature) + 8 + 4  # Signature, index offset, minor version
+
+
+def read_entries(buffer) -> tuple:
+    """
+    Read the file index without checking the entries
+    :return: (entries, problems), parsing stops at the first entry that can't be read
+    """
+    problems = []
+    if XP3Signature != buffer.read(len(XP3Signature)):
+        return [], [('', 'not an XP3 archive')]
+    try:
+        index = XP3FileIndex.read_index(buffer)
+    except (AssertionError, struct.error, OSError) as error:
+        return [], [('', "the file index can't be read: {}".format(error or type(error).__name__))]
+
+    entries = []
+    with BytesIO(index) as index_buffer:
+        while index_buffer.tell() < len(index):
+            position = index_buffer.tell()
+            try:
+                entries.append(XP3FileEntry.read_from(index_buffer, strict=False))
+            except Exception as error:  # Any garbage can be in a corrupted index
+                problems.append(('', "entry {} at byte {} of the file index can't be read: {}".format(
+                    len(entries), position, error or type(error).__name__)))
+                break
+    return entries, problems
+
+
+def check(entries: list, archive_size: int) -> list:
+    """
+    Check the file entries of an archive without reading any file data: segments out of the archive,
+    overlapping segments, segment sizes that don't add up to the info chunk sizes, duplicate paths
+    and checksums that differ between the adlr and encryption chunks
+    :param archive_size: Size of the archive in bytes
+    :return: List of (file path, problem) tuples
+    """
+    import numpy
+    problems = []
+    if not entries:
+        return problems
+    # Columns gathered with one plain loop each, the checks themselves are done on arrays
+    paths = [entry.encryption.file_path if entry.encryption else entry.info.file_path for entry in entries]
+    infos = [entry.info for entry in entries]
+    info_sizes = numpy.stack((numpy.fromiter([info.uncompressed_size for info in infos], numpy.uint64, len(entries)),
+                              numpy.fromiter([info.compressed_size for info in infos], numpy.uint64, len(entries))), 1)
+    checksums = numpy.fromiter([entry.adlr.value for entry in entries], numpy.uint64, len(entries))
+    encryption_checksums = numpy.fromiter([entry.encryption.adler32 if entry.encryption else entry.adlr.value
+                                           for entry in entries], numpy.uint64, len(entries))
+    segment_lists = [entry.segm.segments for entry in entries]
+    counts = numpy.fromiter(map(len, segment_lists), numpy.int64, len(entries))
+    # One row per segment: is compressed, offset, uncompressed and compressed size
+    segments = numpy.fromiter(chain.from_iterable(chain.from_iterable(segment_lists)), numpy.uint64,
+                              int(counts.sum()) * 4).reshape(-1, 4)
+    entry_ids = numpy.repeat(numpy.arange(len(entries)), counts)
+    is_compressed, offsets, uncompressed_sizes, compressed_sizes = segments.T
+
+    # Segments out of the archive
+    archive_size = numpy.uint64(archive_size)
+    outside = (offsets < HEADER_SIZE) | (compressed_sizes > archive_size) \
+              | (offsets > archive_size - numpy.minimum(compressed_sizes, archive_size))
+    for row in numpy.flatnonzero(outside):
+        problems.append((paths[entry_ids[row]], 'segment at {} ({} bytes) is outside of the archive ({} bytes)'.format(
+            offsets[row], compressed_sizes[row], archive_size)))
+
+    stored = (is_compressed == 0) & (compressed_sizes != uncompressed_sizes)
+    for row in numpy.flatnonzero(stored):
+        problems.append((paths[entry_ids[row]], 'uncompressed segment at {} has different sizes ({} and {})'.format(
+            offsets[row], compressed_sizes[row], uncompressed_sizes[row])))
+
+    # Overlapping segments: sort by offset and compare every start with the furthest end before it,
+    # identical segments are shared by several files on purpose
+    rows = numpy.flatnonzero((compressed_sizes > 0) & ~outside)
+    rows = rows[numpy.lexsort((compressed_sizes[rows], offsets[rows]))]
+    starts, ends = offsets[rows], offsets[rows] + compressed_sizes[rows]
+    if len(rows) > 1:
+        furthest = numpy.maximum.accumulate(ends)
+        positions = numpy.arange(len(rows))
+        owners = numpy.maximum.accumulate(numpy.where(ends == furthest, positions, 0))
+        shared = (starts[1:] == starts[:-1]) & (ends[1:] == ends[:-1])
+        for position in numpy.flatnonzero((starts[1:] < furthest[:-1]) & ~shared) + 1:
+            row, other = rows[position], rows[owners[position - 1]]
+            problems.append((paths[entry_ids[row]], 'segment at {} ({} bytes) overlaps the one of {} at {} ({} bytes)'.format(
+                offsets[row], compressed_sizes[row], paths[entry_ids[other]], offsets[other], compressed_sizes[other])))
+
+    # Segment sizes against the info chunk
+    segment_sizes = numpy.zeros((len(entries), 2), dtype=numpy.uint64)
+    numpy.add.at(segment_sizes, entry_ids, segments[:, 2:])
+    for index in numpy.flatnonzero((segment_sizes != info_sizes).any(axis=1)):
+        problems.append((paths[index], 'segments add up to {} bytes ({} compressed), the info chunk says {} ({})'.format(
+            *segment_sizes[index], *info_sizes[index])))
+
+    # Duplicate paths, the engine doesn't tell the case apart
+    lower_paths = '\0'.join(paths).lower().split('\0')
+    if len(set(lower_paths)) < len(paths):
+        path_counts = Counter(lower_paths)
+        for path, lower_path in zip(paths, lower_paths):
+            if path_counts[lower_path] > 1:
+                problems.append((path, 'path is used by {} files'.format(path_counts[lower_path])))
+
+    for index in numpy.flatnonzero(checksums != encryption_checksums):
+        problems.append((paths[index], 'checksums in the adlr and encryption chunks differ (0x{:08X} and 0x{:08X})'.format(
+            checksums[index], encryption_checksums[index])))
+    return problems
+
+
+def fsck(archive: str) -> tuple:
+    """
+    Check the structure of an archive from its file index
+    :return: (number of files, list of (file path, problem) tuples)
+    """
+    with open(archive, 'rb') as buffer:
+        entries, problems = read_entries(buffer)
+    return len(entries), problems + check(entries, os.path.getsize(archive))
+
+
+def fsck_main(argv: list):
+    import argparse
+    from .structs.file import numpy_available
+    parser = argparse.ArgumentParser(prog='xp3 fsck',
+                                     description='Check the file index of archives for broken or overlapping segments, '
+                                                 'size and checksum mismatches and duplicate paths')
+    parser.add_argument('archive', nargs='+', help='Archives to check')
+    parser.add_argument('-s', '--silent', action='store_true', default=False, help='Only print the problems')
+    args = parser.parse_args(argv)
+
+    if not numpy_available():
+        print('ERROR: numpy is not installed')
+        return 2
+    status = 0
+    for archive in args.archive:
+        count, problems = fsck(archive)
+        for path, problem in problems:
+            print('! {}:{} {}'.format(archive, path, problem))
+        if problems:
+            status = 1
+        if not args.silent:
+            print('{} {}: {} file(s), {} problem(s)'.format('!' if problems else '|', archive, count, len(problems)))
+    return status
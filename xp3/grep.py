@@ -0,0 +1,322 @@
+import os, re, sqlite3
+from .xp3 import XP3
+from .structs import codec
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:  # Python < 3.11
+    import sre_parse, sre_constants
+
+SCRIPT_EXTENSIONS = ('.ks', '.tjs', '.txt', '.csv', '.ini', '.scn')
+BATCH_SIZE = 64  # Files read by a worker at a time
+QUERY_SIZE = 900  # Parameters of a query, under the limit of old SQLite versions
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS archives (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS texts (
+    id INTEGER PRIMARY KEY,
+    adler32 INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    UNIQUE (adler32, size)
+);
+CREATE TABLE IF NOT EXISTS entries (
+    archive_id INTEGER NOT NULL REFERENCES archives(id),
+    path TEXT NOT NULL,
+    text_id INTEGER NOT NULL REFERENCES texts(id)
+);
+CREATE TABLE IF NOT EXISTS trigrams (
+    trigram TEXT NOT NULL,
+    text_id INTEGER NOT NULL,
+    PRIMARY KEY (trigram, text_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS entries_archive ON entries(archive_id);
+CREATE INDEX IF NOT EXISTS entries_text ON entries(text_id);
+"""
+
+
+def decode_text(data: bytes) -> str:
+    """Text of a script in UTF-16 (the descrambled scripts), UTF-8 or Shift-JIS, with \\n line ends"""
+    if data[:2] in (b'\xff\xfe', b'\xfe\xff'):
+        text = data.decode('utf-16', errors='replace')
+    elif data[:3] == b'\xef\xbb\xbf':
+        text = data[3:].decode('utf-8', errors='replace')
+    else:
+        try:
+            text = data.decode('utf-8')
+        except UnicodeDecodeError:
+            text = data.decode('cp932', errors='replace')
+    return text.replace('\r\n', '\n').replace('\r', '\n')
+
+
+def trigrams(text: str) -> set:
+    """Case folded trigrams of the text, the ones spanning lines are left out as matches don't span them"""
+    text = text.casefold()
+    return {text[index:index + 3] for index in range(len(text) - 2) if '\n' not in text[index:index + 3]}
+
+
+def _sequence(items) -> list:
+    """Items of a parsed regular expression with the groups matched once replaced by their items"""
+    sequence = []
+    for op, av in items:
+        if op is sre_constants.SUBPATTERN:
+            sequence.extend(_sequence(av[-1]))
+        else:
+            sequence.append((op, av))
+    return sequence
+
+
+def required_literals(pattern: str, flags: int = 0) -> list:
+    """
+    Literal strings every match of the regular expression contains, to pick the texts to search with the trigrams,
+    taken from the pattern parsed by the re module so escapes, classes and verbose patterns are read like it does
+    :param flags: Flags the expression is compiled with
+    :return: List of strings, empty if nothing is certain (alternatives, classes everywhere...)
+    """
+    literals = []
+    current = ''
+    for op, av in _sequence(sre_parse.parse(pattern, flags)) + [(None, None)]:
+        if op is sre_constants.LITERAL:
+            current += chr(av)
+            continue
+        if len(current) >= 3:
+            literals.append(current)
+        current = ''
+    return literals
+
+
+def _read_texts(archive: str, paths: list, cypher: str = 'none', key: str = None) -> list:
+    """Read and decode some files of an archive in a worker, returns (path, text) of the ones read"""
+    if key:
+        from .xp3 import set_key
+        cypher = set_key(key)
+    texts = []
+    with XP3(archive, silent=True) as xp3:
+        for path in paths:
+            data = xp3.open(path).read(encryption_type=cypher)
+            if data is not None:
+                texts.append((path, decode_text(data)))
+    return texts
+
+
+def read_texts(jobs: list, workers: int = None, cypher: str = 'none', key: str = None):
+    """
+    Read the script files of archives in parallel
+    :param jobs: List of (archive path, list of internal paths)
+    :return: Iterator of (archive path, internal path, text)
+    """
+    batches = [(archive, paths[start:start + BATCH_SIZE]) for archive, paths in jobs
+               for start in range(0, len(paths), BATCH_SIZE)]
+    workers = min(workers or os.cpu_count() or 1, len(batches))
+    if workers <= 1:
+        results = (_read_texts(archive, paths, cypher, key) for archive, paths in batches)
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(workers)
+        results = executor.map(_read_texts, *zip(*batches), [cypher] * len(batches), [key] * len(batches))
+    for (archive, _), texts in zip(batches, results):
+        for path, text in texts:
+            yield archive, path, text
+    if workers > 1:
+        executor.shutdown()
+
+
+def script_entries(archive: str) -> list:
+    """:return: List of (internal path, adler32, size) of the script files in the archive"""
+    with XP3(archive, silent=True) as xp3:
+        return [(entry.file_path, entry.adler32, entry.info.uncompressed_size) for entry in xp3.file_index
+                if entry.file_path.lower().endswith(SCRIPT_EXTENSIONS)]
+
+
+class TextIndex:
+    """
+    SQLite index of the text of the scripts in archives: each distinct text (by checksum and size) is stored once
+    with its trigrams, searches only look at the texts that have all the trigrams of the pattern
+    """
+
+    def __init__(self, path: str, silent: bool = False):
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+        self.silent = silent
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def update(self, archives: list, workers: int = None, cypher: str = 'none', key: str = None) -> tuple:
+        """
+        Index the archives, unchanged archives (size and modification time) are skipped,
+        and only the files with texts that aren't in the index yet are read
+        :return: (number of indexed archives, number of files read)
+        """
+        known = {path: (archive_id, size, mtime_ns) for archive_id, path, size, mtime_ns
+                 in self.connection.execute('SELECT id, path, size, mtime_ns FROM archives')}
+        texts = {(adler32, size): text_id for text_id, adler32, size
+                 in self.connection.execute('SELECT id, adler32, size FROM texts')}
+        changed = {}
+        removed = [archive_id for path, (archive_id, _, _) in known.items() if not os.path.isfile(path)]
+        for archive in archives:
+            archive = os.path.abspath(archive)
+            try:
+                stat = os.stat(archive)
+                if known.get(archive, (None,))[1:] == (stat.st_size, stat.st_mtime_ns):
+                    continue
+                changed[archive] = (stat, script_entries(archive))
+            except (AssertionError, OSError, ValueError) + codec.error as error:
+                if not self.silent:
+                    print('! Skipping {}: {}'.format(archive, error))
+
+        # Read the new texts, once for the files with the same content
+        missing = {}
+        for archive, (stat, entries) in changed.items():
+            for path, adler32, size in entries:
+                if (adler32, size) not in texts and (adler32, size) not in missing:
+                    missing[adler32, size] = (archive, path)
+        jobs = {}
+        for archive, path in missing.values():
+            jobs.setdefault(archive, []).append(path)
+        sizes = {(archive, path): content for content, (archive, path) in missing.items()}
+        read = 0
+        with self.connection:
+            for archive, path, text in read_texts(list(jobs.items()), workers, cypher, key):
+                adler32, size = sizes[archive, path]
+                text_id = self.connection.execute('INSERT INTO texts (adler32, size, text) VALUES (?, ?, ?)',
+                                                  (adler32, size, text)).lastrowid
+                self.connection.executemany('INSERT INTO trigrams VALUES (?, ?)',
+                                            ((trigram, text_id) for trigram in trigrams(text)))
+                texts[adler32, size] = text_id
+                read += 1
+
+            for archive_id in removed:
+                self._remove(archive_id)
+            for archive, (stat, entries) in changed.items():
+                if archive in known:
+                    self._remove(known[archive][0])
+                archive_id = self.connection.execute(
+                    'INSERT INTO archives (path, size, mtime_ns) VALUES (?, ?, ?)',
+                    (archive, stat.st_size, stat.st_mtime_ns)).lastrowid
+                self.connection.executemany(
+                    'INSERT INTO entries VALUES (?, ?, ?)',
+                    ((archive_id, path, texts[adler32, size]) for path, adler32, size in entries
+                     if (adler32, size) in texts))  # Not the unreadable ones
+            self._remove_unused_texts()
+        if not self.silent and changed:
+            print('| Indexed {} archive(s), read {} file(s)'.format(len(changed), read))
+        return len(changed), read
+
+    def _remove(self, archive_id: int):
+        self.connection.execute('DELETE FROM entries WHERE archive_id = ?', (archive_id,))
+        self.connection.execute('DELETE FROM archives WHERE id = ?', (archive_id,))
+
+    def _remove_unused_texts(self):
+        unused = 'SELECT id FROM texts WHERE id NOT IN (SELECT text_id FROM entries)'
+        self.connection.execute(f'DELETE FROM trigrams WHERE text_id IN ({unused})')
+        self.connection.execute(f'DELETE FROM texts WHERE id IN ({unused})')
+
+    def search(self, regex, archives: list = None):
+        """
+        :param regex: Compiled regular expression, matched line by line
+        :param archives: Archive paths to search in (default: all the indexed ones)
+        :return: Iterator of (archive path, internal path, line number, line)
+        """
+        needed = set()
+        for literal in required_literals(regex.pattern, regex.flags):
+            needed |= trigrams(literal)
+        query = 'SELECT id, text FROM texts'
+        parameters = []
+        if needed:
+            query += ' WHERE id IN (SELECT text_id FROM trigrams WHERE trigram IN ({}) ' \
+                     'GROUP BY text_id HAVING COUNT(*) = ?)'.format(', '.join('?' * len(needed)))
+            parameters = list(needed) + [len(needed)]
+        matches = {}
+        for text_id, text in self.connection.execute(query, parameters):
+            lines = [(number, line) for number, line in enumerate(text.split('\n'), 1) if regex.search(line)]
+            if lines:
+                matches[text_id] = lines
+        if not matches:
+            return
+        paths = None if archives is None else {os.path.abspath(archive) for archive in archives}
+        files = []
+        text_ids = list(matches)
+        for start in range(0, len(text_ids), QUERY_SIZE):
+            chunk = text_ids[start:start + QUERY_SIZE]
+            files.extend(self.connection.execute(
+                'SELECT archives.path, entries.path, text_id FROM entries JOIN archives ON archives.id = archive_id '
+                'WHERE text_id IN ({})'.format(', '.join('?' * len(chunk))), chunk))
+        for archive, path, text_id in sorted(files):
+            if paths is None or archive in paths:
+                for number, line in matches[text_id]:
+                    yield archive, path, number, line
+
+
+def grep(regex, archives: list, workers: int = None, cypher: str = 'none', key: str = None):
+    """
+    Search the scripts of the archives without an index
+    :return: Iterator of (archive path, internal path, line number, line)
+    """
+    jobs = [(archive, [path for path, _, _ in script_entries(archive)]) for archive in archives]
+    for archive, path, text in read_texts(jobs, workers, cypher, key):
+        for number, line in enumerate(text.split('\n'), 1):
+            if regex.search(line):
+                yield archive, path, number, line
+
+
+def grep_main(argv: list):
+    import argparse
+    from .batch import expand_inputs
+    from .structs import encryption_parameters
+    parser = argparse.ArgumentParser(prog='xp3 grep',
+                                     description='Search the text of the scripts ({}) in archives, descrambled '
+                                                 'and decoded from UTF-16 or Shift-JIS'.format(', '.join(SCRIPT_EXTENSIONS)))
+    parser.add_argument('pattern', help='Regular expression, matched line by line')
+    parser.add_argument('archives', nargs='+', help='Archives, globs or folders with archives')
+    parser.add_argument('-i', '--ignore-case', action='store_true', default=False)
+    parser.add_argument('-F', '--fixed-strings', action='store_true', default=False,
+                        help='The pattern is a plain string')
+    parser.add_argument('-l', '--files-with-matches', action='store_true', default=False,
+                        help='Only list the files that match')
+    parser.add_argument('--index', default=None, metavar='DB',
+                        help='Trigram index to update with the archives and search in, '
+                             'only new texts are read and searches of indexed archives take milliseconds')
+    parser.add_argument('-c', '--cypher', choices=encryption_parameters.keys(), default='none',
+                        help='Encryption type (default: none)')
+    parser.add_argument('-k', '--key', help='Hex key of the hiddenb cypher (e.g. 5a17c3e809)')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='Number of processes reading the files (default: number of CPUs)')
+    parser.add_argument('-s', '--silent', action='store_true', default=False)
+    args = parser.parse_args(argv)
+
+    try:
+        archives = expand_inputs(args.archives)
+    except FileNotFoundError as error:
+        print("ERROR: {} dosn't exist or not accessible".format(error))
+        return 2
+    regex = re.compile(re.escape(args.pattern) if args.fixed_strings else args.pattern,
+                       re.IGNORECASE if args.ignore_case else 0)
+
+    if args.index:
+        with TextIndex(args.index, args.silent) as index:
+            index.update(archives, args.jobs, args.cypher, args.key)
+            matches = list(index.search(regex, archives))
+    else:
+        matches = grep(regex, archives, args.jobs, args.cypher, args.key)
+
+    found = False
+    listed = set()
+    for archive, path, number, line in matches:
+        found = True
+        if args.files_with_matches:
+            if (archive, path) not in listed:
+                listed.add((archive, path))
+                print('{}:{}'.format(archive, path))
+        else:
+            print('{}:{}:{}: {}'.format(archive, path, number, line))
+    return 0 if found else 1
@@ -0,0 +1,102 @@
+import os, bisect
+
+MODES = ('sequential', 'random', 'once')
+READAHEAD_SIZE = 16 << 20  # Bytes of the next planned files the OS is asked to read ahead
+# Access pattern of the whole archive given to the OS for each mode
+_FILE_ADVICE = {'sequential': 'POSIX_FADV_SEQUENTIAL', 'random': 'POSIX_FADV_RANDOM', 'once': 'POSIX_FADV_SEQUENTIAL'}
+
+
+def fadvise_available(buffer) -> bool:
+    """posix_fadvise() can be used with the buffer (a real file on a system that has it)"""
+    if not hasattr(os, 'posix_fadvise'):
+        return False
+    try:
+        buffer.fileno()
+    except (AttributeError, OSError, ValueError):
+        return False
+    return True
+
+
+def entry_ranges(entry) -> list:
+    """(offset, size) ranges of the data of an entry in the archive, adjacent segments merged"""
+    ranges = []
+    for segment in entry.segm:
+        if ranges and ranges[-1][0] + ranges[-1][1] == segment.offset:
+            ranges[-1][1] += segment.compressed_size
+        elif segment.compressed_size:
+            ranges.append([segment.offset, segment.compressed_size])
+    return [tuple(data_range) for data_range in ranges]
+
+
+class IOPolicy:
+    """
+    Hints to the page cache of the OS from the order the files of an archive are going to be read in:
+    - sequential: the next planned files are read ahead while a file is read
+    - random: only the data of the file being read is read ahead, the readahead of the OS is turned off
+    - once: like sequential, and the data of the files already read is dropped from the cache,
+            so a one pass extraction of a huge archive doesn't push everything else out of it
+    """
+
+    def __init__(self, fileno: int, mode: str, entries=(), readahead: int = READAHEAD_SIZE):
+        """
+        :param fileno: File descriptor of the archive
+        :param mode: One of MODES
+        :param entries: File entries in the order they are going to be read, see plan()
+        :param readahead: Bytes of the next planned files to read ahead
+        """
+        if mode not in MODES:
+            raise ValueError(f'Unknown I/O policy {mode}')
+        self.fileno = fileno
+        self.mode = mode
+        self.readahead = readahead
+        self.willneed_size = 0  # Bytes the OS was asked to read ahead
+        self.dontneed_size = 0  # Bytes the OS was told to drop
+        self._last = None
+        os.posix_fadvise(fileno, 0, 0, getattr(os, _FILE_ADVICE[mode]))
+        self.plan(entries)
+
+    def plan(self, entries):
+        """Set the order the files are going to be read in, the files that aren't planned are only read ahead when read"""
+        self.ranges = []
+        self.positions = {}
+        self.offsets = [0]  # Planned bytes before each file
+        for entry in entries:
+            ranges = entry_ranges(entry)
+            if ranges and ranges[0][0] not in self.positions:
+                self.positions[ranges[0][0]] = len(self.ranges)
+                self.ranges.append(ranges)
+                self.offsets.append(self.offsets[-1] + sum(size for _, size in ranges))
+        self._advised = 0  # Planned files up to this one were read ahead
+
+    def _advise(self, ranges, advice: str):
+        for offset, size in ranges:
+            os.posix_fadvise(self.fileno, offset, size, getattr(os, advice))
+            if advice == 'POSIX_FADV_WILLNEED':
+                self.willneed_size += size
+            else:
+                self.dontneed_size += size
+
+    def access(self, entry):
+        """Called before the data of a file is read"""
+        ranges = entry_ranges(entry)
+        if not ranges:
+            return
+        position = self.positions.get(ranges[0][0])
+        if self.mode == 'once' and self._last is not None and self._last != ranges:
+            self._advise(self._last, 'POSIX_FADV_DONTNEED')
+        self._last = ranges
+        if self.mode == 'random' or position is None:
+            self._advise(ranges, 'POSIX_FADV_WILLNEED')
+            return
+        # Keep the planned files up to readahead bytes after this one in flight
+        end = max(position + 1, bisect.bisect_left(self.offsets, self.offsets[position + 1] + self.readahead))
+        end = min(end, len(self.ranges))
+        for planned in self.ranges[max(position, self._advised):end]:
+            self._advise(planned, 'POSIX_FADV_WILLNEED')
+        self._advised = max(self._advised, end)
+
+    def close(self):
+        """Drop the data of the last file read in the once mode"""
+        if self.mode == 'once' and self._last is not None:
+            self._advise(self._last, 'POSIX_FADV_DONTNEED')
+            self._last = None
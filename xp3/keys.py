@@ -0,0 +1,156 @@
+import os, struct
+from .xp3 import XP3
+from .structs import codec
+from .structs.file import pread
+
+# Known first bytes of files by extension, several alternatives when the header varies
+UTF_16LE_BOM = b'\xff\xfe'
+KNOWN_HEADERS = {
+    '.png': (b'\x89PNG\r\n\x1a\n\x00\x00\x00\x0dIHDR',),
+    '.ogg': (b'OggS\x00\x02' + b'\x00' * 8,),
+    '.tlg': (b'TLG5.0\x00raw\x1a', b'TLG6.0\x00raw\x1a', b'TLG0.0\x00sds\x1a'),
+    # Plain UTF-16 scripts or scrambled ones (magic, mode, BOM)
+    '.ks': (UTF_16LE_BOM,) + tuple(b'\xfe\xfe' + bytes((mode,)) + UTF_16LE_BOM for mode in range(3)),
+}
+KNOWN_HEADERS['.tjs'] = KNOWN_HEADERS['.ks']
+RIFF_TYPES = {'.wav': b'WAVE', '.avi': b'AVI ', '.webp': b'WEBP'}
+HEADER_SIZE = 16
+HEADER_READ_SIZE = 4096
+
+
+def known_headers(file_path: str, size: int) -> tuple:
+    """Possible first bytes of a file by its extension, empty if they are unknown"""
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension in RIFF_TYPES:
+        return (b'RIFF' + struct.pack('<I', size - 8) + RIFF_TYPES[extension],)
+    return KNOWN_HEADERS.get(extension, ())
+
+
+def read_payload(file, size: int = None) -> bytes:
+    """
+    Read the stored data of a file without decrypting it or checking it
+    :param size: Only read the first size bytes of the first segment
+    """
+    data = b''
+    for segment in file.segm:
+        if size is None:
+            raw = pread(file.buffer, segment.offset, segment.compressed_size)
+            data += codec.decompress(raw) if segment.is_compressed else raw
+            continue
+        if segment.is_compressed:
+            raw = pread(file.buffer, segment.offset, min(segment.compressed_size, HEADER_READ_SIZE))
+            return codec.decompressobj().decompress(raw, size)
+        return pread(file.buffer, segment.offset, min(segment.compressed_size, size))
+    return data
+
+
+def key_votes(headers: list, length: int):
+    """
+    Votes for every byte of a repeating key of the length
+    :param headers: List of (stored first bytes, alternatives of the known first bytes) of the files
+    :return: (length, 256) array of votes, each file has one vote for every position it covers
+    """
+    import numpy
+    positions, values, weights = [], [], []
+    for stored, alternatives in headers:
+        stored = numpy.frombuffer(stored, dtype=numpy.uint8)
+        for plain in alternatives:
+            size = min(len(stored), len(plain))
+            positions.append(numpy.arange(size))
+            values.append(stored[:size] ^ numpy.frombuffer(plain, dtype=numpy.uint8, count=size))
+            weights.append(numpy.full(size, 1 / len(alternatives)))
+    if not positions:
+        return numpy.zeros((length, 256))
+    positions, values = numpy.concatenate(positions), numpy.concatenate(values).astype(numpy.intp)
+    votes = numpy.bincount((positions % length) * 256 + values, numpy.concatenate(weights), length * 256)
+    return votes.reshape(length, 256)
+
+
+def candidate_keys(headers: list, max_length: int = HEADER_SIZE) -> list:
+    """
+    Derive the repeating keys of every length from the known file headers,
+    lengths with key bytes no header covers and repetitions of shorter keys are left out
+    :return: List of (key, agreement) tuples with the best agreement first,
+             agreement is the share of the votes the chosen key bytes got
+    """
+    import numpy
+    candidates = []
+    for length in range(1, max_length + 1):
+        votes = key_votes(headers, length)
+        total = votes.sum(axis=1)
+        if not total.all():
+            continue
+        key = bytes(votes.argmax(axis=1).astype(numpy.uint8))
+        if any(key == shorter * (length // len(shorter)) for shorter, _ in candidates if length % len(shorter) == 0):
+            continue
+        candidates.append((key, float(votes.max(axis=1).sum() / total.sum())))
+    return sorted(candidates, key=lambda candidate: -candidate[1])
+
+
+def count_valid(key: bytes, samples: list) -> int:
+    """Number of the (stored data, adler32) samples whose checksum matches after XORing with the repeating key"""
+    import numpy
+    key = numpy.frombuffer(key, dtype=numpy.uint8)
+    valid = 0
+    for data, adler32 in samples:
+        data = numpy.frombuffer(data, dtype=numpy.uint8)
+        if codec.adler32((data ^ numpy.resize(key, len(data))).tobytes()) == adler32:
+            valid += 1
+    return valid
+
+
+def recover_key(archive: str, max_length: int = HEADER_SIZE, samples: int = 32, candidates: int = 8,
+                silent: bool = False) -> list:
+    """
+    Find the XOR key of a hiddenb (xor_bytes) archive from the known headers of its files (PNG, OGG, RIFF, scripts...)
+    :param max_length: Longest key length to try, longer keys can't be fully covered by the headers
+    :param samples: Number of files to check the candidate keys against (the smallest ones)
+    :param candidates: Number of the best candidate keys to check
+    :return: List of (key, files that passed the checksum, agreement) tuples, the best key first
+    """
+    with XP3(archive, 'r', silent=True) as xp3:
+        files = [xp3[index] for index in range(len(xp3.file_index.entries))]
+        files = [file for file in files if file.segm.segments and file.info.uncompressed_size]
+        headers = []
+        for file in files:
+            alternatives = known_headers(file.file_path, file.info.uncompressed_size)
+            if alternatives:
+                headers.append((read_payload(file, HEADER_SIZE), alternatives))
+        if not silent:
+            print('| {} of {} file(s) have known headers'.format(len(headers), len(files)))
+        keys = candidate_keys(headers, max_length)[:candidates]
+
+        files.sort(key=lambda file: file.info.uncompressed_size)
+        checked = [(read_payload(file), file.adler32) for file in files[:samples]]
+
+    results = [(key, count_valid(key, checked), agreement) for key, agreement in keys]
+    results.sort(key=lambda result: (-result[1], -result[2], len(result[0])))
+    return results
+
+
+def key_main(argv: list):
+    import argparse
+    from .structs.file import numpy_available
+    parser = argparse.ArgumentParser(prog='xp3 key', description='XOR keys of encrypted archives')
+    commands = parser.add_subparsers(dest='command', required=True)
+    parser_recover = commands.add_parser('recover', help='Find the -k key of a hiddenb archive from known file headers')
+    parser_recover.add_argument('archive', help='Encrypted archive')
+    parser_recover.add_argument('--max-length', type=int, default=HEADER_SIZE,
+                                help=f'Longest key length to try (default: {HEADER_SIZE})')
+    parser_recover.add_argument('--samples', type=int, default=32,
+                                help='Number of files to check the keys against (default: 32)')
+    parser_recover.add_argument('-n', '--candidates', type=int, default=8,
+                                help='Number of candidate keys to check and show (default: 8)')
+    parser_recover.add_argument('-s', '--silent', action='store_true', default=False)
+    args = parser.parse_args(argv)
+
+    if not numpy_available():
+        print('ERROR: numpy is not installed')
+        return 2
+    results = recover_key(args.archive, args.max_length, args.samples, args.candidates, args.silent)
+    if not results:
+        print('! No key candidates, none of the files have known headers')
+        return 1
+    for key, valid, agreement in results:
+        print('{}\t{} file(s) valid\t{:.0%} agreement'.format(key.hex(), valid, agreement))
+    return 0 if results[0][1] else 1
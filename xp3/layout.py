@@ -0,0 +1,92 @@
+import os, posixpath
+from .xp3 import XP3
+
+
+def read_trace(path: str) -> list:
+    """Read an access trace, one internal file path per line (empty lines and lines starting with # are skipped)"""
+    with open(path, encoding='utf-8') as trace:
+        return [line.strip() for line in trace if line.strip() and not line.startswith('#')]
+
+
+def write_trace(path: str, trace: list):
+    """Save an access trace recorded with XP3Reader.start_trace()"""
+    with open(path, 'w', encoding='utf-8') as output:
+        output.writelines(file_path + '\n' for file_path in trace)
+
+
+def seek_distance(file_index, trace: list) -> int:
+    """
+    Total distance in bytes the read position has to jump when the files are read in the order of the trace
+    (the distance between the end of one file and the start of the next one)
+    """
+    distance = 0
+    position = None
+    for file_path in trace:
+        if file_path not in file_index.path_index:
+            continue
+        segments = file_index[file_path].segm.segments
+        if not segments:
+            continue
+        start = segments[0].offset
+        if position is not None:
+            distance += abs(start - position)
+        position = segments[-1].offset + segments[-1].compressed_size
+    return distance
+
+
+def ordered_entries(file_index, trace: list) -> list:
+    """
+    Order the entries for the layout: traced files in order of their first access,
+    then the rest grouped by directory in order of appearance
+    """
+    entries = {entry.file_path: entry for entry in file_index}
+    ordered = []
+    for file_path in trace:
+        if file_path in entries:
+            ordered.append(entries.pop(file_path))
+
+    directories = {}
+    for entry in sorted(entries.values(), key=lambda entry: entry.segm[0].offset if entry.segm.segments else 0):
+        directories.setdefault(posixpath.dirname(entry.file_path), []).append(entry)
+    for directory in directories.values():
+        ordered.extend(directory)
+    return ordered
+
+
+def optimize_layout(archive: str, trace: list, output: str, silent: bool = False):
+    """
+    Rewrite the archive with the data laid out in order of the access trace, without recompressing it
+    :param archive: Path of the archive
+    :param trace: List of internal file paths in order of access
+    :param output: Path of the resulting archive
+    :param silent: Supress prints
+    :return: Seek distance before and after
+    """
+    if os.path.abspath(archive) == os.path.abspath(output):
+        raise ValueError('The output can not be the archive being reordered')
+    with XP3(archive, 'r', silent=True) as source:
+        before = seek_distance(source.file_index, trace)
+        with XP3(output, 'w', silent) as xp3:
+            for entry in ordered_entries(source.file_index, trace):
+                xp3.add_entry(entry, source.buffer)
+
+    with XP3(output, 'r', silent=True) as result:
+        after = seek_distance(result.file_index, trace)
+
+    if not silent:
+        print('Seek distance: {:.1f} MiB → {:.1f} MiB'.format(before / 2**20, after / 2**20))
+    return before, after
+
+
+def layout_main(argv: list):
+    import argparse
+    parser = argparse.ArgumentParser(prog='xp3 layout',
+                                     description='Reorder archive data by an access trace without recompressing')
+    parser.add_argument('archive', help='Archive to reorder')
+    parser.add_argument('-t', '--trace', required=True, help='Access trace, one internal file path per line')
+    parser.add_argument('-o', '--output', required=True, help='Output archive')
+    parser.add_argument('-s', '--silent', action='store_true', default=False)
+    args = parser.parse_args(argv)
+
+    optimize_layout(args.archive, read_trace(args.trace), args.output, args.silent)
+    return 0
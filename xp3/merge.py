@@ -0,0 +1,94 @@
+import os
+from .xp3 import XP3
+
+
+def same_file(path: str, other: str) -> bool:
+    """The paths are the same file (through links too)"""
+    if os.path.exists(path) and os.path.exists(other):
+        return os.path.samefile(path, other)
+    return os.path.abspath(path) == os.path.abspath(other)
+
+
+def merge(archives: list, output: str, silent: bool = False):
+    """
+    Merge several archives into one by copying the stored segments as is,
+    entries of later archives replace the ones with the same path in earlier archives
+    :param archives: Paths of the archives to merge, in order of precedence (last wins)
+    :param output: Path of the resulting archive
+    :param silent: Supress prints
+    """
+    if any(same_file(archive, output) for archive in archives):
+        raise ValueError('The output can not be one of the archives being merged')
+    count = _copy_entries(archives, output, silent)
+    if not silent:
+        print('Merged {} archive(s), {} file(s) → {}'.format(len(archives), count, output))
+    return count
+
+
+def rebuild(archive: str, output: str = None, silent: bool = False):
+    """
+    Rewrite an archive dropping unreferenced data and duplicate entries (last wins),
+    if no output is specified the archive is replaced
+    """
+    in_place = not output or same_file(output, archive)
+    if in_place:
+        output = archive + '.tmp'
+    try:
+        count = _copy_entries([archive], output, silent)
+        if in_place:
+            os.replace(output, archive)
+    finally:
+        if in_place and os.path.exists(output):
+            os.remove(output)
+
+    if not silent:
+        print('Rebuilt {}, {} file(s)'.format(archive, count))
+    return count
+
+
+def _copy_entries(archives: list, output: str, silent: bool = False):
+    readers = [XP3(archive, 'r', silent=True) for archive in archives]
+    try:
+        # Keep the position of the first occurrence and the data of the last one
+        entries = {}
+        for reader in readers:
+            for entry in reader.file_index:
+                entries[entry.file_path] = (entry, reader.buffer)
+
+        with XP3(output, 'w', silent) as xp3:
+            for entry, buffer in entries.values():
+                xp3.add_entry(entry, buffer)
+    finally:
+        for reader in readers:
+            reader.close()
+    return len(entries)
+
+
+def merge_main(argv: list):
+    import argparse
+    parser = argparse.ArgumentParser(prog='xp3 merge',
+                                     description='Merge archives without recompressing, later archives win')
+    parser.add_argument('archives', nargs='+', help='Archives to merge (e.g. data.xp3 patch.xp3 patch2.xp3)')
+    parser.add_argument('-o', '--output', required=True, help='Output archive')
+    parser.add_argument('-s', '--silent', action='store_true', default=False)
+    args = parser.parse_args(argv)
+
+    try:
+        merge(args.archives, args.output, args.silent)
+    except ValueError as error:
+        print('ERROR: {}'.format(error))
+        return 2
+    return 0
+
+
+def rebuild_main(argv: list):
+    import argparse
+    parser = argparse.ArgumentParser(prog='xp3 rebuild',
+                                     description='Rebuild an archive without recompressing, dropping dead data')
+    parser.add_argument('archive', help='Archive to rebuild')
+    parser.add_argument('-o', '--output', help='Output archive (default: replace the input)')
+    parser.add_argument('-s', '--silent', action='store_true', default=False)
+    args = parser.parse_args(argv)
+
+    rebuild(args.archive, args.output, args.silent)
+    return 0
@@ -0,0 +1,143 @@
+import os, re, hashlib, posixpath
+
+HASHED_NAME = re.compile('^[0-9a-fA-F]{32}$')
+HASHES_PER_TASK = 200000
+
+
+def path_hash(file_path: str) -> str:
+    """Name an encrypted archive stores instead of the file path: MD5 of the lower case path in UTF-16LE"""
+    return hashlib.md5(file_path.lower().encode('utf-16le')).hexdigest()
+
+
+def hashed_names(file_index) -> set:
+    """Paths in the file index that are hashes of unknown names"""
+    return {entry.file_path.lower() for entry in file_index if HASHED_NAME.match(entry.file_path)}
+
+
+def read_names(path: str) -> dict:
+    """Read a file of recovered names, one 'hash<TAB>path' pair per line"""
+    names = {}
+    with open(path, encoding='utf-8') as file:
+        for line in file:
+            if '\t' in line:
+                name_hash, file_path = line.rstrip('\r\n').split('\t', 1)
+                names[name_hash.lower()] = file_path
+    return names
+
+
+def write_names(path: str, names: dict):
+    with open(path, 'w', encoding='utf-8') as file:
+        file.writelines('{}\t{}\n'.format(name_hash, file_path) for name_hash, file_path in sorted(names.items()))
+
+
+def split_words(words) -> tuple:
+    """
+    Split candidate paths into directories, base names and extensions to combine
+    :return: (directories, base names, extensions) lists, directories end with / and include the root
+    """
+    directories, basenames, extensions = {''}, set(), {''}
+    for word in words:
+        directory, filename = posixpath.split(word.replace('\\', '/'))
+        if directory:
+            directories.add(directory + '/')
+        basename, extension = posixpath.splitext(filename)
+        if basename:
+            basenames.add(basename)
+        if extension:
+            extensions.add(extension)
+    return sorted(directories), sorted(basenames), sorted(extensions)
+
+
+_targets = None
+
+
+def _init_worker(targets):
+    global _targets
+    _targets = targets
+
+
+def _match(task: tuple) -> list:
+    """Hash every directory + base name + extension combination, returns the ones found in the targets"""
+    directories, basenames, extensions = task
+    encoded_extensions = [(extension, extension.lower().encode('utf-16le')) for extension in extensions]
+    matches = []
+    for directory in directories:
+        # Reuse the hash state of the common prefixes
+        directory_hash = hashlib.md5(directory.lower().encode('utf-16le'))
+        for basename in basenames:
+            basename_hash = directory_hash.copy()
+            basename_hash.update(basename.lower().encode('utf-16le'))
+            for extension, encoded in encoded_extensions:
+                name_hash = basename_hash.copy()
+                name_hash.update(encoded)
+                if name_hash.digest() in _targets:
+                    matches.append((name_hash.hexdigest(), directory + basename + extension))
+    return matches
+
+
+def recover(targets: set, words: list, combine: bool = True, workers: int = None) -> dict:
+    """
+    Find the paths that hash to the target names
+    :param targets: Hashed names to recover (hex)
+    :param words: Candidate paths (e.g. from a wordlist)
+    :param combine: Also try every directory x base name x extension combination of the candidates
+    :param workers: Number of processes to hash in (default: number of CPUs)
+    :return: Dictionary of recovered hash -> path
+    """
+    digests = frozenset(bytes.fromhex(name_hash) for name_hash in targets)
+    _init_worker(digests)
+    names = {name_hash: path for name_hash, path in _match(([''], list(dict.fromkeys(words)), ['']))}
+    if not combine:
+        return names
+
+    directories, basenames, extensions = split_words(words)
+    step = max(1, HASHES_PER_TASK // (len(directories) * len(extensions)))
+    tasks = [(directories, basenames[start:start + step], extensions) for start in range(0, len(basenames), step)]
+    if len(tasks) == 1:
+        results = [_match(tasks[0])]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(digests,)) as executor:
+            results = executor.map(_match, tasks)
+    for matches in results:
+        for name_hash, path in matches:
+            names.setdefault(name_hash, path)
+    return names
+
+
+def names_main(argv: list):
+    import argparse, time
+    from .xp3 import XP3
+    parser = argparse.ArgumentParser(prog='xp3 names', description='Hashed file names of encrypted archives')
+    commands = parser.add_subparsers(dest='command', required=True)
+    parser_recover = commands.add_parser('recover', help='Find the real names of hashed files from wordlists')
+    parser_recover.add_argument('archive', help='Archive with hashed names')
+    parser_recover.add_argument('-w', '--wordlist', action='append', required=True,
+                                help='File with candidate paths, one per line (can be repeated)')
+    parser_recover.add_argument('-o', '--output',
+                                help='File to save the names to, they are added to it if it exists (default: archive.names)')
+    parser_recover.add_argument('--no-combine', action='store_true', default=False,
+                                help="Only try the paths as they are, don't combine their directories, names and extensions")
+    parser_recover.add_argument('-j', '--jobs', type=int, default=None, help='Number of processes (default: number of CPUs)')
+    parser_recover.add_argument('-s', '--silent', action='store_true', default=False)
+    args = parser.parse_args(argv)
+
+    with XP3(args.archive, 'r', silent=True) as xp3:
+        targets = hashed_names(xp3.file_index)
+    output = args.output or os.path.splitext(args.archive)[0] + '.names'
+    names = read_names(output) if os.path.isfile(output) else {}
+    targets -= set(names)
+
+    words = []
+    for wordlist in args.wordlist:
+        with open(wordlist, encoding='utf-8', errors='replace') as file:
+            words.extend(line.strip() for line in file if line.strip())
+
+    start = time.perf_counter()
+    recovered = recover(targets, words, not args.no_combine, args.jobs)
+    names.update(recovered)
+    write_names(output, names)
+    if not args.silent:
+        print('Recovered {} of {} hashed name(s) in {:.1f}s → {}'.format(
+            len(recovered), len(targets), time.perf_counter() - start, output))
+    return 0
@@ -0,0 +1,163 @@
+import io, posixpath, threading
+from collections import OrderedDict
+
+BLOCK_SIZE = 1 << 16  # 64 KiB
+READAHEAD_BLOCKS = 4  # Blocks fetched after the requested ones when reading sequentially and on the first read
+MERGE_GAP_BLOCKS = 2  # Missing blocks with up to this many cached blocks between them are fetched in one request
+CACHE_SIZE = 32 << 20  # 32 MiB
+
+
+def is_url(path) -> bool:
+    return isinstance(path, str) and path.startswith(('http://', 'https://'))
+
+
+class HTTPRangeFile(io.RawIOBase):
+    """
+    Read-only file object over an HTTP(S) URL, reads are served from a cache of aligned blocks
+    that are fetched with Range requests, so only the parts of a remote archive that are used get downloaded.
+    pread() is safe to call from several threads
+    """
+
+    def __init__(self, url: str, block_size: int = BLOCK_SIZE, readahead: int = READAHEAD_BLOCKS,
+                 cache_size: int = CACHE_SIZE, timeout: float = 30):
+        """
+        :param url: HTTP or HTTPS URL of the file, the server must support Range requests
+        :param block_size: Size of the cached blocks
+        :param readahead: Number of blocks to fetch after the requested ones when reading sequentially
+        :param cache_size: Size in bytes to keep the least recently used blocks under
+        :param timeout: Timeout of the requests in seconds
+        """
+        from urllib.parse import urlparse
+        self.url = url
+        self.name = posixpath.basename(urlparse(url).path)
+        self.block_size = block_size
+        self.readahead = readahead
+        self.max_blocks = max(1, cache_size // block_size)
+        self.timeout = timeout
+        self.blocks = OrderedDict()
+        self.position = 0
+        self.requests = 0
+        self.bytes_fetched = 0
+        self.size = None
+        self._next_block = None
+        self._lock = threading.Lock()
+        # The first request gets the header and the size of the file
+        self._fetch(0, readahead)
+        if self.size is None:  # The server may leave the total out of Content-Range (bytes 0-1023/*)
+            self.size = self._head_size()
+
+    def _request(self, start: int, end: int) -> bytes:
+        from urllib.request import Request, urlopen  # Imports http.client and ssl, only load them when used
+        request = Request(self.url, headers={'Range': 'bytes={}-{}'.format(start, end - 1)})
+        with urlopen(request, timeout=self.timeout) as response:
+            if response.status != 206:
+                raise OSError(f"{self.url} doesn't support range requests")
+            total = response.headers.get('Content-Range', '').rpartition('/')[2]
+            if total.isdigit():
+                self.size = int(total)
+            data = response.read()
+        self.requests += 1
+        self.bytes_fetched += len(data)
+        return data
+
+    def _head_size(self) -> int:
+        """Size of the file from the Content-Length of a HEAD request"""
+        from urllib.request import Request, urlopen
+        with urlopen(Request(self.url, method='HEAD'), timeout=self.timeout) as response:
+            length = response.headers.get('Content-Length', '')
+        self.requests += 1
+        if not length.isdigit():
+            raise OSError(f"The size of {self.url} is unknown, the server didn't send it")
+        return int(length)
+
+    def _fetch(self, first: int, last: int) -> dict:
+        """Fetch the blocks from first to last in one request, returns them by index"""
+        end = (last + 1) * self.block_size
+        if self.size is not None:
+            end = min(end, self.size)
+        data = self._request(first * self.block_size, end)
+        fetched = {}
+        for index in range(first, last + 1):
+            block = data[(index - first) * self.block_size:(index - first + 1) * self.block_size]
+            if not block:
+                break
+            fetched[index] = self.blocks[index] = block
+            self.blocks.move_to_end(index)
+        while len(self.blocks) > self.max_blocks:
+            self.blocks.popitem(last=False)
+        return fetched
+
+    def _load(self, blocks: list, readahead: int = 0) -> dict:
+        """
+        Fetch the missing blocks, nearby ones in one request, the last request also gets the readahead blocks
+        :return: The fetched blocks by index, as they may not all fit into the cache
+        """
+        last_block = (self.size - 1) // self.block_size
+        missing = [index for index in blocks if index not in self.blocks]
+        fetched = {}
+        if not missing:
+            return fetched
+        runs = [[missing[0], missing[0]]]
+        for index in missing[1:]:
+            if index - runs[-1][1] <= MERGE_GAP_BLOCKS + 1:
+                runs[-1][1] = index
+            else:
+                runs.append([index, index])
+        # Near the end of the file, where the file index is, get the rest of it
+        runs[-1][1] = last_block if last_block - runs[-1][1] <= self.readahead else runs[-1][1] + readahead
+        for first, last in runs:
+            fetched.update(self._fetch(first, min(last, last_block)))
+        return fetched
+
+    def pread(self, offset: int, size: int) -> bytes:
+        """Read size bytes at offset, independent of the position of the file"""
+        with self._lock:
+            end = min(offset + size, self.size)
+            if end <= offset:
+                return b''
+            first, last = offset // self.block_size, (end - 1) // self.block_size
+            if last - first >= self.max_blocks:  # Doesn't fit into the cache
+                return self._request(offset, end)
+            # Hold on to the cached blocks, fetching the others can evict them
+            blocks = {index: self.blocks[index] for index in range(first, last + 1) if index in self.blocks}
+            for index in blocks:
+                self.blocks.move_to_end(index)
+            blocks.update(self._load(list(range(first, last + 1)), self.readahead if first == self._next_block else 0))
+            self._next_block = last + 1
+            data = b''.join(blocks[index] for index in range(first, last + 1))
+        start = offset - first * self.block_size
+        return data[start:start + end - offset]
+
+    def prefetch(self, ranges):
+        """Fetch the blocks of several (offset, size) ranges in as few requests as possible"""
+        with self._lock:
+            blocks = sorted({index for offset, size in ranges if size > 0 and offset < self.size
+                             for index in range(offset // self.block_size,
+                                                (min(offset + size, self.size) - 1) // self.block_size + 1)})
+            if blocks:
+                self._load(blocks)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.pread(self.position, len(buffer))
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError('negative seek position {}'.format(offset))
+        self.position = offset
+        return offset
+
+    def tell(self) -> int:
+        return self.position
@@ -0,0 +1,159 @@
+import os, io, time, struct, hashlib, multiprocessing
+from multiprocessing import shared_memory
+
+DEFAULT_SIZE = 256 << 20  # 256 MiB
+DEFAULT_SLOTS = 1 << 14
+PROBE_SLOTS = 8  # A key can only be in one of the 8 slots after the one its digest points to
+PENDING_TIMEOUT = 30  # Seconds after which a file that is still being read by another process is read again
+HEADER = struct.Struct('<3Q')  # Bytes ever written to the arena, hits, loads
+SLOT = struct.Struct('<16sB7xQQd')  # Key digest, state, position in the arena (not wrapped), size, last use
+EMPTY, PENDING, READY = 0, 1, 2
+
+
+def archive_identity(buffer):
+    """Identity of an archive to key the cache with, None for archives in memory"""
+    url = getattr(buffer, 'url', None)
+    if url:
+        return url, buffer.size
+    try:
+        stat = os.fstat(buffer.fileno())
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None
+    return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+class SharedCache:
+    """
+    Read files shared by processes through shared memory, so a file read by several workers is decompressed
+    and decrypted once. The data is written one after another into a circular arena, an entry is valid
+    as long as it hasn't been written over. The slot table and the arena are guarded by one lock.
+    Create it in the parent process and give it to the workers on start (e.g. in the initargs of a pool)
+    """
+
+    def __init__(self, size: int = DEFAULT_SIZE, slots: int = DEFAULT_SLOTS, lock=None):
+        """
+        :param size: Size of the arena in bytes, files larger than a quarter of it aren't cached
+        :param slots: Number of entries in the slot table
+        :param lock: Lock shared by the processes (default: a new multiprocessing.Lock)
+        """
+        self.size = size
+        self.slots = slots
+        self.lock = lock or multiprocessing.Lock()
+        self.memory = shared_memory.SharedMemory(create=True, size=HEADER.size + slots * SLOT.size + size)
+        self._owner = os.getpid()
+
+    def __getstate__(self):
+        return {'name': self.memory.name, 'size': self.size, 'slots': self.slots, 'lock': self.lock}
+
+    def __setstate__(self, state):
+        self.size = state['size']
+        self.slots = state['slots']
+        self.lock = state['lock']
+        self.memory = shared_memory.SharedMemory(state['name'])
+        self._owner = None
+
+    def close(self):
+        """Detach from the shared memory, the process that created the cache also frees it"""
+        self.memory.close()
+        if self._owner == os.getpid():
+            self.memory.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def hits(self) -> int:
+        return HEADER.unpack_from(self.memory.buf)[1]
+
+    @property
+    def loads(self) -> int:
+        """Number of files read by the processes themselves"""
+        return HEADER.unpack_from(self.memory.buf)[2]
+
+    def get_or_load(self, key, load):
+        """
+        Data of the key from the cache, or from load() which is called in one process at a time for a key,
+        the others wait for its result
+        :param key: Tuple identifying the data (archive identity, segment, cypher...)
+        :param load: Function returning the data, None is returned as is and not cached
+        """
+        digest = hashlib.blake2b(repr(key).encode('utf-8'), digest_size=16).digest()
+        while True:
+            with self.lock:
+                index, state, position, size, used = self._find(digest)
+                if state == READY:
+                    offset = HEADER.size + self.slots * SLOT.size + position % self.size
+                    data = bytes(self.memory.buf[offset:offset + size])
+                    SLOT.pack_into(self.memory.buf, index * SLOT.size + HEADER.size,
+                                   digest, READY, position, size, time.time())
+                    self._count(hits=1)
+                    return data
+                if state != PENDING:
+                    if index is not None:  # Tell the other processes this one is reading it
+                        SLOT.pack_into(self.memory.buf, index * SLOT.size + HEADER.size,
+                                       digest, PENDING, 0, 0, time.time())
+                    break
+            time.sleep(0.001)
+
+        try:
+            data = load()
+        except BaseException:
+            with self.lock:
+                self._release(digest)
+            raise
+        with self.lock:
+            self._count(loads=1)
+            if data is None or len(data) > self.size // 4:
+                self._release(digest)
+            else:
+                self._store(digest, data)
+        return data
+
+    def _count(self, hits: int = 0, loads: int = 0):
+        head, all_hits, all_loads = HEADER.unpack_from(self.memory.buf)
+        HEADER.pack_into(self.memory.buf, 0, head, all_hits + hits, all_loads + loads)
+
+    def _find(self, digest: bytes) -> tuple:
+        """
+        Look for the key in its slots, expired entries count as empty
+        :return: (slot index, state, position, size, last use) of the key or of the slot to put it into
+                 with the EMPTY state, the index is None if all its slots are being read
+        """
+        head = HEADER.unpack_from(self.memory.buf)[0]
+        now = time.time()
+        start = int.from_bytes(digest[:8], 'little') % self.slots
+        victim = victim_rank = None
+        for probe in range(PROBE_SLOTS):
+            index = (start + probe) % self.slots
+            slot_digest, state, position, size, used = SLOT.unpack_from(self.memory.buf, index * SLOT.size + HEADER.size)
+            if state == READY and head - position > self.size \
+                    or state == PENDING and now - used > PENDING_TIMEOUT:
+                state = EMPTY
+            if state != EMPTY and slot_digest == digest:
+                return index, state, position, size, used
+            if state != PENDING:
+                # Empty slots first, then the least recently used entry
+                rank = (state != EMPTY, used)
+                if victim is None or rank < victim_rank:
+                    victim, victim_rank = index, rank
+        return victim, EMPTY, 0, 0, 0
+
+    def _store(self, digest: bytes, data):
+        index = self._find(digest)[0]
+        if index is None:
+            return
+        head, hits, loads = HEADER.unpack_from(self.memory.buf)
+        # Entries don't wrap around the end of the arena
+        position = head if head % self.size + len(data) <= self.size else head + self.size - head % self.size
+        offset = HEADER.size + self.slots * SLOT.size + position % self.size
+        self.memory.buf[offset:offset + len(data)] = data
+        HEADER.pack_into(self.memory.buf, 0, position + len(data), hits, loads)
+        SLOT.pack_into(self.memory.buf, index * SLOT.size + HEADER.size, digest, READY, position, len(data), time.time())
+
+    def _release(self, digest: bytes):
+        index, state = self._find(digest)[:2]
+        if state == PENDING:
+            SLOT.pack_into(self.memory.buf, index * SLOT.size + HEADER.size, bytes(16), EMPTY, 0, 0, 0)
@@ -3,4 +3,12 @@ from .file import XP3File
 from .file_index import XP3FileIndex
 from .file_entry import XP3FileEntry, XP3FileEncryption, XP3FileTime, XP3FileAdler, XP3FileSegments, XP3FileInfo
 from .encryption_parameters import encryption_parameters
-from .scrambling import KSScrambling
+from . import codec
+
+
+def __getattr__(name):
+    # Imported on first use, only scripts need it
+    if name == 'KSScrambling':
+        from .scrambling import KSScrambling
+        return KSScrambling
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,134 @@
+"""
+Deflate backend used for all zlib streams in the archive.
+Every backend produces and reads standard zlib streams, the faster ones are only used if installed:
+    zlib     - standard library
+    zlib-ng  - zlib-ng bindings (pip install zlib-ng)
+    isal     - Intel ISA-L bindings (pip install isal), compresses at level 3 at most
+"""
+import zlib
+
+BACKENDS = ('zlib', 'zlib-ng', 'isal')
+ISAL_MAX_LEVEL = 3
+ISAL_DEFAULT_LEVEL = 2
+ADLER_BASE = 65521
+
+_deflate = None  # Module used for compression, picked on first use
+_inflate = None  # Module used for decompression and checksums
+
+
+def load_backend(name: str):
+    """Import a backend module by name, raises ImportError if it is not installed"""
+    if name == 'zlib':
+        return zlib
+    elif name == 'zlib-ng':
+        from zlib_ng import zlib_ng
+        return zlib_ng
+    elif name == 'isal':
+        from isal import isal_zlib
+        return isal_zlib
+    raise ValueError(f'Unknown deflate backend {name}')
+
+
+def available_backends() -> list:
+    backends = []
+    for name in BACKENDS:
+        try:
+            load_backend(name)
+            backends.append(name)
+        except ImportError:
+            pass
+    return backends
+
+
+def __getattr__(name: str):
+    """
+    codec.error: tuple of the exceptions the installed backends raise for broken streams (zlib.error, IsalError...),
+    built on first use so the backends aren't imported with the package
+    """
+    if name == 'error':
+        global error
+        error = tuple(dict.fromkeys(load_backend(backend).error for backend in available_backends()))
+        return error
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def _first_available(names):
+    for name in names:
+        try:
+            return load_backend(name)
+        except ImportError:
+            pass
+    return zlib
+
+
+def set_backend(name: str = 'auto'):
+    """
+    Select the deflate backend, 'auto' uses the fastest installed one:
+    isal or zlib-ng to decompress and zlib-ng to compress (isal would lower the compression level)
+    """
+    global _deflate, _inflate
+    if name == 'auto':
+        _inflate = _first_available(('isal', 'zlib-ng'))
+        _deflate = _first_available(('zlib-ng',))
+    else:
+        _deflate = _inflate = load_backend(name)
+
+
+def backend_names() -> tuple:
+    """Names of the backends in use for compression and decompression"""
+    if _deflate is None:
+        set_backend()
+    names = {load_backend(name): name for name in available_backends()}
+    return names[_deflate], names[_inflate]
+
+
+def _level(level: int) -> int:
+    if _deflate.__name__ == 'isal.isal_zlib':
+        return ISAL_DEFAULT_LEVEL if level < 0 else min(level, ISAL_MAX_LEVEL)
+    return level
+
+
+def compress(data, level: int = zlib.Z_DEFAULT_COMPRESSION) -> bytes:
+    if _deflate is None:
+        set_backend()
+    return _deflate.compress(data, _level(level))
+
+
+def compressobj(level: int = zlib.Z_DEFAULT_COMPRESSION, method: int = zlib.DEFLATED, wbits: int = zlib.MAX_WBITS,
+                memLevel: int = zlib.DEF_MEM_LEVEL, strategy: int = zlib.Z_DEFAULT_STRATEGY):
+    if _deflate is None:
+        set_backend()
+    if _deflate.__name__ == 'isal.isal_zlib':
+        strategy = zlib.Z_DEFAULT_STRATEGY  # the only one isal supports
+    return _deflate.compressobj(_level(level), method, wbits, memLevel, strategy)
+
+
+def decompress(data, size: int = None) -> bytes:
+    """:param size: Expected size of the result, the output buffer is allocated once if given"""
+    if _inflate is None:
+        set_backend()
+    if size:
+        return _inflate.decompress(data, zlib.MAX_WBITS, size)
+    return _inflate.decompress(data)
+
+
+def decompressobj():
+    if _inflate is None:
+        set_backend()
+    return _inflate.decompressobj()
+
+
+def adler32(data, value: int = 1) -> int:
+    if _inflate is None:
+        set_backend()
+    return _inflate.adler32(data, value)
+
+
+def adler32_combine(adler1: int, adler2: int, length2: int) -> int:
+    """Checksum of two pieces of data joined together from their checksums and the length of the second one"""
+    remainder = length2 % ADLER_BASE
+    sum1 = adler1 & 0xFFFF
+    sum2 = remainder * sum1 % ADLER_BASE
+    sum1 = (sum1 + (adler2 & 0xFFFF) + ADLER_BASE - 1) % ADLER_BASE
+    sum2 = (sum2 + (adler1 >> 16) + (adler2 >> 16) + ADLER_BASE - remainder) % ADLER_BASE
+    return sum2 << 16 | sum1
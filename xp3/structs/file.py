@@ -1,26 +1,89 @@
-import os, zlib
+import os, threading, weakref
 from io import BytesIO
 from array import array
 from .encryption_parameters import encryption_parameters
 from .file_entry import XP3FileEntry
-try:
-    from numpy import frombuffer, uint8, bitwise_and, bitwise_xor, right_shift, concatenate, dtype, fromstring, uint64, uint32, uint16, ubyte
-    import math
-    numpy = True
-except ModuleNotFoundError:
-    numpy = False
-    
-EXTRACT_INVALID = False
+from .codec import decompress, decompressobj, adler32, adler32_combine
+
+numpy = None  # Numpy is imported on first use, it takes longer to import than the rest of the package
 
-from .scrambling import KSScrambling
+def numpy_available() -> bool:
+    global numpy
+    if numpy is None:
+        from importlib.util import find_spec
+        numpy = find_spec('numpy') is not None
+    return numpy
+
+EXTRACT_INVALID = False
+STREAM_CHUNK_SIZE = 1 << 20
+XOR_BLOCK_SIZE = 1 << 16
+PARALLEL_MIN_SIZE = 1 << 24  # Files of several segments from 16 MiB are decoded in parallel
+PARALLEL_WORKERS = None  # Threads to decode them with (default: number of CPUs)
+SCRIPT_EXTENSIONS = ['.ks', '.tjs', '.wks', '.wtjs']
 
 class XP3DecryptionError(Exception):
     pass
 
+class XP3ChecksumError(Exception):
+    """The data of a file read in chunks doesn't match its checksum, raised after the last chunk"""
+    pass
+
+_locks = weakref.WeakKeyDictionary()
+_locks_lock = threading.Lock()
+
+def _buffer_lock(buffer):
+    with _locks_lock:
+        try:
+            return _locks.setdefault(buffer, threading.Lock())
+        except TypeError:  # Can't be weakly referenced, share one lock
+            return _locks_lock
+
+def pread(buffer, offset: int, size: int) -> bytes:
+    """
+    Read size bytes at offset without depending on the position of the buffer,
+    so several threads can read from one buffer at once.
+    Uses the pread() of the buffer if it has one, os.pread() for files where available,
+    and seek() and read() under a lock for each buffer otherwise
+    """
+    if hasattr(buffer, 'pread'):
+        return buffer.pread(offset, size)
+    if isinstance(buffer, BytesIO):
+        with buffer.getbuffer() as view:
+            return bytes(view[offset:offset + size])
+    if hasattr(os, 'pread'):
+        try:
+            fileno = buffer.fileno()
+        except (AttributeError, OSError):
+            pass
+        else:
+            chunks = []
+            while size:
+                chunk = os.pread(fileno, size, offset)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                offset += len(chunk)
+                size -= len(chunk)
+            return b''.join(chunks)
+    with _buffer_lock(buffer):
+        buffer.seek(offset)
+        return buffer.read(size)
+
 class XP3File(XP3FileEntry):
     """Wrapper around file entry with buffer access to be able to read the file"""
 
-    def __init__(self, index_entry: XP3FileEntry, buffer, silent, use_numpy):
+    def __init__(self, index_entry: XP3FileEntry, buffer, silent, use_numpy, file_path: str = None,
+                 cache=None, archive_id=None, io_policy=None):
+        """
+        :param file_path: Real path of a file stored under a hashed name
+        :param cache: sharedcache.SharedCache to share the read data with other processes
+        :param archive_id: Identity of the archive in the cache, see sharedcache.archive_identity()
+        :param io_policy: iopolicy.IOPolicy told before the data is read
+        """
+        self.real_path = file_path
+        self.cache = cache
+        self.archive_id = archive_id
+        self.io_policy = io_policy
         super(XP3File, self).__init__(
             encryption=index_entry.encryption,
             time=index_entry.time,
@@ -33,42 +96,52 @@ class XP3File(XP3FileEntry):
         self.use_numpy = use_numpy
 
 
+    @property
+    def file_path(self):
+        return self.real_path or super().file_path
+
     def read(self, encryption_type='none', raw=False):
-        """Reads the file from buffer and return it's data"""
+        """
+        Reads the file from buffer and return it's data (a bytearray if it was decrypted or read in parallel),
+        large files of several segments are decoded by PARALLEL_WORKERS threads
+        """
+        if self.cache is not None and self.archive_id is not None:
+            key = (self.archive_id, self.segm.segments[0].offset if self.segm.segments else 0, self.info.uncompressed_size,
+                   self.adler32, encryption_type, encryption_parameters.get(encryption_type), raw)
+            return self.cache.get_or_load(key, lambda: self._read(encryption_type, raw))
+        return self._read(encryption_type, raw)
 
+    def _read(self, encryption_type, raw):
         if self.file_path == '' or 'This is a protected archive' in self.file_path:
             if not self.silent:
                 print('! Not a file')
             return None
         
-        all_data = b''
-        for segment in self.segm:
-            self.buffer.seek(segment.offset)
-            data = self.buffer.read(segment.compressed_size)
-
-            if segment.is_compressed:
-                data = zlib.decompress(data)
-            if len(data) != segment.uncompressed_size:
-                raise AssertionError(len(data), segment.uncompressed_size)
-
-            if self.is_encrypted or ("hidden" in encryption_parameters[encryption_type][0]):
-                file_buffer = BytesIO(data)
-                if encryption_type in ('none', None) and not raw:
-                    raise XP3DecryptionError('File is encrypted and no encryption type was specified')
-                self.xor(file_buffer, self.adler32, encryption_type, self.use_numpy)
-                data = file_buffer.getvalue()
-                file_buffer.close()
-
-            all_data += data
+        if self.io_policy:
+            self.io_policy.access(self)
+        workers = PARALLEL_WORKERS or os.cpu_count() or 1
+        if len(self.segm.segments) > 1 and workers > 1 and self.segm.uncompressed_size >= PARALLEL_MIN_SIZE:
+            all_data, checksum = self._read_parallel(encryption_type, raw, workers)
+        else:
+            segments = []
+            position = 0
+            for segment in self.segm:
+                data = self._decode_segment(segment, position, encryption_type, raw)
+                segments.append(data)
+                position += len(data)
+            # Most files have a single segment, don't copy it
+            all_data = segments[0] if len(segments) == 1 else b''.join(segments)
+            del segments
+            checksum = adler32(all_data) if self.adler32 else 0
 
         if self.adler32:
-            checksum = zlib.adler32(all_data)
             if checksum != self.adler32:
                 if not self.silent:
                     print(f'! Checksum error. Expected {hex(self.adler32)} got {hex(checksum)}')
                 return all_data if EXTRACT_INVALID else None
 
-        if os.path.splitext(self.file_path)[1] in ['.ks', '.tjs', '.wks', '.wtjs']:
+        if self.is_script:
+            from .scrambling import KSScrambling
             with KSScrambling(all_data) as scrambled:
                 udata = scrambled.decode()
                 if udata is None or udata == b'':
@@ -80,6 +153,122 @@ class XP3File(XP3FileEntry):
 
         return all_data
 
+    def _decode_segment(self, segment, position, encryption_type, raw):
+        """Read, decompress and decrypt one segment, position is where it starts in the file"""
+        data = pread(self.buffer, segment.offset, segment.compressed_size)
+
+        if segment.is_compressed:
+            data = decompress(data, segment.uncompressed_size)
+        if len(data) != segment.uncompressed_size:
+            raise AssertionError(len(data), segment.uncompressed_size)
+
+        if self._needs_xor(encryption_type, raw):
+            data = bytearray(data)
+            xor_data(data, self.adler32, encryption_type, self.use_numpy, offset=position)
+        return data
+
+    def _read_parallel(self, encryption_type, raw, workers):
+        """
+        Decode the segments in a thread pool into their places in one buffer,
+        zlib releases the GIL while decompressing and checksumming
+        :return: (data, adler32 of the data)
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        positions = [0]
+        for segment in self.segm.segments[:-1]:
+            positions.append(positions[-1] + segment.uncompressed_size)
+        output = bytearray(self.segm.uncompressed_size)
+
+        def decode(segment, position):
+            data = self._decode_segment(segment, position, encryption_type, raw)
+            output[position:position + len(data)] = data
+            return adler32(data) if self.adler32 else 0
+
+        with ThreadPoolExecutor(min(workers, len(positions))) as executor:
+            checksums = list(executor.map(decode, self.segm.segments, positions))
+        checksum = checksums[0]
+        for segment, segment_checksum in zip(self.segm.segments[1:], checksums[1:]):
+            checksum = adler32_combine(checksum, segment_checksum, segment.uncompressed_size)
+        return output, checksum
+
+    def stream(self, encryption_type='none', raw=False, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Reads the file in chunks of up to chunk_size bytes instead of all at once,
+        scripts are still read whole to be descrambled.
+        The checksum can only be verified after the last chunk, XP3ChecksumError is raised then if it doesn't match
+        (unless EXTRACT_INVALID is set, like read() returns None), the chunks already read must be discarded
+        :return: Iterator over the chunks of data
+        """
+        if self.file_path == '' or 'This is a protected archive' in self.file_path:
+            if not self.silent:
+                print('! Not a file')
+            return iter(())
+        if self.is_script:
+            data = self.read(encryption_type=encryption_type, raw=raw)
+            return iter(() if data is None else (data,))
+        # Check before the first chunk is requested
+        self._needs_xor(encryption_type, raw)
+        if self.io_policy:
+            self.io_policy.access(self)
+        return self._stream(encryption_type, raw, chunk_size)
+
+    def _stream(self, encryption_type, raw, chunk_size):
+        checksum = adler32(b'')
+        position = 0
+        for segment in self.segm:
+            for data in self._read_segment(segment, chunk_size):
+                if self._needs_xor(encryption_type, raw):
+                    data = bytearray(data)
+                    xor_data(data, self.adler32, encryption_type, self.use_numpy, offset=position)
+                checksum = adler32(data, checksum)
+                position += len(data)
+                yield data
+
+        if self.adler32 and checksum != self.adler32:
+            if not self.silent:
+                print(f'! Checksum error. Expected {hex(self.adler32)} got {hex(checksum)}')
+            if not EXTRACT_INVALID:
+                raise XP3ChecksumError(f'{self.file_path}: expected {hex(self.adler32)} got {hex(checksum)}')
+
+    def _read_segment(self, segment, chunk_size):
+        """Reads and decompresses a segment in chunks"""
+        decompressor = decompressobj() if segment.is_compressed else None
+        position, remaining, size = segment.offset, segment.compressed_size, 0
+        while remaining:
+            data = pread(self.buffer, position, min(remaining, chunk_size))
+            if not data:
+                raise AssertionError(f'Unexpected end of archive at {position}')
+            position += len(data)
+            remaining -= len(data)
+            if decompressor:
+                while data:
+                    chunk = decompressor.decompress(data, chunk_size)
+                    data = decompressor.unconsumed_tail
+                    size += len(chunk)
+                    if chunk:
+                        yield chunk
+            else:
+                size += len(data)
+                yield data
+        if decompressor:
+            chunk = decompressor.flush()
+            size += len(chunk)
+            if chunk:
+                yield chunk
+        if size != segment.uncompressed_size:
+            raise AssertionError(size, segment.uncompressed_size)
+
+    def _needs_xor(self, encryption_type, raw):
+        if self.is_encrypted or ("hidden" in encryption_parameters[encryption_type][0]):
+            if encryption_type in ('none', None) and not raw:
+                raise XP3DecryptionError('File is encrypted and no encryption type was specified')
+            return True
+        return False
+
+    @property
+    def is_script(self):
+        return os.path.splitext(self.file_path)[1] in SCRIPT_EXTENSIONS
+
     def extract(self, to='', name=None, encryption_type='none', raw=False):
         """
         Reads the data and saves the file to specified folder,
@@ -104,85 +293,97 @@ class XP3File(XP3FileEntry):
             output.write(file)
 
     @staticmethod
-    def xor(output_buffer, adler32: int, encryption_type: str, use_numpy: bool = False):
-        """XOR the data, uses numpy if available"""
-        enc_type, master_key, secondary_key, _ = encryption_parameters[encryption_type]
-        # Read the encrypted data from buffer
+    def xor(output_buffer, adler32: int, encryption_type: str, use_numpy: bool = False, offset: int = 0):
+        """
+        XOR the data in the buffer, see xor_data()
+        :param offset: Position of the data in the file, for the cyphers that depend on it
+        """
         output_buffer.seek(0)
-        data = output_buffer.read()
-
-        # Use numpy if available
-        if numpy and use_numpy and ("xor_full" in enc_type or "xor_plain" in enc_type or "xor_bytes" in enc_type) and not ("shr3" in enc_type or "xor-mix" in enc_type):
-            key = None
-            dt = dtype(uint8)
-            if "xor_full" in enc_type:
-                master_key = int.from_bytes(master_key) if master_key else 0
-                adler_key = bitwise_xor(adler32, master_key) if master_key else adler32
-                if adler_key:
-                    key = bitwise_and(bitwise_xor(bitwise_xor(bitwise_xor(right_shift(adler_key, 24), right_shift(adler_key, 16)), right_shift(adler_key, 8)), adler_key), 0xFF)
-                key = key if key else secondary_key
-            elif "xor_plain" in enc_type:
-                master_key = int.from_bytes(master_key) if master_key else 0
-                adler_key = bitwise_xor(adler32, master_key) if master_key else adler32
-                key = adler_key & 0xFF
-                key = key if key else secondary_key
-            elif "xor_bytes" in enc_type:
-                if len(master_key):
-                    key = fromstring((master_key * int(math.ceil( float(len(data))/float(len(master_key)) )))[:len(data)], dtype=dt)
-                    #key = bitwise_xor(key, adler32 & 0xFF)
-                else:
-                    return
-                #print(len(key), len(data))
+        data = bytearray(output_buffer.read())
+        xor_data(data, adler32, encryption_type, use_numpy, offset)
+        output_buffer.seek(0)
+        output_buffer.write(data)
 
-            data = frombuffer(data, dtype=dt)
+def xor_data(data: bytearray, adler32: int, encryption_type: str, use_numpy: bool = False, offset: int = 0):
+    """
+    XOR the data in place, uses numpy if available, no copies of the whole data are made
+    :param offset: Position of the data in the file, for the cyphers that depend on it
+    """
+    enc_type, master_key, secondary_key, _ = encryption_parameters[encryption_type]
+    if not data:
+        return
+    if "xor_bytes" in enc_type and not master_key:
+        return
+    master_key_bytes = master_key
+    master_key = int.from_bytes(master_key)
+    adler_key = adler32 ^ master_key
 
-            if "xor-1st-b" in enc_type:
-                first_byte_key = bitwise_and(adler_key, 0xFF)
-                if not first_byte_key:
-                    first_byte_key = bitwise_and(master_key, 0xFF)
-                first = frombuffer(data[:1], dtype=uint8)
-                first = bitwise_xor(first, first_byte_key)
-                data = concatenate((first, frombuffer(data[1:], dtype=uint8)))
+    if "xor-1st-b" in enc_type and offset == 0:
+        first_byte_key = adler_key & 0xFF
+        if not first_byte_key: first_byte_key = master_key & 0xFF
+        data[0] ^= first_byte_key
 
-            data = bitwise_xor(data, key)
+    # Use numpy if available
+    if use_numpy and ("xor_full" in enc_type or "xor_plain" in enc_type or "xor_bytes" in enc_type) and not ("shr3" in enc_type or "xor-mix" in enc_type) and numpy_available():
+        from numpy import frombuffer, resize, uint8
+        view = frombuffer(data, dtype=uint8)  # Writable view of the bytearray
+        if "xor_bytes" in enc_type:
+            # Repeating key rotated to the position, XORed a block at a time
+            shift = offset % len(master_key_bytes)
+            key = frombuffer(master_key_bytes[shift:] + master_key_bytes[:shift], dtype=uint8)
+            key = resize(key, len(key) * max(1, XOR_BLOCK_SIZE // len(key)))
+            for start in range(0, len(view), len(key)):
+                block = view[start:start + len(key)]
+                block ^= key[:len(block)]
+            return
+        if "xor_full" in enc_type:
+            key = 0
+            if adler_key:
+                key = (adler_key >> 24 ^ adler_key >> 16 ^ adler_key >> 8 ^ adler_key) & 0xFF
         else:
-            master_key = int.from_bytes(master_key)
-            adler_key = adler32 ^ master_key
-            data = array('B', data)
-
-            if "xor-1st-b" in enc_type:
-                first_byte_key = adler_key & 0xFF
-                if not first_byte_key: first_byte_key = master_key & 0xFF
-                data[0] ^= first_byte_key
-
-            # XOR the data
-            if "xor_full" in enc_type:
-                key = 0
-                if adler_key:
-                    key = (adler_key >> 24 ^ adler_key >> 16 ^ adler_key >> 8 ^ adler_key) & 0xFF
-                key = key if key else secondary_key
-                if key:
-                    for i in range(0, len(data), 2): data[i] ^= key
-            elif "xor_plain" in enc_type:
-                key = adler_key & 0xFF
-                if key:
-                    for i in range(0, len(data)): data[i] ^= key
-            elif "xor_byte" in enc_type:
-                key = secondary_key & 0xFF
-                for i in range(0, len(data)): data[i] ^= key
-            elif "xor-p1-neg" in enc_type:
-                key = adler_key & 0xFF
-                for i in range(0, len(data)): data[i] = xor_p1_neg(data[i], key)
-            elif "xor-mix" in enc_type:
-                key = adler_key & 0xFF
-                for i in range(0, len(data), 2): data[i] ^= key
-                for i in range(1, len(data), 2): data[i] ^= i
-            elif "shr3" in enc_type:
-                for i in range(0, len(data)): data[i] ^= (adler_key >> 3) & 0xFF
-
-        # Overwrite the buffer with decrypted/encrypted data
-        output_buffer.seek(0)
-        output_buffer.write(data.tobytes())
+            key = adler_key & 0xFF
+        key = key if key else secondary_key
+        if key:
+            view ^= uint8(key)
+        return
+
+    # XOR the data
+    if "xor_full" in enc_type:
+        key = 0
+        if adler_key:
+            key = (adler_key >> 24 ^ adler_key >> 16 ^ adler_key >> 8 ^ adler_key) & 0xFF
+        key = key if key else secondary_key
+        if key:
+            _translate(data, _table(plain_xor, key), offset % 2, 2)
+    elif "xor_plain" in enc_type:
+        key = adler_key & 0xFF
+        if key:
+            _translate(data, _table(plain_xor, key))
+    elif "xor_bytes" in enc_type:
+        for index, key in enumerate(master_key_bytes):
+            _translate(data, _table(plain_xor, key), (index - offset) % len(master_key_bytes), len(master_key_bytes))
+    elif "xor-p1-neg" in enc_type:
+        key = adler_key & 0xFF
+        _translate(data, _table(xor_p1_neg, key))
+    elif "xor-mix" in enc_type:
+        key = adler_key & 0xFF
+        _translate(data, _table(plain_xor, key), offset % 2, 2)
+        # The other bytes are XORed with their position
+        for index in range(1 - offset % 2, 256, 2):
+            _translate(data, _table(plain_xor, (offset + index) & 0xFF), index, 256)
+    elif "shr3" in enc_type:
+        _translate(data, _table(plain_xor, (adler_key >> 3) & 0xFF))
+
+def _table(function, key: int) -> bytes:
+    """Translation table of the byte cypher with the key"""
+    return bytes(function(nbyte, key) for nbyte in range(256))
+
+def _translate(data: bytearray, table: bytes, start: int = 0, step: int = 1):
+    """Translate every step-th byte from start in place, a block at a time"""
+    block_size = XOR_BLOCK_SIZE - XOR_BLOCK_SIZE % step
+    for position in range(0, len(data), block_size):
+        block = slice(position + start, position + block_size, step)
+        data[block] = data[block].translate(table)
 
 def plain_xor(nbyte, key): return (nbyte ^ key)
 def xor_p1_neg(nbyte, key): return (nbyte ^ (key + 1) ^ 0xFF) & 0xFF
@@ -1,8 +1,9 @@
-import zlib, struct
+import struct
 from io import BufferedReader
 from collections import namedtuple
 from datetime import datetime
 from .constants import XP3FileIsEncrypted
+from .codec import adler32
 #from math import ceil
 
 class XP3FileEncryption:
@@ -51,6 +52,7 @@ class XP3FileTime:
 
     def __init__(self, timestamp: int = 0):
         self.timestamp = timestamp
+        self.milliseconds = timestamp  # value as stored in the chunk
 
 
     @classmethod
@@ -58,10 +60,12 @@ class XP3FileTime:
         size, timestamp = cls.time_chunk.unpack(buffer.read(16))
         if size != 8:
             raise AssertionError
-        return cls(timestamp // 1000)
+        time = cls(timestamp // 1000)
+        time.milliseconds = timestamp
+        return time
 
     def to_bytes(self):
-        return b'time' + self.time_chunk.pack(8, self.timestamp)
+        return b'time' + self.time_chunk.pack(8, self.milliseconds)
 
 
 class XP3FileSegments:
@@ -173,7 +177,7 @@ class XP3FileAdler:
 
     @classmethod
     def from_data(cls, data: bytes):
-        return cls(zlib.adler32(data))
+        return cls(adler32(data))
 
     def to_bytes(self):
         return b'adlr' + self.adler32_chunk.pack(4, self.value)
@@ -186,19 +190,20 @@ class XP3FileEntry:
     file_chunk = struct.Struct('<Q')
 
     def __init__(self, time: XP3FileTime, adlr: XP3FileAdler, segm: XP3FileSegments, info: XP3FileInfo,
-                 encryption: XP3FileEncryption = None):
+                 encryption: XP3FileEncryption = None, strict: bool = True):
+        """:param strict: Raise an error if the checksums in the adlr and encryption chunks don't match"""
         self.encryption = encryption
         self.time = time
         self.adlr = adlr
         self.segm = segm
         self.info = info
 
-        if encryption:
+        if encryption and strict:
             if self.file_path and adlr.value != encryption.adler32:
                 raise AssertionError(f"Checksums in adlr and encryption chunks don't match: 0x{adlr.value:X} != 0x{encryption.adler32:X} for {self}")
 
     @classmethod
-    def read_from(cls, buffer: BufferedReader):
+    def read_from(cls, buffer: BufferedReader, strict: bool = True):
         encryption = None
         time = None
         adlr = None
@@ -229,7 +234,7 @@ class XP3FileEntry:
         elif not time:  # time chunk is not always present
             time = XP3FileTime()  # create an empty placeholder
 
-        return cls(adlr=adlr, segm=segm, info=info, time=time, encryption=encryption)
+        return cls(adlr=adlr, segm=segm, info=info, time=time, encryption=encryption, strict=strict)
 
     @property
     def adler32(self):
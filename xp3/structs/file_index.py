@@ -1,8 +1,11 @@
-import os, zlib, struct
+import os, struct
 from .file_entry import XP3FileEntry
+from .codec import compress, compressobj, decompress
 from io import BytesIO
 from .constants import XP3Signature, XP3FileIndexContinue, XP3FileIndexCompressed, Xp3FileIndexUncompressed
 
+INDEX_CHUNK_SIZE = 1 << 20  # Compress the file index 1 MiB at a time
+
 class peek:
     """
         Context manager, goes to position in the buffer and goes back
@@ -93,7 +96,7 @@ class XP3FileIndex:
         if flag == XP3FileIndexCompressed:
             compressed_size, uncompressed_size = struct.unpack('<2Q', buffer.read(16))
             index = buffer.read(compressed_size)
-            index = zlib.decompress(index)
+            index = decompress(index)
             if len(index) != uncompressed_size:
                 raise AssertionError('Index size mismatch')
         elif flag == Xp3FileIndexUncompressed:
@@ -106,7 +109,7 @@ class XP3FileIndex:
 
     def to_bytes(self):
         uncompressed_index = b''.join([entry.to_bytes() for entry in self.entries])
-        compressed_index = zlib.compress(uncompressed_index, level=9)
+        compressed_index = compress(uncompressed_index, level=9)
         uncompressed_size = len(uncompressed_index)
         compressed_size = len(compressed_index)
         if compressed_size + 1 + 8 + 8 < uncompressed_size + 1 + 8:  # Account for header overhead
@@ -114,6 +117,39 @@ class XP3FileIndex:
         else:
             return struct.pack('<BQ', Xp3FileIndexUncompressed, uncompressed_size) + uncompressed_index
 
+    @staticmethod
+    def write_index(buffer, index_buffer):
+        """
+        Write a file index compressed a chunk at a time, the same as to_bytes() without having all of it in memory
+        :param buffer: Seekable buffer to write into at its position
+        :param index_buffer: Buffer with the serialized entries, read from its start
+        """
+        start = buffer.tell()
+        buffer.write(struct.pack('<BQQ', XP3FileIndexCompressed, 0, 0))  # Sizes placeholder
+        compressor = compressobj(9)
+        uncompressed_size = compressed_size = 0
+        index_buffer.seek(0)
+        while chunk := index_buffer.read(INDEX_CHUNK_SIZE):
+            uncompressed_size += len(chunk)
+            data = compressor.compress(chunk)
+            compressed_size += len(data)
+            buffer.write(data)
+        data = compressor.flush()
+        compressed_size += len(data)
+        buffer.write(data)
+        end = buffer.tell()
+
+        buffer.seek(start)
+        if compressed_size + 1 + 8 + 8 < uncompressed_size + 1 + 8:  # Account for header overhead
+            buffer.write(struct.pack('<BQQ', XP3FileIndexCompressed, compressed_size, uncompressed_size))
+            buffer.seek(end)
+        else:
+            buffer.truncate()
+            buffer.write(struct.pack('<BQ', Xp3FileIndexUncompressed, uncompressed_size))
+            index_buffer.seek(0)
+            while chunk := index_buffer.read(INDEX_CHUNK_SIZE):
+                buffer.write(chunk)
+
     def __iter__(self):
         yield from self.entries
 
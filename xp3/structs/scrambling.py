@@ -1,5 +1,6 @@
-import zlib, struct, sys
+import struct, sys
 from io import BytesIO
+from .codec import compress, decompress
 
 UTF_16LE_BOM = b'\xFF\xFE'
 
@@ -49,11 +50,11 @@ class KSScrambling:
         self.buffer.seek(16, 0)
         data = self.buffer.read(sys.getsizeof(self.buffer) - self.buffer.tell())
         self.buffer.seek(0)
-        return zlib.decompress(data)
+        return decompress(data)
 
     def compress(self):
         data = self.buffer.read(sys.getsizeof(self.buffer) - self.buffer.tell())
-        compressed_data = zlib.compress(data)
+        compressed_data = compress(data)
         self.buffer.seek(0)
         self.buffer.write(struct.pack('<QQ', len(compressed_data), len(data)))
         self.buffer.write(compressed_data)
@@ -2,6 +2,8 @@ import os
 import unittest
 import datetime
 import tempfile
+import zlib
+import time
 from xp3 import XP3, XP3Reader, XP3Writer
 import tracemalloc
 
@@ -115,5 +117,1156 @@ class DuplicateWrite(unittest.TestCase):
                 xp3.add('duplicate_file', b'12345', None)
 
 
+class MergeAndRebuild(unittest.TestCase):
+    """Raw segment copy, later archives win"""
+
+    def write(self, path, files, encryption_type=None):
+        with XP3(path, mode='w', silent=True) as xp3:
+            for filepath, data in files:
+                xp3.add(filepath, data, encryption_type, timestamp=1234567)
+
+    def test(self):
+        from xp3.merge import merge, rebuild
+        with tempfile.TemporaryDirectory() as xp3dir:
+            base, patch, out = (os.path.join(xp3dir, name) for name in ('base.xp3', 'patch.xp3', 'out.xp3'))
+            self.write(base, (('a.txt', b'a' * 100), ('b.txt', b'old')))
+            self.write(patch, (('b.txt', b'new' * 50), ('c.txt', b'c')), 'hidden')
+            merge([base, patch], out)
+
+            with XP3(out, mode='r', silent=True) as merged, XP3(patch, mode='r', silent=True) as source:
+                self.assertEqual(['a.txt', 'b.txt', 'c.txt'], [file.file_path for file in merged])
+                self.assertEqual(b'a' * 100, merged.open('a.txt').read())
+                self.assertEqual(b'new' * 50, merged.open('b.txt').read(encryption_type='hidden'))
+                for path in ('b.txt', 'c.txt'):
+                    copied, original = merged.open(path), source.open(path)
+                    self.assertEqual(original.to_bytes().replace(original.segm.to_bytes(), b''),
+                                     copied.to_bytes().replace(copied.segm.to_bytes(), b''))
+                    merged.buffer.seek(copied.segm[0].offset)
+                    source.buffer.seek(original.segm[0].offset)
+                    self.assertEqual(source.buffer.read(original.segm[0].compressed_size),
+                                     merged.buffer.read(copied.segm[0].compressed_size))
+
+            # The output can't overwrite an archive still being read
+            size = os.path.getsize(base)
+            with self.assertRaises(ValueError):
+                merge([base, patch], base)
+            self.assertEqual(size, os.path.getsize(base))
+
+            size = os.path.getsize(out)
+            rebuild(out)
+            self.assertEqual(size, os.path.getsize(out))
+            with XP3(out, mode='r', silent=True) as rebuilt:
+                self.assertEqual(3, len(rebuilt.file_index.entries))
+
+
+class Diff(unittest.TestCase):
+    """Patch archive with only the changed files"""
+
+    def test(self):
+        from xp3.diff import diff, ADDED, MODIFIED, DELETED
+        with tempfile.TemporaryDirectory() as xp3dir:
+            old, new, patch = (os.path.join(xp3dir, name) for name in ('old.xp3', 'new.xp3', 'patch.xp3'))
+            with XP3(old, mode='w', silent=True) as xp3:
+                for filepath, data in (('same', b'same'), ('changed', b'data1'), ('deleted', b'data')):
+                    xp3.add(filepath, data)
+            with XP3(new, mode='w', silent=True) as xp3:
+                for filepath, data in (('same', b'same'), ('changed', b'data2'), ('added', b'data')):
+                    xp3.add(filepath, data)
+
+            changes = diff(old, new, patch, silent=True)
+            self.assertEqual(sorted([(MODIFIED, 'changed'), (ADDED, 'added'), (DELETED, 'deleted')]), sorted(changes))
+            with XP3(patch, mode='r', silent=True) as xp3:
+                self.assertEqual(['changed', 'added'], [file.file_path for file in xp3])
+                self.assertEqual(b'data2', xp3.open('changed').read())
+
+            size = os.path.getsize(old)
+            with self.assertRaises(ValueError):
+                diff(old, new, old, silent=True)
+            self.assertEqual(size, os.path.getsize(old))
+
+
+class Fsck(unittest.TestCase):
+    """Structural problems found from the file index alone"""
+
+    def test(self):
+        import struct
+        from xp3.fsck import fsck
+        from xp3.structs import XP3FileEncryption, XP3FileIndex, XP3Signature
+        with tempfile.TemporaryDirectory() as xp3dir:
+            archive = os.path.join(xp3dir, 'data.xp3')
+            with XP3(archive, mode='w', silent=True) as xp3:
+                for filepath in ('first.txt', 'second.txt', 'third.txt', 'fourth.txt'):
+                    xp3.add(filepath, filepath.encode() * 10)
+            self.assertEqual((4, []), fsck(archive))
+
+            # Same data with a broken file index
+            with XP3(archive, silent=True) as source:
+                first, second, third, fourth = (source.file_index[path] for path in
+                                                ('first.txt', 'second.txt', 'third.txt', 'fourth.txt'))
+                segment = second.segm.segments[0]
+                second.segm.segments[0] = segment._replace(offset=segment.offset - 1)  # Overlaps the first
+                third.info.uncompressed_size += 1
+                fourth.info.file_path = 'First.txt'
+                fourth.encryption = XP3FileEncryption(fourth.adler32 + 1, 'First.txt')
+                segment = first.segm.segments[0]
+                first.segm.segments.append(segment._replace(offset=1 << 40))
+            with open(archive, 'rb') as file:
+                data = file.read()
+            index_offset, = struct.unpack_from('<Q', data, len(XP3Signature))
+            with open(os.path.join(xp3dir, 'broken.xp3'), 'wb') as file:
+                file.write(data[:index_offset])
+                file.write(XP3FileIndex.from_entries([first, second, third, fourth]).to_bytes())
+
+            count, problems = fsck(os.path.join(xp3dir, 'broken.xp3'))
+            self.assertEqual(4, count)
+            self.assertEqual(['first.txt', 'second.txt', 'first.txt', 'third.txt', 'first.txt', 'First.txt',
+                              'First.txt'], [path for path, _ in problems])
+            self.assertIn('outside of the archive', problems[0][1])
+            self.assertIn('overlaps the one of first.txt', problems[1][1])
+            self.assertIn('the info chunk says', problems[3][1])
+            self.assertIn('used by 2 files', problems[4][1])
+            self.assertIn('adlr and encryption', problems[-1][1])
+
+
+class Layout(unittest.TestCase):
+    """Data is reordered by the access trace"""
+
+    def test(self):
+        from xp3.layout import optimize_layout
+        files = [('dir{}/file{}'.format(index % 3, index), os.urandom(1000)) for index in range(12)]
+        with tempfile.TemporaryDirectory() as xp3dir:
+            archive, output = os.path.join(xp3dir, 'data.xp3'), os.path.join(xp3dir, 'ordered.xp3')
+            with XP3(archive, mode='w', silent=True) as xp3:
+                for filepath, data in files:
+                    xp3.add(filepath, data)
+
+            with XP3(archive, mode='r', silent=True) as xp3:
+                trace = xp3.start_trace()
+                for filepath in ('dir2/file11', 'dir0/file0', 'dir1/file4', 'dir0/file0'):
+                    xp3.open(filepath).read()
+
+            before, after = optimize_layout(archive, trace, output, silent=True)
+            self.assertLess(after, before)
+            with XP3(output, mode='r', silent=True) as xp3:
+                paths = [file.file_path for file in sorted(xp3, key=lambda file: file.segm[0].offset)]
+                self.assertEqual(['dir2/file11', 'dir0/file0', 'dir1/file4'], paths[:3])
+                directories = [os.path.dirname(path) for path in paths[3:]]
+                self.assertEqual(['dir1', 'dir1', 'dir1', 'dir2', 'dir2', 'dir2', 'dir0', 'dir0', 'dir0'], directories)
+                for filepath, data in files:
+                    self.assertEqual(data, xp3.open(filepath).read())
+
+
+class Codec(unittest.TestCase):
+    """Every installed deflate backend writes archives the standard zlib can read"""
+
+    def test(self):
+        import zlib
+        from xp3.structs import codec
+        data = b'compressible data ' * 1000
+        try:
+            for backend in codec.available_backends():
+                codec.set_backend(backend)
+                with XP3Writer(silent=True) as xp3:
+                    xp3.add('file.txt', data)
+                    archive = xp3.pack_up()
+                codec.set_backend('zlib')
+                with XP3Reader(archive, silent=True) as xp3:
+                    file = xp3.open('file.txt')
+                    self.assertTrue(file.segm[0].is_compressed)
+                    self.assertEqual(data, file.read())
+                    self.assertEqual(zlib.adler32(data), file.adler32)
+                # Broken streams raise one of codec.error whatever the backend
+                codec.set_backend(backend)
+                with self.assertRaises(codec.error):
+                    codec.decompress(codec.compress(data)[:-10])
+        finally:
+            codec.set_backend()
+
+
+class MaxCompression(unittest.TestCase):
+    """Strategy search keeps the smallest stream and remembers the winner"""
+
+    def test(self):
+        import zlib
+        from xp3.compression import StrategySearch
+        data = bytes(range(256)) * 64 + b'\0' * 4096 + b'text ' * 500
+        with tempfile.TemporaryDirectory() as cachedir:
+            cache_path = os.path.join(cachedir, 'strategies.json')
+            with StrategySearch(cache_path) as compressor:
+                with XP3Writer(silent=True, compressor=compressor) as xp3:
+                    xp3.add('file.bin', data)
+                    archive = xp3.pack_up()
+                self.assertEqual(1, compressor.searches)
+
+            with XP3Reader(archive, silent=True) as xp3:
+                file = xp3.open('file.bin')
+                self.assertEqual(data, file.read())
+                self.assertLessEqual(file.segm[0].compressed_size, len(zlib.compress(data, 9)))
+
+            with StrategySearch(cache_path) as compressor:
+                self.assertEqual(zlib.decompress(compressor(data)), data)
+                self.assertEqual((0, 1), (compressor.searches, compressor.cache_hits))
+
+
+class BuildCache(unittest.TestCase):
+    """Repacks take the packed data of unchanged files from the cache"""
+
+    def pack(self, cache, files, encryption_type=None):
+        with XP3Writer(silent=True, cache=cache) as xp3:
+            for filepath, data in files.items():
+                xp3.add(filepath, data, encryption_type)
+            return xp3.pack_up()
+
+    def test(self):
+        from xp3.buildcache import BuildCache
+        files = {'scenario/first.ks': b'script ' * 100, 'image/bg.png': b'image', 'data.bin': bytes(1000)}
+        with tempfile.TemporaryDirectory() as cachedir:
+            cache = BuildCache(cachedir)
+            archive = self.pack(cache, files)
+            self.assertEqual((0, 3), (cache.hits, cache.misses))
+            self.assertEqual(archive, self.pack(cache, files))
+            self.assertEqual((3, 3), (cache.hits, cache.misses))
+
+            files['data.bin'] = bytes(2000)
+            with XP3Reader(self.pack(cache, files), silent=True) as xp3:
+                self.assertEqual(bytes(2000), xp3.open('data.bin').read())
+            self.assertEqual((5, 4), (cache.hits, cache.misses))
+
+            # Other packing settings don't share the entries
+            self.pack(cache, files, 'hidden')
+            self.assertEqual((5, 7), (cache.hits, cache.misses))
+
+            cache.max_size = 0
+            cache.close()
+            self.assertEqual(0, BuildCache(cachedir).evict())
+            self.assertEqual([], [filename for _, _, filenames in os.walk(cachedir) for filename in filenames])
+
+    def test_command_line(self):
+        import subprocess, sys
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        with tempfile.TemporaryDirectory() as xp3dir:
+            os.makedirs(os.path.join(xp3dir, 'game', 'scenario'))
+            with open(os.path.join(xp3dir, 'game', 'scenario', 'first.ks'), 'wb') as file:
+                file.write(b'script')
+            # --cache doesn't take the next argument as its folder
+            for hits in (0, 1):
+                result = subprocess.run([sys.executable, '-m', 'xp3', '-r', '--cache', '--cache-dir',
+                                         os.path.join(xp3dir, 'cache'), os.path.join(xp3dir, 'game'),
+                                         os.path.join(xp3dir, 'game.xp3')],
+                                        cwd=root, capture_output=True, text=True)
+                self.assertEqual(0, result.returncode, result.stdout + result.stderr)
+                self.assertIn('{} of 1 file(s) from the build cache'.format(hits), result.stdout)
+
+
+class Memory(unittest.TestCase):
+    """Peak memory of packing and reading large files under every cypher, as a multiple of the file or chunk size"""
+
+    size = 8 << 20
+    chunk_size = 1 << 20
+    pack_peak = 2.5  # times the file size, besides the file itself
+    read_peak = 3
+    stream_peak = 5  # times the chunk size
+
+    def peak(self, function):
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        result = function()
+        return result, tracemalloc.get_traced_memory()[1] - current
+
+    def test(self):
+        from xp3.xp3 import set_key
+        from xp3.structs.encryption_parameters import encryption_parameters
+        from xp3.structs.file import numpy_available
+        if numpy_available():
+            import numpy  # Imported before measuring
+            del numpy
+        data = os.urandom(self.size // 2) + bytes(self.size // 2)
+        original_key = encryption_parameters['hiddenb'][1]
+        try:
+            with tempfile.TemporaryDirectory() as xp3dir:
+                for cypher in encryption_parameters:
+                    if cypher == 'hiddenb':
+                        set_key('5a17c3e809')
+                    with self.subTest(cypher=cypher):
+                        archive = os.path.join(xp3dir, cypher + '.xp3')
+                        with XP3(archive, mode='w', silent=True) as xp3:
+                            _, peak = self.peak(lambda: xp3.add('file.bin', data, cypher))
+                        self.assertLess(peak, self.pack_peak * self.size)
+
+                        with XP3(archive, silent=True) as xp3:
+                            file = xp3.open('file.bin')
+                            read, peak = self.peak(lambda: file.read(encryption_type=cypher))
+                            self.assertEqual(data, read)
+                            self.assertLess(peak, self.read_peak * self.size)
+                            del read
+
+                            chunks = file.stream(encryption_type=cypher, chunk_size=self.chunk_size)
+                            size, peak = self.peak(lambda: sum(len(chunk) for chunk in chunks))
+                            self.assertEqual(self.size, size)
+                            self.assertLess(peak, self.stream_peak * self.chunk_size)
+        finally:
+            encryption_parameters['hiddenb'][1] = original_key
+
+
+class Export(unittest.TestCase):
+    """Streaming reads and export into tar and zip"""
+
+    files = (
+        ('dir/text.txt', b'text ' * 10000, 1600000000000),
+        ('random.bin', os.urandom(100000), 1500000000000),
+    )
+
+    def test_stream(self):
+        from xp3.structs import encryption_parameters
+        data = os.urandom(50001)
+        encryption_parameters['hiddenb'][1] = b'\x12\x34\x56'
+        try:
+            for use_numpy in (True, False):
+                for encryption_type in ('none', 'hidden', 'hiddenb'):
+                    with XP3Writer(silent=True, use_numpy=use_numpy) as xp3:
+                        xp3.add('file.bin', data, encryption_type)
+                        xp3.add('file.txt', b'1' * 50001, encryption_type)
+                        archive = xp3.pack_up()
+                    with XP3Reader(archive, silent=True, use_numpy=use_numpy) as xp3:
+                        for file in xp3:
+                            chunks = list(file.stream(encryption_type, chunk_size=999))
+                            self.assertGreater(len(chunks), 1)
+                            self.assertEqual(file.read(encryption_type), b''.join(chunks))
+        finally:
+            encryption_parameters['hiddenb'][1] = b''
+
+    def test_export(self):
+        import io, tarfile, zipfile
+        from xp3.export import export
+        with tempfile.TemporaryDirectory() as xp3dir:
+            archive = os.path.join(xp3dir, 'data.xp3')
+            with XP3(archive, mode='w', silent=True) as xp3:
+                for filepath, data, timestamp in self.files:
+                    xp3.add(filepath, data, timestamp=timestamp)
+
+            output = io.BytesIO()
+            self.assertEqual(2, export(archive, output, 'tar', silent=True))
+            with tarfile.open(fileobj=io.BytesIO(output.getvalue())) as tar:
+                for filepath, data, timestamp in self.files:
+                    self.assertEqual(data, tar.extractfile(filepath).read())
+                    self.assertEqual(timestamp // 1000, tar.getmember(filepath).mtime)
+
+            output = io.BytesIO()
+            self.assertEqual(2, export(archive, output, 'zip', silent=True))
+            with zipfile.ZipFile(output) as zip:
+                for filepath, data, timestamp in self.files:
+                    self.assertEqual(data, zip.read(filepath))
+                    self.assertEqual(datetime.datetime.fromtimestamp(timestamp // 1000).timetuple()[:6],
+                                     zip.getinfo(filepath).date_time)
+
+    def test_checksum_error(self):
+        import io
+        from xp3.export import export, export_main
+        from xp3.structs.file import XP3ChecksumError
+        with tempfile.TemporaryDirectory() as xp3dir:
+            archive = os.path.join(xp3dir, 'data.xp3')
+            with XP3(archive, mode='w', silent=True) as xp3:
+                for filepath, data, timestamp in self.files:
+                    xp3.add(filepath, data, timestamp=timestamp)
+            with XP3(archive, mode='r', silent=True) as xp3:
+                offset = xp3['random.bin'].segm[0].offset
+            with open(archive, 'r+b') as file:  # random.bin is stored as it is
+                file.seek(offset + 1000)
+                byte = file.read(1)
+                file.seek(offset + 1000)
+                file.write(bytes([byte[0] ^ 0xFF]))
+
+            with XP3(archive, mode='r', silent=True) as xp3:
+                chunks = xp3['random.bin'].stream(chunk_size=30000)
+                with self.assertRaises(XP3ChecksumError):
+                    list(chunks)
+            for format in ('tar', 'zip'):
+                with self.assertRaisesRegex(XP3ChecksumError, 'random.bin'):
+                    export(archive, io.BytesIO(), format, silent=True)
+            self.assertEqual(2, export_main([archive, '-o', os.path.join(xp3dir, 'data.tar'), '-s']))
+
+
+class SelectiveUnpack(unittest.TestCase):
+    """Only the files passing the filter are read and unpacked"""
+
+    def test(self):
+        from xp3.filters import path_filter
+        matches = path_filter(include=['*.ks'], exclude=['test/*'], exclude_regex=['^skip'])
+        self.assertTrue(matches('scenario/first.ks'))
+        self.assertFalse(matches('scenario/first.tjs'))
+        self.assertFalse(matches('test/first.ks'))
+        self.assertFalse(matches('skip.ks'))
+        self.assertIsNone(path_filter())
+
+        with tempfile.TemporaryDirectory() as xp3dir:
+            archive = os.path.join(xp3dir, 'data.xp3')
+            with XP3(archive, mode='w', silent=True) as xp3:
+                xp3.add('scenario/first.ks', b'script')
+                xp3.add('image/bg.png', b'image')
+
+            with XP3(archive, mode='r', silent=True) as xp3:
+                from unittest import mock
+                from xp3.structs import file
+                with mock.patch.object(file, 'pread', wraps=file.pread) as pread:
+                    xp3.unpack(os.path.join(xp3dir, 'out'), filter=path_filter(include_regex=[r'\.ks$']))
+                self.assertEqual([len(b'script')], [call.args[2] for call in pread.call_args_list])
+            self.assertEqual(['first.ks'], os.listdir(os.path.join(xp3dir, 'out', 'scenario')))
+            self.assertFalse(os.path.exists(os.path.join(xp3dir, 'out', 'image')))
+
+
+class Catalog(unittest.TestCase):
+    """Catalog of several archives, updated only for changed archives"""
+
+    def test(self):
+        from xp3.catalog import Catalog
+        with tempfile.TemporaryDirectory() as gamedir:
+            for name, files in (('data.xp3', (('scenario/first.ks', b'script'), ('bgm/title.ogg', b'music'))),
+                                ('sub/patch.xp3', (('scenario/first.ks', b'patched'), ('bgm/copy.ogg', b'music')))):
+                with XP3(os.path.join(gamedir, name), mode='w', silent=True) as xp3:
+                    for filepath, data in files:
+                        xp3.add(filepath, data)
+
+            with Catalog(os.path.join(gamedir, 'catalog.sqlite'), silent=True) as catalog:
+                self.assertEqual((2, 0, 0), catalog.build(gamedir))
+                self.assertEqual((0, 2, 0), catalog.build(gamedir))
+                self.assertEqual(['data.xp3', 'patch.xp3'],
+                                 [os.path.basename(row[0]) for row in catalog.find_path('Scenario/First.ks')])
+                self.assertEqual(['bgm/copy.ogg', 'bgm/title.ogg'],
+                                 sorted(row[1] for row in catalog.find_glob('bgm/*.ogg')))
+                self.assertEqual(['bgm/copy.ogg', 'bgm/title.ogg'], sorted(row[1] for row in catalog.duplicates()))
+
+                os.remove(os.path.join(gamedir, 'sub', 'patch.xp3'))
+                self.assertEqual((0, 1, 1), catalog.build(gamedir))
+                self.assertEqual([], catalog.duplicates())
+
+                # An archive with a truncated index is skipped, the others are still indexed
+                with open(os.path.join(gamedir, 'data.xp3'), 'rb') as file:
+                    data = file.read()
+                with open(os.path.join(gamedir, 'broken.xp3'), 'wb') as file:
+                    file.write(data[:-5])
+                with XP3(os.path.join(gamedir, 'sub', 'patch.xp3'), mode='w', silent=True) as xp3:
+                    xp3.add('scenario/second.ks', b'script')
+                self.assertEqual((1, 1, 0), catalog.build(gamedir))
+
+
+class HashedNames(unittest.TestCase):
+    """Real names of files stored under hashed names recovered from a wordlist"""
+
+    def test(self):
+        from xp3.names import hashed_names, recover, path_hash
+        with XP3Writer(silent=True) as xp3:
+            for filepath in ('scenario/first.ks', 'scenario/second.ks', 'image/title.png'):
+                xp3.add(path_hash(filepath), filepath.encode())
+            archive = xp3.pack_up()
+
+        with XP3Reader(archive, silent=True) as xp3:
+            targets = hashed_names(xp3.file_index)
+            self.assertEqual({path_hash('scenario/first.ks'), path_hash('scenario/second.ks'),
+                              path_hash('image/title.png')}, targets)
+            self.assertEqual(b'scenario/first.ks', xp3.open('Scenario/First.ks').read())
+
+            # 'image/title.png' only comes from combining the words
+            self.assertEqual({path_hash('scenario/first.ks'): 'scenario/first.ks'},
+                             recover(targets, ['scenario/first.ks', 'image/logo.png', 'title'], combine=False))
+            names = recover(targets, ['scenario/first.ks', 'image/logo.png', 'title'])
+            self.assertEqual(['image/title.png', 'scenario/first.ks'], sorted(names.values()))
+
+            xp3.load_names(names)
+            self.assertEqual(['scenario/first.ks', path_hash('scenario/second.ks'), 'image/title.png'],
+                             [file.file_path for file in xp3])
+
+
+class KeyRecovery(unittest.TestCase):
+    """XOR key of a hiddenb archive found from the headers of known file types"""
+
+    def test(self):
+        from xp3.xp3 import set_key
+        from xp3.keys import recover_key
+        from xp3.structs.encryption_parameters import encryption_parameters
+        key = bytes.fromhex('5a17c3e809')
+        files = (('image/title.png', b'\x89PNG\r\n\x1a\n\x00\x00\x00\x0dIHDR' + os.urandom(200)),
+                 ('bgm/title.ogg', b'OggS\x00\x02' + b'\x00' * 8 + os.urandom(300)),
+                 ('sound/click.wav', b'RIFF' + (92).to_bytes(4, 'little') + b'WAVE' + bytes(88)),
+                 ('scenario/first.ks', '\ufeff*start\n[wait time=100]\n'.encode('utf-16le') * 20),
+                 ('readme.txt', b'no known header'))
+        original = encryption_parameters['hiddenb'][1]
+        try:
+            with tempfile.TemporaryDirectory() as xp3dir:
+                archive = os.path.join(xp3dir, 'data.xp3')
+                with XP3(archive, mode='w', silent=True) as xp3:
+                    for filepath, data in files:
+                        xp3.add(filepath, data, set_key(key.hex()))
+
+                results = recover_key(archive, silent=True)
+                self.assertEqual((key, len(files)), results[0][:2])
+                self.assertTrue(all(valid < len(files) for _, valid, _ in results[1:]))
+        finally:
+            encryption_parameters['hiddenb'][1] = original
+
+
+class ConcurrentReads(unittest.TestCase):
+    """One reader shared by many threads reading random files"""
+
+    def read_concurrently(self, xp3, files):
+        import random
+        from concurrent.futures import ThreadPoolExecutor
+
+        def read(filepath):
+            file = xp3[filepath]
+            data = file.read() if random.random() < 0.5 else b''.join(file.stream(chunk_size=1000))
+            return filepath, data, file.adler32
+
+        paths = [random.choice(list(files)) for _ in range(400)]
+        with ThreadPoolExecutor(16) as executor:
+            for filepath, data, checksum in executor.map(read, paths):
+                self.assertEqual(files[filepath], data)
+                self.assertEqual(checksum, zlib.adler32(data))
+
+    def test(self):
+        import random
+        files = {'file_{}.bin'.format(index): random.randbytes(random.randrange(1, 20000)) * random.randrange(1, 4)
+                 for index in range(40)}
+        with tempfile.TemporaryDirectory() as xp3dir:
+            archive = os.path.join(xp3dir, 'data.xp3')
+            with XP3(archive, mode='w', silent=True) as xp3:
+                for filepath, data in files.items():
+                    xp3.add(filepath, data)
+            with XP3(archive, silent=True) as xp3:
+                self.read_concurrently(xp3, files)
+            with open(archive, 'rb') as file, XP3Reader(file.read(), silent=True) as xp3:
+                self.read_concurrently(xp3, files)
+
+
+class RemoteArchive(unittest.TestCase):
+    """Archive read over HTTP with range requests from a local server"""
+
+    def test(self):
+        import random, threading, http.server
+        from xp3.remote import HTTPRangeFile
+
+        class RangeHandler(http.server.SimpleHTTPRequestHandler):
+            total = True  # Send the size of the file in Content-Range
+            length = True  # and in the Content-Length of HEAD requests
+
+            def do_GET(self):
+                with open(self.translate_path(self.path), 'rb') as file:
+                    data = file.read()
+                start, end = self.headers['Range'].split('=')[1].split('-')
+                start, end = int(start), min(int(end), len(data) - 1)
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, len(data) if self.total else '*'))
+                self.send_header('Content-Length', str(end - start + 1))
+                self.end_headers()
+                self.wfile.write(data[start:end + 1])
+
+            def do_HEAD(self):
+                if self.length:
+                    return super().do_HEAD()
+                self.send_response(200)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        files = {'image_{}.bin'.format(index): random.randbytes(300000) for index in range(20)}
+        files['scenario/first.ks'] = b'*start\n[cm]\nHello\n' * 100
+        with tempfile.TemporaryDirectory() as xp3dir:
+            with XP3(os.path.join(xp3dir, 'data.xp3'), mode='w', silent=True) as xp3:
+                for filepath, data in files.items():
+                    xp3.add(filepath, data)
+            size = os.path.getsize(os.path.join(xp3dir, 'data.xp3'))
+
+            server = http.server.ThreadingHTTPServer(
+                ('127.0.0.1', 0), lambda *args: RangeHandler(*args, directory=xp3dir))
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            url = 'http://127.0.0.1:{}/data.xp3'.format(server.server_address[1])
+            try:
+                # Header, file index and one script in a handful of small requests
+                with XP3(url, silent=True) as xp3:
+                    self.assertEqual(files['scenario/first.ks'], xp3['scenario/first.ks'].read())
+                    self.assertLessEqual(xp3.buffer.requests, 4)
+                    self.assertLess(xp3.buffer.bytes_fetched, size // 4)
+                    self.assertEqual(files['image_7.bin'], xp3['image_7.bin'].read())
+
+                # Nearby reads batched into one request, then served from the cache
+                remote = HTTPRangeFile(url, readahead=0)
+                requests = remote.requests
+                remote.prefetch([(300000, 100), (400000, 100), (500000, 100)])
+                self.assertEqual(requests + 1, remote.requests)
+                with open(os.path.join(xp3dir, 'data.xp3'), 'rb') as file:
+                    for offset in (300000, 400000, 500000):
+                        file.seek(offset)
+                        self.assertEqual(file.read(100), remote.pread(offset, 100))
+                    self.assertEqual(requests + 1, remote.requests)
+                    remote.seek(-10, os.SEEK_END)
+                    file.seek(-10, os.SEEK_END)
+                    self.assertEqual(file.read(), remote.read())
+
+                    # Reads about as large as the cache, with the readahead that doesn't fit into it
+                    remote = HTTPRangeFile(url, block_size=4096, cache_size=16 * 4096)
+                    for offset, length in ((0, 4096), (4096, 15 * 4096), (16 * 4096, 16 * 4096),
+                                           (30 * 4096 + 100, 17 * 4096), (5000, 15 * 4096)):
+                        file.seek(offset)
+                        self.assertEqual(file.read(length), remote.pread(offset, length))
+
+                # Size left out of Content-Range (bytes 0-1023/*), taken from a HEAD request
+                RangeHandler.total = False
+                with XP3(url, silent=True) as xp3:
+                    self.assertEqual(size, xp3.buffer.size)
+                    self.assertEqual(files['image_7.bin'], xp3['image_7.bin'].read())
+                RangeHandler.length = False
+                with self.assertRaisesRegex(OSError, 'size'):
+                    HTTPRangeFile(url)
+            finally:
+                server.shutdown()
+                server.server_close()
+
+
+def _start_shared_cache_worker(cache):
+    global _shared_cache
+    _shared_cache = cache
+
+
+def _read_with_shared_cache(archive, filepath):
+    with XP3(archive, silent=True, cache=_shared_cache) as xp3:
+        return filepath, xp3[filepath].read()
+
+
+class SharedCache(unittest.TestCase):
+    """Files read by a pool of processes are decoded once"""
+
+    def test(self):
+        import random
+        from concurrent.futures import ProcessPoolExecutor
+        from xp3.sharedcache import SharedCache
+        files = {'file_{}.txt'.format(index): random.randbytes(1000) * random.randrange(5, 16) for index in range(10)}
+        with tempfile.TemporaryDirectory() as xp3dir, SharedCache(size=1 << 20, slots=64) as cache:
+            archive = os.path.join(xp3dir, 'data.xp3')
+            with XP3(archive, mode='w', silent=True) as xp3:
+                for filepath, data in files.items():
+                    xp3.add(filepath, data)
+            with ProcessPoolExecutor(4, initializer=_start_shared_cache_worker, initargs=(cache,)) as executor:
+                paths = list(files) * 8
+                for filepath, data in executor.map(_read_with_shared_cache, [archive] * len(paths), paths):
+                    self.assertEqual(files[filepath], data)
+            self.assertEqual(len(files), cache.loads)
+            self.assertEqual(len(files) * 7, cache.hits)
+
+            # The oldest entries are written over when the arena is full
+            with SharedCache(size=1 << 15, slots=64) as small_cache, \
+                    XP3Reader(open(archive, 'rb'), silent=True, cache=small_cache) as xp3:
+                for _ in range(3):
+                    for file in xp3:
+                        self.assertEqual(files[file.file_path], file.read())
+                self.assertLess(len(files), small_cache.loads)
+
+
+class ParallelSegments(unittest.TestCase):
+    """Files split into segments are decoded by several threads into one buffer"""
+
+    def test(self):
+        import random
+        from unittest import mock
+        from xp3.structs import file
+        from xp3.structs.codec import adler32_combine
+        for _ in range(100):
+            first, second = random.randbytes(random.randrange(300)), random.randbytes(random.randrange(100000))
+            self.assertEqual(zlib.adler32(first + second),
+                             adler32_combine(zlib.adler32(first), zlib.adler32(second), len(second)))
+
+        data = b''.join(random.randbytes(100) * random.randrange(1, 50) for _ in range(3000))
+        for encryption_type, use_numpy in (('none', True), ('nekov1', True), ('nekov1', False)):
+            with self.subTest(encryption_type=encryption_type, use_numpy=use_numpy):
+                with XP3Writer(silent=True, use_numpy=use_numpy, segment_size=100000) as xp3:
+                    xp3.add('movie.bin', data, encryption_type)
+                    archive = xp3.pack_up()
+                with XP3Reader(archive, silent=True, use_numpy=use_numpy) as xp3:
+                    entry = xp3['movie.bin']
+                    self.assertEqual(-(-len(data) // 100000), len(entry.segm.segments))
+                    with mock.patch.object(file, 'PARALLEL_MIN_SIZE', 0), mock.patch.object(file, 'PARALLEL_WORKERS', 4), \
+                            mock.patch.object(file.XP3File, '_read_parallel', wraps=entry._read_parallel) as parallel:
+                        self.assertEqual(data, entry.read(encryption_type))
+                        self.assertTrue(parallel.called)
+                    self.assertEqual(data, b''.join(entry.stream(encryption_type, chunk_size=30000)))
+
+
+class Estimate(unittest.TestCase):
+    """The size estimated from samples is close to the size of the packed archive"""
+
+    def test(self):
+        import random
+        from xp3.estimate import estimate
+        words = [random.randbytes(random.randrange(2, 8)).hex().encode() for _ in range(500)]
+        with tempfile.TemporaryDirectory() as xp3dir:
+            folder = os.path.join(xp3dir, 'data')
+            os.makedirs(os.path.join(folder, 'scenario'))
+            for index in range(100):
+                with open(os.path.join(folder, 'scenario', 'text_{}.ks'.format(index)), 'wb') as file:
+                    file.write(b' '.join(random.choices(words, k=random.randrange(100, 30000))))
+            for index in range(10):
+                with open(os.path.join(folder, 'video_{}.bin'.format(index)), 'wb') as file:
+                    file.write(random.randbytes(random.randrange(1, 1 << 20)))
+                with open(os.path.join(folder, 'image_{}.png'.format(index)), 'wb') as file:
+                    file.write(random.randbytes(random.randrange(1, 1 << 18)))
+            with XP3(os.path.join(xp3dir, 'data.xp3'), mode='w', silent=True) as xp3:
+                xp3.add_folder(folder)
+
+            estimates, archive_size, seconds, sampled = estimate(folder, sample_size=1 << 20)
+            self.assertEqual(120, len(estimates))
+            self.assertLess(sampled, sum(file.size for file in estimates))
+            self.assertAlmostEqual(1, archive_size / os.path.getsize(os.path.join(xp3dir, 'data.xp3')), delta=0.05)
+            self.assertGreater(seconds, 0)
+
+
+class ScalableIndex(unittest.TestCase):
+    """The file index is spooled to a temporary file and compressed a chunk at a time"""
+
+    def test(self):
+        from unittest import mock
+        from xp3 import xp3writer
+        from xp3.structs import file_index
+        with mock.patch.object(xp3writer, 'INDEX_SPOOL_SIZE', 1 << 16), mock.patch.object(file_index, 'INDEX_CHUNK_SIZE', 1000):
+            with XP3Writer(silent=True) as xp3:
+                for index in range(5000):
+                    xp3.add('folder_{}/file_{}.txt'.format(index % 10, index), str(index).encode())
+                with self.assertRaises(FileExistsError):
+                    xp3.add('folder_3/file_13.txt', b'again')
+                self.assertTrue(xp3._index_spool._rolled)
+                self.assertEqual(5000, xp3.entry_count)
+                entries = list(xp3.iter_entries())
+                self.assertEqual(5000, len(entries))
+                self.assertEqual('folder_9/file_4999.txt', entries[-1].file_path)
+                archive = xp3.pack_up()
+
+        with XP3Reader(archive, silent=True) as xp3:
+            self.assertEqual(5000, len(xp3.file_index.entries))
+            for index in (0, 1234, 4999):
+                self.assertEqual(str(index).encode(), xp3['folder_{}/file_{}.txt'.format(index % 10, index)].read())
+
+
+class Watch(unittest.TestCase):
+    """Changed files are appended to the archive, which is compacted when it has too much dead data"""
+
+    def write(self, path, data):
+        with open(path, 'wb') as file:
+            file.write(data)
+        os.utime(path, ns=(time.time_ns() + 10 ** 9,) * 2)  # Changed even within the resolution of the clock
+
+    def read_all(self, archive):
+        with XP3(archive, silent=True) as xp3:
+            return {file.file_path: file.read() for file in xp3}
+
+    def test(self):
+        import random
+        from unittest import mock
+        from xp3 import watch, merge
+        from xp3.fsck import fsck
+        with tempfile.TemporaryDirectory() as xp3dir:
+            folder = os.path.join(xp3dir, 'patch')
+            archive = os.path.join(xp3dir, 'patch.xp3')
+            os.makedirs(os.path.join(folder, 'scenario'))
+            self.write(os.path.join(folder, 'scenario', 'first.ks'), b'*start\nHello\n')
+            self.write(os.path.join(folder, 'image.bin'), random.randbytes(1000))
+            watcher = watch.Watcher(folder, archive, debounce=0, silent=True)
+            watcher.sync()
+            self.assertEqual(['image.bin', 'scenario/first.ks'], sorted(self.read_all(archive)))
+
+            self.write(os.path.join(folder, 'scenario', 'first.ks'), b'*start\nHello again\n')
+            self.write(os.path.join(folder, 'scenario', 'second.ks'), b'*start\nBye\n')
+            os.remove(os.path.join(folder, 'image.bin'))
+            self.assertFalse(watcher.poll())  # Waits for the folder to stop changing
+            self.assertTrue(watcher.poll())
+            self.assertFalse(watcher.poll())
+            self.assertEqual({'scenario/first.ks': b'*start\nHello again\n', 'scenario/second.ks': b'*start\nBye\n'},
+                             self.read_all(archive))
+            self.assertEqual((2, []), fsck(archive))
+
+            # Nothing to do for an archive that is up to date
+            size = os.path.getsize(archive)
+            watch.Watcher(folder, archive, silent=True).sync()
+            self.assertEqual(size, os.path.getsize(archive))
+
+            with mock.patch.object(watch, 'COMPACT_MIN_SIZE', 0), \
+                    mock.patch.object(merge, 'rebuild', wraps=merge.rebuild) as rebuild:
+                for index in range(3):
+                    self.write(os.path.join(folder, 'scenario', 'first.ks'), random.randbytes(5000))
+                    watcher.poll()
+                    watcher.poll()
+                self.assertTrue(rebuild.called)
+            self.assertLess(os.path.getsize(archive), 3 * 5000)
+            self.assertEqual(2, len(self.read_all(archive)))
+            self.assertEqual((2, []), fsck(archive))
+
+            # A file gone before it is read leaves the archive as it was
+            files = self.read_all(archive)
+            with self.assertRaises(FileNotFoundError):
+                watch.update(archive, {'scenario/first.ks': os.path.join(folder, 'gone.ks')}, [])
+            self.assertEqual(files, self.read_all(archive))
+
+            # and the watcher tries again instead of stopping or forgetting the change
+            self.write(os.path.join(folder, 'scenario', 'second.ks'), b'*start\nBye again\n')
+            failures = [FileNotFoundError('gone.ks')]
+
+            def update(*args):
+                if failures:
+                    raise failures.pop()
+                return watch_update(*args)
+            watch_update = watch.update
+            with mock.patch.object(watch, 'update', update):
+                watcher.poll()
+                self.assertFalse(watcher.poll())
+                self.assertEqual(b'*start\nBye\n', self.read_all(archive)['scenario/second.ks'])
+                self.assertTrue(watcher.poll())
+            self.assertEqual(b'*start\nBye again\n', self.read_all(archive)['scenario/second.ks'])
+
+
+class TLG(unittest.TestCase):
+    """TLG5 and TLG6 images made by a minimal encoder are decoded and written as PNG while unpacking"""
+
+    def literals(self, data):
+        """LZSS data made only of literals"""
+        return b''.join(b'\x00' + data[start:start + 8] for start in range(0, len(data), 8))
+
+    def tlg5(self, pixels, block_height=4):
+        import struct, numpy
+        height, width, colors = pixels.shape
+        planes = pixels.transpose(2, 0, 1)[[2, 1, 0, 3][:colors]].astype(numpy.uint8)
+        planes = numpy.diff(planes, axis=1, prepend=numpy.uint8(0))
+        planes = numpy.diff(planes, axis=2, prepend=numpy.uint8(0))
+        planes[0] -= planes[1]
+        planes[2] -= planes[1]
+        blocks = b''
+        for y in range(0, height, block_height):
+            for color in range(colors):
+                data = planes[color, y:y + block_height].tobytes()
+                if color % 2:  # Some blocks compressed, some not
+                    data = self.literals(data)
+                blocks += struct.pack('<BI', 0 if color % 2 else 1, len(data)) + data
+        block_count = (height - 1) // block_height + 1
+        return b'TLG5.0\x00raw\x1a' + struct.pack('<B3I', colors, width, height, block_height) \
+            + bytes(4 * block_count) + blocks
+
+    def golomb(self, values):
+        """Bit pool of the values as the TLG6 encoder writes it"""
+        from xp3.tlg import GOLOMB_BIT_LENGTHS
+        bits = []
+
+        def write(value, count):
+            bits.extend(value >> bit & 1 for bit in range(count))
+
+        def gamma(count):
+            length = count.bit_length() - 1
+            write(1 << length, length + 1)
+            write(count, length)
+
+        values = [value - 256 if value > 127 else value for value in values]
+        write(values[0] != 0, 1)
+        n, a, index = 3, 0, 0
+        while index < len(values):
+            end = index
+            while end < len(values) and (values[end] == 0) == (values[index] == 0):
+                end += 1
+            gamma(end - index)
+            for value in values[index:end] if values[index] else ():
+                v = 2 * value - 1 if value > 0 else -2 * value - 2
+                k = GOLOMB_BIT_LENGTHS[n][a]
+                zeros = v >> k
+                if len(bits) % 8 + zeros >= 32:  # No set bit in the 32 bits the decoder reads, the count goes in a byte
+                    write(0, (len(bits) // 8 + 4) * 8 - len(bits))
+                    write(zeros, 8)
+                else:
+                    write(1 << zeros, zeros + 1)
+                write(v, k)
+                a += v >> 1
+                n -= 1
+                if n < 0:
+                    a >>= 1
+                    n = 3
+            index = end
+        return len(bits), bytes(int(''.join(map(str, reversed(bits[start:start + 8]))), 2)
+                                for start in range(0, len(bits), 8))
+
+    def tlg6(self, pixels, filters):
+        import struct, numpy
+        from xp3.tlg import CHROMA_TRANSFORMS, _block_order
+        height, width, colors = pixels.shape
+        planes = pixels.transpose(2, 0, 1)[[2, 1, 0, 3][:colors] if colors > 1 else [0]].astype(numpy.int16)
+        padded = numpy.zeros((colors, height + 1, width + 1), dtype=numpy.int16)
+        padded[:, 1:, 1:] = planes
+        left, up, up_left = padded[:, 1:, :-1], padded[:, :-1, 1:], padded[:, :-1, :-1]
+        low, high = numpy.minimum(left, up), numpy.maximum(left, up)
+        median = numpy.where(up_left >= high, low, numpy.where(up_left <= low, high, left + up - up_left))
+        block_filters = filters.repeat(8, 0).repeat(8, 1)[:height, :width]
+        residuals = (planes - numpy.where(block_filters & 1, (left + up + 1) >> 1, median)) & 0xFF
+        inverses = numpy.rint(numpy.linalg.inv(numpy.array(CHROMA_TRANSFORMS, dtype=float))).astype(numpy.int16)
+        if colors > 1:
+            residuals[:3] = numpy.einsum('hwij,jhw->ihw', inverses[block_filters >> 1], residuals[:3]) & 0xFF
+
+        data = b''
+        for y in range(0, height, 8):
+            rows = min(8, height - y)
+            order = _block_order(rows, width)
+            for color in range(colors):
+                values = numpy.zeros(rows * width, dtype=numpy.int16)
+                values[order.ravel()] = residuals[color, y:y + rows].ravel()
+                bit_length, pool = self.golomb(values.tolist())
+                data += struct.pack('<I', bit_length) + pool
+        filter_data = self.literals(filters.astype(numpy.uint8).tobytes())
+        return b'TLG6.0\x00raw\x1a' + struct.pack('<4B3I', colors, 0, 0, 0, width, height, 8) \
+            + struct.pack('<I', len(filter_data)) + filter_data + data
+
+    def smooth(self, height, width, colors):
+        import numpy
+        y, x = numpy.mgrid[:height, :width]
+        return numpy.stack([(x * (color + 1) + y * (3 - color) + (x * y) // 7) % 256
+                            for color in range(colors)], axis=2).astype(numpy.uint8)
+
+    def read_png(self, data):
+        import struct, numpy
+        self.assertEqual(b'\x89PNG\r\n\x1a\n', data[:8])
+        width, height, depth, color_type = struct.unpack_from('>IIBB', data, 16)
+        channels = {0: 1, 2: 3, 6: 4}[color_type]
+        idat_size, = struct.unpack_from('>I', data, 33)
+        rows = numpy.frombuffer(zlib.decompress(data[41:41 + idat_size]), dtype=numpy.uint8).reshape(height, -1)
+        self.assertTrue((rows[:, 0] == 1).all())
+        pixels = numpy.cumsum(rows[:, 1:].reshape(height, width, channels), axis=1, dtype=numpy.uint8)
+        return pixels
+
+    def test_lzss(self):
+        from xp3.tlg import _lzss
+        history = bytearray(4096)
+        # Two literals and a match of 10 bytes 2 bytes back, overlapping what it copies
+        self.assertEqual(12, _lzss(b'\x04ab\x00\x70', history, 0))
+        self.assertEqual(b'ab' * 6, history[4096:])
+
+    def test(self):
+        import numpy
+        from xp3.structs.file import numpy_available
+        if not numpy_available():
+            self.skipTest('numpy is not installed')
+        from xp3 import tlg
+        images = {'rgba5.tlg': self.smooth(13, 21, 4), 'rgb5.tlg': self.smooth(9, 8, 3),
+                  'rgba6.tlg': self.smooth(19, 21, 4), 'rgb6.tlg': self.smooth(16, 10, 3),
+                  'grey6.tlg': self.smooth(11, 12, 1), 'noise6.tlg': numpy.random.default_rng(0).integers(
+                      0, 256, (9, 17, 4), dtype=numpy.uint8)}
+        data = {}
+        for name, pixels in images.items():
+            if '5' in name:
+                data[name] = self.tlg5(pixels)
+            else:
+                height, width = pixels.shape[:2]
+                filters = numpy.arange(((height - 1) // 8 + 1) * ((width - 1) // 8 + 1)).reshape((height - 1) // 8 + 1, -1)
+                data[name] = self.tlg6(pixels, filters * 7 % (32 if pixels.shape[2] > 1 else 2))
+            self.assertTrue(numpy.array_equal(pixels, tlg.decode(data[name])), name)
+            self.assertTrue(numpy.array_equal(pixels, self.read_png(tlg.png(pixels))), name)
+        wrapped = b'TLG0.0\x00sds\x1a' + len(data['rgb6.tlg']).to_bytes(4, 'little') + data['rgb6.tlg'] + b'tags'
+        self.assertTrue(numpy.array_equal(images['rgb6.tlg'], tlg.decode(wrapped)))
+
+        with tempfile.TemporaryDirectory() as xp3dir:
+            archive = os.path.join(xp3dir, 'images.xp3')
+            with XP3(archive, mode='w', silent=True) as xp3:
+                for name, image in data.items():
+                    xp3.add('image/' + name, image)
+                xp3.add('image/broken.tlg', b'TLG6.0\x00raw\x1a' + bytes(10))
+                xp3.add('script.ks', b'*start\n')
+            with XP3(archive, silent=True) as xp3:
+                xp3.unpack(os.path.join(xp3dir, 'out'), convert_tlg='png')
+            out = os.path.join(xp3dir, 'out')
+            self.assertEqual(sorted([name[:-4] + '.png' for name in data] + ['broken.tlg']),
+                             sorted(os.listdir(os.path.join(out, 'image'))))
+            self.assertTrue(os.path.isfile(os.path.join(out, 'script.ks')))
+            with open(os.path.join(out, 'image', 'broken.tlg'), 'rb') as file:
+                self.assertEqual(b'TLG6.0\x00raw\x1a' + bytes(10), file.read())
+            for name, pixels in images.items():
+                with open(os.path.join(out, 'image', name[:-4] + '.png'), 'rb') as file:
+                    self.assertTrue(numpy.array_equal(pixels, self.read_png(file.read())), name)
+
+
+class Grep(unittest.TestCase):
+    """Search the decoded scripts of archives, with and without the trigram index"""
+
+    def test_literals(self):
+        import re
+        from xp3.grep import required_literals
+        self.assertEqual(['hello'], required_literals('hello'))
+        self.assertEqual(['colo', 'r world'], required_literals('colou?r world'))
+        self.assertEqual(['abcd'], required_literals('x{2,3}abcd'))
+        self.assertEqual(['.ks', 'name'], required_literals(r'\.ks\s+name'))
+        self.assertEqual([], required_literals('first|second'))
+        # Escapes stand for one character, the digits after them aren't literals
+        for pattern in (r'\x41BCD', r'\u0041BCD', r'\U00000041BCD', r'\N{LATIN CAPITAL LETTER A}BCD', r'\101BCD'):
+            self.assertEqual(['ABCD'], required_literals(pattern), pattern)
+        self.assertEqual(['ab\0cd'], required_literals(r'ab\0cd'))
+        self.assertEqual(['abc'], required_literals(r'\d+abc\b'))
+        # Classes and verbose patterns are read like the re module does
+        self.assertEqual(['cde'], required_literals(r'[a\]b]cde'))
+        self.assertEqual(['abc'], required_literals(r'[^]x]abc'))
+        self.assertEqual(['abcd'], required_literals(r'(?x) ab cd'))
+        self.assertEqual(['abcd'], required_literals(r'ab cd', re.VERBOSE))
+        self.assertEqual(['abcdef'], required_literals(r'ab(cd)ef'))
+
+    def test_escapes(self):
+        import re
+        from xp3.grep import grep, TextIndex
+        with tempfile.TemporaryDirectory() as xp3dir:
+            archive = os.path.join(xp3dir, 'data.xp3')
+            with XP3(archive, mode='w', silent=True) as xp3:
+                xp3.add('scenario/first.txt', '*start\nABCD\n\tあいう\nxacde zabc\n'.encode('utf-8'))
+            with TextIndex(os.path.join(xp3dir, 'index.sqlite'), silent=True) as index:
+                index.update([archive])
+                for pattern, line in ((r'\x41BCD', 2), (r'\u3042いう', 3), (r'\N{HIRAGANA LETTER A}いう', 3),
+                                      (r'\101BC', 2), (r'\tあい', 3), (r'\x41B\x43', 2),
+                                      (r'[a\]b]cde', 4), (r'[^]x]abc', 4), (r'(?x) za bc', 4)):
+                    expected = [(archive, 'scenario/first.txt', line)]
+                    self.assertEqual(expected, [found[:3] for found in grep(re.compile(pattern), [archive])], pattern)
+                    self.assertEqual(expected, [found[:3] for found in index.search(re.compile(pattern))], pattern)
+
+    def test(self):
+        import re
+        from xp3.grep import grep, TextIndex
+        with tempfile.TemporaryDirectory() as xp3dir:
+            first = os.path.join(xp3dir, 'first.xp3')
+            second = os.path.join(xp3dir, 'second.xp3')
+            with XP3(first, mode='w', silent=True) as xp3:
+                # Scrambled UTF-16, Shift-JIS and a file that isn't a script, all encrypted
+                xp3.add('scenario/start.ks', '*start\r\n吾輩は猫である。\r\n名前はまだ無い。\r\n'.encode('utf-16'), 'p1neg')
+                xp3.add('system/titles.csv', 'var title = "猫の物語";\n'.encode('cp932'), 'p1neg')
+                xp3.add('image/cat.png', '猫である'.encode('utf-16'))
+            with XP3(second, mode='w', silent=True) as xp3:
+                xp3.add('system/titles.csv', 'var title = "猫の物語";\n'.encode('cp932'), 'p1neg')
+
+            found = list(grep(re.compile('猫'), [first, second], workers=2, cypher='p1neg'))
+            self.assertEqual([(first, 'scenario/start.ks', 2, '吾輩は猫である。'),
+                              (first, 'system/titles.csv', 1, 'var title = "猫の物語";'),
+                              (second, 'system/titles.csv', 1, 'var title = "猫の物語";')], sorted(found))
+
+            with TextIndex(os.path.join(xp3dir, 'index.sqlite'), silent=True) as index:
+                self.assertEqual((2, 2), index.update([first, second], cypher='p1neg'))  # Same config read once
+                self.assertEqual((0, 0), index.update([first, second], cypher='p1neg'))
+                self.assertEqual(sorted(found), list(index.search(re.compile('猫'))))
+                self.assertEqual([(first, 'scenario/start.ks', 3, '名前はまだ無い。')],
+                                 list(index.search(re.compile('名前は'))))
+                self.assertEqual([(second, 'system/titles.csv', 1, 'var title = "猫の物語";')],
+                                 list(index.search(re.compile('TITLE', re.IGNORECASE), [second])))
+                self.assertEqual([], list(index.search(re.compile('猫の名前'))))
+
+                time.sleep(0.01)
+                with XP3(second, mode='w', silent=True) as xp3:
+                    xp3.add('system/titles.csv', 'var title = "猫の物語";\n'.encode('cp932'), 'p1neg')
+                    xp3.add('scenario/end.ks', '*end\n名前はまだ無い。\n'.encode('utf-16'), 'p1neg')
+                self.assertEqual((1, 1), index.update([first, second], cypher='p1neg'))
+                self.assertEqual([first, second], [archive for archive, *_ in index.search(re.compile('名前は'))])
+
+                os.remove(first)
+                index.update([second], cypher='p1neg')
+                self.assertEqual([second], [archive for archive, *_ in index.search(re.compile('名前は'))])
+                self.assertEqual(2, index.connection.execute('SELECT COUNT(*) FROM texts').fetchone()[0])
+
+
+class IOPolicy(unittest.TestCase):
+    """Read ahead and drop hints given to the OS from the planned order of the reads"""
+
+    def advised(self, fadvise, advice):
+        return [call.args[1:3] for call in fadvise.call_args_list if call.args[3] == advice]
+
+    def test(self):
+        import random
+        from unittest import mock
+        if not hasattr(os, 'posix_fadvise'):
+            self.skipTest('posix_fadvise is not available')
+        with tempfile.TemporaryDirectory() as xp3dir:
+            archive = os.path.join(xp3dir, 'data.xp3')
+            with XP3(archive, mode='w', silent=True) as xp3:
+                for index in range(8):
+                    xp3.add('file{}.bin'.format(index), random.randbytes(1000))
+            with XP3(archive, silent=True) as xp3:
+                ranges = [(file.segm.segments[0].offset, file.segm.segments[0].compressed_size) for file in xp3]
+
+            with mock.patch('os.posix_fadvise', wraps=os.posix_fadvise) as fadvise:
+                with XP3(archive, silent=True, io_policy='sequential') as xp3:
+                    xp3.io_policy.readahead = 2500
+                    self.assertEqual([(0, 0)], self.advised(fadvise, os.POSIX_FADV_SEQUENTIAL))
+                    xp3['file0.bin'].read()
+                    self.assertEqual(ranges[:4], self.advised(fadvise, os.POSIX_FADV_WILLNEED))
+                    xp3['file1.bin'].read()
+                    self.assertEqual(ranges[:5], self.advised(fadvise, os.POSIX_FADV_WILLNEED))
+                    self.assertEqual([], self.advised(fadvise, os.POSIX_FADV_DONTNEED))
+
+            with mock.patch('os.posix_fadvise', wraps=os.posix_fadvise) as fadvise:
+                with XP3(archive, silent=True, io_policy='random') as xp3:
+                    self.assertEqual(1000, len(b''.join(xp3['file5.bin'].stream())))
+                    xp3['file2.bin'].read()
+                self.assertEqual([ranges[5], ranges[2]], self.advised(fadvise, os.POSIX_FADV_WILLNEED))
+
+            # A one pass extraction drops what it read, the skipped files are never read ahead
+            with mock.patch('os.posix_fadvise', wraps=os.posix_fadvise) as fadvise:
+                with XP3(archive, silent=True, io_policy='once') as xp3:
+                    xp3.unpack(os.path.join(xp3dir, 'out'), filter=lambda path: path != 'file3.bin')
+                selected = ranges[:3] + ranges[4:]
+                self.assertEqual(selected, self.advised(fadvise, os.POSIX_FADV_WILLNEED))
+                self.assertEqual(selected, self.advised(fadvise, os.POSIX_FADV_DONTNEED))
+            self.assertEqual(7, len(os.listdir(os.path.join(xp3dir, 'out'))))
+
+
+class Batch(unittest.TestCase):
+    """Several archives processed by a pool of workers"""
+
+    def test(self):
+        import argparse, contextlib, io
+        from xp3.batch import expand_inputs, output_path, run_jobs
+        with tempfile.TemporaryDirectory() as xp3dir:
+            for name in ('first', 'second'):
+                with XP3(os.path.join(xp3dir, name + '.xp3'), mode='w', silent=True) as xp3:
+                    xp3.add(name + '.txt', name.encode())
+            with open(os.path.join(xp3dir, 'broken.xp3'), 'wb') as file:
+                file.write(b'not an archive')
+
+            inputs = expand_inputs([xp3dir])
+            self.assertEqual(['broken.xp3', 'first.xp3', 'second.xp3'], [os.path.basename(path) for path in inputs])
+            self.assertEqual(inputs[1:], expand_inputs([os.path.join(xp3dir, '*st.xp3'), os.path.join(xp3dir, 's*')]))
+
+            args = argparse.Namespace(zlib='auto', key='', cypher='none', silent=True, index=False, include=[],
+                                      exclude=[], include_regex=[], exclude_regex=[])
+            output = os.path.join(xp3dir, 'out')
+            with contextlib.redirect_stdout(io.StringIO()):
+                jobs = [('unpack', input, output_path('unpack', input, output, True), args) for input in inputs]
+                self.assertEqual(1, run_jobs(jobs, 2, silent=True))
+                self.assertEqual(0, run_jobs(jobs[1:], 2, silent=True))
+            for name in ('first', 'second'):
+                with open(os.path.join(output, name, name + '.txt'), 'rb') as file:
+                    self.assertEqual(name.encode(), file.read())
+
+
+class ImportTime(unittest.TestCase):
+    """The command line tool has to start fast, heavy modules are imported only when needed"""
+
+    budget = 0.1  # seconds for importing the package and everything it imports
+
+    def import_times(self):
+        """Module names mapped to (imported at the top level, cumulative import time in microseconds)"""
+        import subprocess, sys
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-m', 'xp3'], cwd=root,
+                                capture_output=True, text=True)
+        times = {}
+        for line in result.stderr.splitlines():
+            if not line.startswith('import time:'):
+                continue
+            self_time, cumulative, name = line[len('import time:'):].split('|')
+            if cumulative.strip().isdigit():  # Skip the header
+                times[name.strip()] = (not name[1:].startswith(' '), int(cumulative))
+        return times
+
+    def test(self):
+        self.import_times()  # Let the first run compile the modules
+        times = self.import_times()
+        self.assertIn('xp3.xp3', times)
+        self.assertNotIn('numpy', times)
+        self.assertNotIn('urllib.request', times)  # Only for remote archives, it imports http.client and ssl
+        total = sum(cumulative for name, (top_level, cumulative) in times.items()
+                    if top_level and name.split('.')[0] == 'xp3')
+        self.assertLess(total / 1e6, self.budget)
+
+
 if __name__ == '__main__':
     unittest.main()
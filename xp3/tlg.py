@@ -0,0 +1,345 @@
+"""
+Decoder of the TLG5 and TLG6 images of KiriKiri (and of TLG0 containers of them) and a minimal PNG writer.
+The entropy decoding (LZSS and Golomb codes) is sequential by nature and done in Python on precomputed
+bit tables, the color transforms and the filters are done on whole images with numpy.
+Experimental: only tested on images from the encoder in the tests, not on images made by the KiriKiri tools
+"""
+import os, struct, zlib
+
+TLG0_MAGIC = b'TLG0.0\x00sds\x1a'
+TLG5_MAGIC = b'TLG5.0\x00raw\x1a'
+TLG6_MAGIC = b'TLG6.0\x00raw\x1a'
+TEXT_SIZE = 4096  # LZSS window
+BLOCK_SIZE = 8  # TLG6 filter blocks are 8x8 pixels
+GOLOMB_N_COUNT = 4
+GOLOMB_COMPRESSED = ((3, 7, 15, 27, 63, 108, 223, 448, 130),
+                     (3, 5, 13, 24, 51, 95, 192, 384, 257),
+                     (2, 5, 12, 21, 39, 86, 155, 320, 384),
+                     (2, 3, 9, 18, 33, 61, 129, 258, 511))
+# Bit length of the Golomb codes by the number of codes left before the sum is halved and the sum of the values
+GOLOMB_BIT_LENGTHS = [[length for length, count in enumerate(counts) for _ in range(count)] for counts in GOLOMB_COMPRESSED]
+# Blue, green and red of the TLG6 color transforms from the blue, green and red residuals
+CHROMA_TRANSFORMS = (
+    ((1, 0, 0), (0, 1, 0), (0, 0, 1)),
+    ((1, 1, 0), (0, 1, 0), (0, 1, 1)),
+    ((1, 0, 0), (1, 1, 0), (1, 1, 1)),
+    ((1, 1, 1), (0, 1, 1), (0, 0, 1)),
+    ((1, 0, 1), (1, 1, 1), (1, 1, 2)),
+    ((1, 0, 1), (1, 1, 1), (0, 0, 1)),
+    ((1, 1, 0), (0, 1, 0), (0, 0, 1)),
+    ((1, 0, 0), (1, 1, 0), (0, 0, 1)),
+    ((1, 0, 0), (0, 1, 0), (0, 1, 1)),
+    ((2, 1, 1), (1, 1, 1), (1, 0, 1)),
+    ((1, 0, 1), (0, 1, 1), (0, 0, 1)),
+    ((1, 0, 0), (1, 1, 0), (1, 0, 1)),
+    ((1, 0, 0), (1, 1, 1), (1, 0, 1)),
+    ((1, 1, 0), (1, 2, 1), (1, 1, 1)),
+    ((1, 1, 1), (0, 1, 1), (1, 1, 2)),
+    ((1, 0, 0), (2, 1, 0), (2, 0, 1)),
+)
+
+
+def is_tlg(data) -> bool:
+    return data[:len(TLG5_MAGIC)] in (TLG0_MAGIC, TLG5_MAGIC, TLG6_MAGIC)
+
+
+def decode(data):
+    """
+    Decode a TLG5 or TLG6 image
+    :return: Pixels as a numpy array of (height, width, channels) bytes, in grey, RGB or RGBA
+    """
+    if data.startswith(TLG0_MAGIC):
+        size, = struct.unpack_from('<I', data, len(TLG0_MAGIC))
+        data = data[len(TLG0_MAGIC) + 4:len(TLG0_MAGIC) + 4 + size]
+    if data.startswith(TLG5_MAGIC):
+        return _decode_tlg5(data)
+    if data.startswith(TLG6_MAGIC):
+        return _decode_tlg6(data)
+    raise ValueError('Not a TLG5 or TLG6 image')
+
+
+def _lzss(data, history: bytearray, r: int) -> int:
+    """
+    Decompress the LZSS data of TLG images, appending it to the history, whose last 4096 bytes are the
+    window of the decompressor from its position r on
+    :return: New position in the window
+    """
+    position, end = 0, len(data)
+    while position < end:
+        flags = data[position]
+        position += 1
+        if not flags:  # 8 literals
+            literals = data[position:position + 8]
+            history += literals
+            position += len(literals)
+            r = (r + len(literals)) & (TEXT_SIZE - 1)
+            continue
+        for bit in range(8):
+            if position >= end:
+                break
+            if flags >> bit & 1:
+                mpos = data[position] | (data[position + 1] & 0x0F) << 8
+                length = (data[position + 1] >> 4) + 3
+                position += 2
+                if length == 18:
+                    length += data[position]
+                    position += 1
+                distance = (r - mpos) & (TEXT_SIZE - 1) or TEXT_SIZE
+                start = len(history) - distance
+                if distance >= length:
+                    history += history[start:start + length]
+                else:  # Repeats what it's copying
+                    history += (history[start:] * (length // distance + 1))[:length]
+                r = (r + length) & (TEXT_SIZE - 1)
+            else:
+                history.append(data[position])
+                position += 1
+                r = (r + 1) & (TEXT_SIZE - 1)
+    return r
+
+
+def _decode_tlg5(data):
+    import numpy
+    colors = data[len(TLG5_MAGIC)]
+    width, height, block_height = struct.unpack_from('<3I', data, len(TLG5_MAGIC) + 1)
+    if colors not in (3, 4):
+        raise ValueError(f'Unsupported number of TLG5 colors {colors}')
+    position = len(TLG5_MAGIC) + 13 + ((height - 1) // block_height + 1) * 4  # Skip the block sizes
+
+    # Blue, green, red and alpha differences
+    planes = numpy.empty((colors, height, width), dtype=numpy.uint8)
+    history = bytearray(TEXT_SIZE)
+    r = 0
+    for y in range(0, height, block_height):
+        rows = min(block_height, height - y)
+        for color in range(colors):
+            mark, size = struct.unpack_from('<BI', data, position)
+            block = data[position + 5:position + 5 + size]
+            position += 5 + size
+            if mark == 0:
+                start = len(history)
+                r = _lzss(block, history, r)
+                block = history[start:]
+                del history[:-TEXT_SIZE]
+            planes[color, y:y + rows] = numpy.frombuffer(block, dtype=numpy.uint8, count=rows * width).reshape(rows, width)
+
+    planes[0] += planes[1]
+    planes[2] += planes[1]
+    # Every pixel is the sum of the differences to the left of it and above it
+    planes = numpy.cumsum(numpy.cumsum(planes, axis=2, dtype=numpy.uint8), axis=1, dtype=numpy.uint8)
+    return numpy.stack([planes[2], planes[1], planes[0]] + ([planes[3]] if colors == 4 else []), axis=2)
+
+
+def _golomb_values(pool: bytes, count: int) -> bytearray:
+    """Decode count values of the Golomb coded bit pool of a TLG6 block row, as bytes"""
+    import numpy
+    pool = bytes(pool) + bytes(8)  # The decoder reads 32 bits at a time
+    bits = numpy.unpackbits(numpy.frombuffer(pool, dtype=numpy.uint8), bitorder='little')
+    ones = numpy.append(numpy.flatnonzero(bits), len(bits) + 64)
+    # Position of the next set bit and value of the next 8 bits from every position
+    next_one = ones[numpy.searchsorted(ones, numpy.arange(len(bits)))].tolist()
+    padded = numpy.append(bits, numpy.zeros(8, dtype=numpy.uint8)).astype(numpy.uint16)
+    window = sum(padded[shift:shift + len(bits)] << shift for shift in range(8)).tolist()
+
+    values = bytearray(count)
+    zero = not pool[0] & 1
+    position = 1
+    index = 0
+    n = GOLOMB_N_COUNT - 1
+    a = 0
+    while index < count:
+        # Run length of zero or non-zero values, gamma coded
+        one = next_one[position]
+        length = one - position
+        position = one + 1
+        run = (1 << length) + (int.from_bytes(pool[position >> 3:(position >> 3) + 4], 'little')
+                               >> (position & 7) & ((1 << length) - 1))
+        position += length
+        if zero:
+            index += run
+        else:
+            for index in range(index, min(index + run, count)):
+                k = GOLOMB_BIT_LENGTHS[n][a]
+                one = next_one[position]
+                if one >= (position & ~7) + 32:  # No set bit in the next 32, the count is in the 5th byte
+                    byte = (position >> 3) + 5
+                    length = pool[byte - 1]
+                    position = byte * 8
+                else:
+                    length = one - position
+                    position = one + 1
+                v = (length << k) + (window[position] & ((1 << k) - 1))
+                position += k
+                a += v >> 1
+                values[index] = ((v >> 1) + 1 if v & 1 else -(v >> 1) - 1) & 0xFF
+                n -= 1
+                if n < 0:
+                    a >>= 1
+                    n = GOLOMB_N_COUNT - 1
+            index += 1
+        zero = not zero
+    return values
+
+
+def _block_order(rows: int, width: int):
+    """
+    Position in the Golomb values of every pixel of a TLG6 block row: the values go block by block,
+    the rows of odd blocks bottom to top and odd rows right to left
+    """
+    import numpy
+    x = numpy.arange(width)
+    block = x // BLOCK_SIZE
+    block_width = numpy.minimum(BLOCK_SIZE, width - block * BLOCK_SIZE)
+    y = numpy.arange(rows)[:, None]
+    row = numpy.where(block % 2 == 1, rows - 1 - y, y)
+    column = numpy.where(y % 2 == 1, block_width - 1 - x % BLOCK_SIZE, x % BLOCK_SIZE)
+    return block * rows * BLOCK_SIZE + row * block_width + column
+
+
+def _reconstruct(residuals, average):
+    """
+    Undo the prediction of the TLG6 filters, each pixel is predicted from the left, upper and upper left ones
+    by the median edge detector or their average, anti-diagonals at a time as they don't depend on each other
+    :param residuals: (channels, height, width) array of the prediction errors
+    :param average: (height, width) array, True where the average is used
+    """
+    import numpy
+    channels, height, width = residuals.shape
+    pixels = numpy.zeros((channels, height + 1, width + 1), dtype=numpy.int16)  # Zeros above and left of the image
+    residuals = residuals.astype(numpy.int16)
+    for diagonal in range(height + width - 1):
+        y = numpy.arange(max(0, diagonal - width + 1), min(height - 1, diagonal) + 1)
+        x = diagonal - y
+        left, up, up_left = pixels[:, y + 1, x], pixels[:, y, x + 1], pixels[:, y, x]
+        low, high = numpy.minimum(left, up), numpy.maximum(left, up)
+        median = numpy.where(up_left >= high, low, numpy.where(up_left <= low, high, left + up - up_left))
+        prediction = numpy.where(average[y, x], (left + up + 1) >> 1, median)
+        pixels[:, y + 1, x + 1] = (prediction + residuals[:, y, x]) & 0xFF
+    return pixels[:, 1:, 1:].astype(numpy.uint8)
+
+
+def _decode_tlg6(data):
+    import numpy
+    colors, data_flag, color_type, external_golomb_table = data[len(TLG6_MAGIC):len(TLG6_MAGIC) + 4]
+    width, height, max_bit_length = struct.unpack_from('<3I', data, len(TLG6_MAGIC) + 4)
+    if colors not in (1, 3, 4) or data_flag or color_type or external_golomb_table:
+        raise ValueError('Unsupported TLG6 variant')
+    x_blocks = (width - 1) // BLOCK_SIZE + 1
+    y_blocks = (height - 1) // BLOCK_SIZE + 1
+
+    # Filter of each block, LZSS compressed with a window made of a pattern
+    position = len(TLG6_MAGIC) + 16
+    size, = struct.unpack_from('<I', data, position)
+    history = bytearray(b''.join(bytes((i,) * 4 + (j,) * 4) for i in range(32) for j in range(16)))
+    _lzss(data[position + 4:position + 4 + size], history, 0)
+    filters = numpy.frombuffer(history, dtype=numpy.uint8, count=x_blocks * y_blocks, offset=TEXT_SIZE)
+    position += 4 + size
+
+    # Blue, green, red and alpha prediction errors
+    residuals = numpy.zeros((4, height, width), dtype=numpy.uint8)
+    orders = {}
+    for y in range(0, height, BLOCK_SIZE):
+        rows = min(BLOCK_SIZE, height - y)
+        if rows not in orders:
+            orders[rows] = _block_order(rows, width)
+        for color in range(colors):
+            bit_length, = struct.unpack_from('<I', data, position)
+            position += 4
+            if bit_length >> 30:
+                raise ValueError('Unsupported TLG6 entropy coding')
+            size = (bit_length + 7) // 8
+            values = numpy.frombuffer(_golomb_values(data[position:position + size], rows * width), dtype=numpy.uint8)
+            residuals[color, y:y + rows] = values[orders[rows]]
+            position += size
+
+    filters = filters.reshape(y_blocks, x_blocks).repeat(BLOCK_SIZE, 0).repeat(BLOCK_SIZE, 1)[:height, :width]
+    transforms = numpy.array(CHROMA_TRANSFORMS, dtype=numpy.int16)[filters >> 1]  # (height, width, 3, 3)
+    residuals[:3] = numpy.einsum('hwij,jhw->ihw', transforms, residuals[:3].astype(numpy.int16)) & 0xFF
+    channels = 4 if colors == 4 else 3
+    planes = _reconstruct(residuals[:channels], (filters & 1).astype(bool))
+    if colors == 1:
+        return planes[0][:, :, None]
+    if colors == 3:
+        return numpy.stack([planes[2], planes[1], planes[0]], axis=2)
+    return numpy.stack([planes[2], planes[1], planes[0], planes[3]], axis=2)
+
+
+def png(pixels, level: int = 6) -> bytes:
+    """PNG file of the (height, width, channels) pixels, grey, RGB or RGBA"""
+    import numpy
+    from .structs import codec
+    height, width, channels = pixels.shape
+    color_type = {1: 0, 3: 2, 4: 6}[channels]
+    # Every row with the Sub filter: the difference to the same channel of the pixel on the left
+    pixels = pixels.reshape(height, width * channels)
+    rows = numpy.empty((height, width * channels + 1), dtype=numpy.uint8)
+    rows[:, 0] = 1
+    rows[:, 1:channels + 1] = pixels[:, :channels]
+    rows[:, channels + 1:] = pixels[:, channels:] - pixels[:, :-channels]
+
+    def chunk(kind: bytes, body: bytes) -> bytes:
+        return struct.pack('>I', len(body)) + kind + body + struct.pack('>I', zlib.crc32(kind + body))
+
+    return b'\x89PNG\r\n\x1a\n' \
+        + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, color_type, 0, 0, 0)) \
+        + chunk(b'IDAT', codec.compress(rows.tobytes(), level)) \
+        + chunk(b'IEND', b'')
+
+
+def convert_file(data, path: str) -> str:
+    """Write a TLG image as a PNG file"""
+    _write(png(decode(data)), path)
+    return path
+
+
+def _write(data, path: str):
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as output:
+        output.write(data)
+
+
+class Converter:
+    """
+    Converts TLG images to PNG files in a pool of processes while the archive is unpacked,
+    the images that can't be decoded are written as they are
+    """
+
+    def __init__(self, workers: int = None, silent: bool = False):
+        from concurrent.futures import ProcessPoolExecutor
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = ProcessPoolExecutor(self.workers)
+        self.silent = silent
+        self.pending = {}
+        self.converted = 0
+
+    def submit(self, data, path: str):
+        """:param path: Path of the TLG file, the PNG file is written next to it"""
+        from concurrent.futures import wait, FIRST_COMPLETED
+        if not is_tlg(data):  # Some games keep other images under the .tlg extension
+            _write(data, path)
+            return
+        # Don't hold too many images in memory
+        if len(self.pending) >= self.workers * 2:
+            done, _ = wait(self.pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                self._finish(future)
+        future = self.executor.submit(convert_file, data, os.path.splitext(path)[0] + '.png')
+        self.pending[future] = (data, path)
+
+    def _finish(self, future):
+        data, path = self.pending.pop(future)
+        try:
+            future.result()
+            self.converted += 1
+        except Exception as error:  # Unknown variant or corrupted image
+            if not self.silent:
+                print("! Can't convert {}: {}".format(path, error or type(error).__name__))
+            _write(data, path)
+
+    def close(self) -> int:
+        """Wait for the conversions, returns the number of converted images"""
+        for future in list(self.pending):
+            self._finish(future)
+        self.executor.shutdown()
+        return self.converted
@@ -0,0 +1,171 @@
+import os, time, struct
+from .xp3writer import XP3Writer
+from .structs import XP3Signature, XP3FileIndex, codec
+from .estimate import folder_files, HEADER_SIZE
+
+COMPACT_RATIO = 0.5  # Rebuild the archive when more than half of it is dead data
+COMPACT_MIN_SIZE = 1 << 20  # but not for less than 1 MiB of it
+
+
+def snapshot(folder: str, flatten: bool = False) -> dict:
+    """:return: Dictionary of internal path -> (file path, size, modification time) of the files in the folder"""
+    files = {}
+    for file_path, internal_path in folder_files(folder, flatten):
+        try:
+            stat = os.stat(file_path)
+        except OSError:  # Removed while scanning
+            continue
+        files[internal_path] = (file_path, stat.st_size, stat.st_mtime_ns)
+    return files
+
+
+def update(archive: str, changed: dict, removed: list, encryption_type: str = None) -> int:
+    """
+    Append the changed files to the archive and write a new file index after them,
+    the data of the replaced and removed files is left in the archive as dead space
+    :param changed: Dictionary of internal path -> file path of the changed and added files
+    :param removed: Internal paths of the removed files
+    :return: Size of the dead data in the archive
+    """
+    # Read everything first, a file removed since the snapshot leaves the archive untouched
+    data = {}
+    for internal_path, file_path in changed.items():
+        with open(file_path, 'rb') as file:
+            data[internal_path] = file.read()
+    with open(archive, 'r+b') as buffer, XP3Writer(buffer, silent=True, append=True) as xp3:
+        for internal_path in list(changed) + list(removed):
+            try:
+                xp3.remove(internal_path)
+            except KeyError:  # Added
+                pass
+        for internal_path, file_data in data.items():
+            xp3.add(internal_path, file_data, encryption_type)
+        xp3.pack_up()
+        # Segments shared by several files are counted once
+        live_size = sum(size for _, size in {(segment.offset, segment.compressed_size)
+                                             for entry in xp3.iter_entries() for segment in entry.segm})
+        buffer.seek(len(XP3Signature))
+        index_offset, = struct.unpack('<Q', buffer.read(8))
+    return index_offset - HEADER_SIZE - live_size
+
+
+class Watcher:
+    """Keeps an archive up to date with a folder by polling the sizes and modification times of its files"""
+
+    def __init__(self, folder: str, archive: str, encryption_type: str = None, flatten: bool = False,
+                 debounce: float = 0.3, compact_ratio: float = COMPACT_RATIO, silent: bool = False):
+        """
+        :param debounce: Seconds the folder must stay unchanged before the archive is updated
+        :param compact_ratio: Part of the archive that can be dead data before it is rebuilt
+        """
+        self.folder = os.path.normpath(folder)
+        self.archive = archive
+        self.encryption_type = encryption_type
+        self.flatten = flatten
+        self.debounce = debounce
+        self.compact_ratio = compact_ratio
+        self.silent = silent
+        self.files = {}  # Snapshot of the folder the archive is up to date with
+        self.pending = None  # Snapshot with changes that aren't in the archive yet
+        self.last_change = 0.0
+
+    def sync(self):
+        """Bring the archive up to date with the folder, the files already in it are compared by checksum"""
+        files = snapshot(self.folder, self.flatten)
+        checksums = {}
+        if os.path.isfile(self.archive):
+            with open(self.archive, 'rb') as buffer:
+                if XP3Signature != buffer.read(len(XP3Signature)):
+                    raise AssertionError('The data is not an XP3 file')
+                checksums = {entry.file_path: entry.adler32 for entry in XP3FileIndex.read_from(buffer)}
+        else:
+            with XP3Writer(open(self.archive, 'wb'), silent=True):
+                pass
+
+        self.files = {}
+        for internal_path, file in files.items():
+            if internal_path in checksums:
+                with open(file[0], 'rb') as data:
+                    if codec.adler32(data.read()) == checksums[internal_path]:
+                        self.files[internal_path] = file
+        self.apply(files, [path for path in checksums if path not in files])
+
+    def poll(self) -> bool:
+        """Check the folder once, the archive is updated after it stops changing, returns True if it was"""
+        files = snapshot(self.folder, self.flatten)
+        now = time.monotonic()
+        if files != (self.files if self.pending is None else self.pending):
+            self.pending = files
+            self.last_change = now
+            return False
+        if self.pending is None or now - self.last_change < self.debounce:
+            return False
+        try:
+            self.apply(self.pending, [path for path in self.files if path not in self.pending])
+        except OSError as error:  # A file changed again while being read, e.g. saved through a temporary file
+            if not self.silent:
+                print('! Update failed, retrying: {}'.format(error))
+            self.last_change = now
+            return False
+        self.pending = None
+        return True
+
+    def apply(self, files: dict, removed: list):
+        """Update the archive with the files that differ from the last snapshot and remove the others"""
+        start = time.perf_counter()
+        changed = {path: file[0] for path, file in files.items() if self.files.get(path) != file}
+        if not changed and not removed:
+            self.files = files
+            return
+        dead_size = update(self.archive, changed, removed, self.encryption_type)
+        self.files = files  # Only once the archive has the files, a failed update is retried in full
+        if not self.silent:
+            print('| Updated {} file(s), removed {} in {:.2f} s'.format(len(changed), len(removed),
+                                                                      time.perf_counter() - start))
+        size = os.path.getsize(self.archive)
+        if dead_size > COMPACT_MIN_SIZE and dead_size > size * self.compact_ratio:
+            from .merge import rebuild
+            rebuild(self.archive, silent=True)
+            if not self.silent:
+                print('| Compacted {} ({} → {} bytes)'.format(self.archive, size, os.path.getsize(self.archive)))
+
+    def run(self, interval: float = 0.5):
+        """Poll the folder until interrupted"""
+        self.sync()
+        if not self.silent:
+            print('Watching {} → {} (Ctrl+C to stop)'.format(self.folder, self.archive))
+        try:
+            while True:
+                time.sleep(interval)
+                self.poll()
+        except KeyboardInterrupt:
+            pass
+
+
+def watch_main(argv: list):
+    import argparse
+    from .xp3 import set_key
+    from .structs import encryption_parameters
+    parser = argparse.ArgumentParser(prog='xp3 watch',
+                                     description='Keep an archive up to date with a folder, changed files are appended '
+                                                 'to it and the archive is rebuilt when too much of it is dead data')
+    parser.add_argument('folder', help='Folder to watch')
+    parser.add_argument('archive', help='Archive to update (created if missing)')
+    parser.add_argument('-c', '--cypher', choices=encryption_parameters.keys(), default='none',
+                        help='Encryption type (default: none)')
+    parser.add_argument('-k', '--key', help='Hex key of the hiddenb cypher (e.g. 5a17c3e809)')
+    parser.add_argument('-f', '--flatten', action='store_true', default=False, help='Ignore the folders')
+    parser.add_argument('-i', '--interval', type=float, default=0.5, help='Seconds between checks (default: 0.5)')
+    parser.add_argument('--debounce', type=float, default=0.3,
+                        help='Seconds the folder must stay unchanged before the archive is updated (default: 0.3)')
+    parser.add_argument('--compact', type=float, default=COMPACT_RATIO, metavar='RATIO',
+                        help='Part of the archive that can be dead data before it is rebuilt (default: 0.5)')
+    parser.add_argument('-s', '--silent', action='store_true', default=False)
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.folder):
+        print('ERROR: {} is not a folder'.format(args.folder))
+        return 2
+    cypher = set_key(args.key) if args.key else args.cypher
+    Watcher(args.folder, args.archive, cypher, args.flatten, args.debounce, args.compact, args.silent).run(args.interval)
+    return 0
@@ -2,18 +2,31 @@
 import os, re
 from .xp3reader import XP3Reader
 from .xp3writer import XP3Writer
+from .remote import is_url
 
 class XP3(XP3Reader, XP3Writer):
-    def __init__(self, target, mode='r', silent=False):
+    def __init__(self, target, mode='r', silent=False, cache=None, io_policy=None):
+        """
+        :param cache: sharedcache.SharedCache to share the read files with other processes (reading only)
+        :param io_policy: 'sequential', 'random' or 'once', hints to the OS about the reads (reading only)
+        """
         self.mode = mode # for debugging convenience
         self.target = target
 
         if self._is_readmode:
-            if isinstance(target, str):
+            if is_url(target):
+                from .remote import HTTPRangeFile
+                self.target = HTTPRangeFile(target)
+            elif isinstance(target, str):
                 if not os.path.isfile(target):
                     raise FileNotFoundError
                 self.target = open(target, "rb")
-            XP3Reader.__init__(self, self.target, silent, use_numpy=True)
+            try:
+                XP3Reader.__init__(self, self.target, silent, use_numpy=True, cache=cache, io_policy=io_policy)
+            except Exception:
+                if isinstance(target, str):
+                    self.target.close()
+                raise
         elif self._is_writemode:
             if isinstance(target, str):
                 dir = os.path.dirname(target)
@@ -30,6 +43,9 @@ class XP3(XP3Reader, XP3Writer):
             if not self.packed_up:
                 self.pack_up()
             self.buffer.close()
+            self._index_spool.close()
+        elif self.io_policy:
+            self.io_policy.close()
         self.target.close()
 
     @property
@@ -60,12 +76,36 @@ class XP3(XP3Reader, XP3Writer):
         hash >>= 1
         return s
 
-    def unpack(self, to='', encryption_type="none"):
-        """Unpack all files in the archive to a specified folder"""
+    def unpack(self, to='', encryption_type="none", filter=None, convert_tlg=None):
+        """
+        Unpack the files in the archive to a specified folder
+        :param filter: Function taking an internal file path and returning True if the file should be unpacked,
+                       the data of the skipped files is never read
+        :param convert_tlg: 'png' to write the TLG images as PNG files, converted in parallel with the unpacking
+        """
         if not self._is_readmode:
             raise Exception("Archive is not open in reading mode")
 
-        for file in self:
+        converter = None
+        if convert_tlg:
+            from .tlg import Converter
+            converter = Converter(silent=self.silent)
+        try:
+            self._unpack(to, encryption_type, filter, converter)
+        finally:
+            if converter:
+                converted = converter.close()
+                if not self.silent:
+                    print("| Converted {} TLG image(s) to PNG".format(converted))
+        return self
+
+    def _unpack(self, to, encryption_type, filter, converter):
+        if self.io_policy and filter:  # Don't read the skipped files ahead
+            self.plan(index for index in range(len(self.file_index.entries)) if filter(self[index].file_path))
+        for index in range(len(self.file_index.entries)):
+            file = self[index]
+            if filter and not filter(file.file_path):
+                continue
             try:
                 if not self.silent:
                     uncompressed_if = "-> {} ".format(file.info.uncompressed_size) if file.info.compressed_size != file.info.uncompressed_size else ''
@@ -74,14 +114,47 @@ class XP3(XP3Reader, XP3Writer):
                             file.info.compressed_size,
                             uncompressed_if)
                         )
-                if os.path.isfile(os.path.join(to, file.file_path)):
-                    print("! File {} already exists".format(os.path.join(to, file.file_path)))
+                path = os.path.join(to, file.file_path)
+                if converter and file.file_path.lower().endswith('.tlg'):
+                    png_path = os.path.splitext(path)[0] + '.png'
+                    if os.path.isfile(png_path):
+                        print("! File {} already exists".format(png_path))
+                    else:
+                        data = file.read(encryption_type=encryption_type)
+                        if data is not None:
+                            converter.submit(data, path)
+                elif os.path.isfile(path):
+                    print("! File {} already exists".format(path))
                 else:
                     file.extract(to=to, encryption_type=encryption_type)
             except OSError:  # Usually because of long file names
                 if not self.silent:
                     print("! Problem writing {}".format(file.file_path))
-        return self
+
+    def verify(self, encryption_type="none", filter=None) -> list:
+        """
+        Read the files in the archive and check their checksums
+        :param filter: Function taking an internal file path and returning True if the file should be checked
+        :return: List of internal file paths of the files that failed
+        """
+        if not self._is_readmode:
+            raise Exception("Archive is not open in reading mode")
+
+        failed = []
+        for index in range(len(self.file_index.entries)):
+            file = self[index]
+            if file.file_path == '' or 'This is a protected archive' in file.file_path:
+                continue
+            if filter and not filter(file.file_path):
+                continue
+            try:
+                if file.read(encryption_type=encryption_type) is None:
+                    failed.append(file.file_path)
+            except Exception as error:  # Corrupted data, wrong cypher, etc.
+                if not self.silent:
+                    print("! {}: {}".format(file.file_path, error))
+                failed.append(file.file_path)
+        return failed
 
     def add_folder(self, path, flatten: bool = False, encryption_type: str = None, save_timestamps: bool = False):
         if not self._is_writemode:
@@ -121,21 +194,53 @@ class XP3(XP3Reader, XP3Writer):
         super().add(internal_filepath, data, encryption_type, timestamp)
 
 
+def set_key(key: str) -> str:
+    """Set the XOR key of the hiddenb cypher from a hex string (e.g. \\x12\\x34 or 1234), returns the cypher name"""
+    import codecs
+    from .structs.encryption_parameters import encryption_parameters
+    encryption_parameters["hiddenb"][1] = codecs.getdecoder("hex_codec")(key.replace("\\x", ''))[0]
+    return "hiddenb"
+
+
+# Subcommands: name -> (module, function), modules are imported only when used
+COMMANDS = {
+    'merge': ('merge', 'merge_main'),
+    'rebuild': ('merge', 'rebuild_main'),
+    'diff': ('diff', 'diff_main'),
+    'fsck': ('fsck', 'fsck_main'),
+    'layout': ('layout', 'layout_main'),
+    'export': ('export', 'export_main'),
+    'catalog': ('catalog', 'catalog_main'),
+    'names': ('names', 'names_main'),
+    'key': ('keys', 'key_main'),
+    'watch': ('watch', 'watch_main'),
+    'grep': ('grep', 'grep_main'),
+    'benchmark': ('benchmark', 'benchmark_main'),
+}
+
+
 def main():
     import argparse, sys
     from .structs.encryption_parameters import encryption_parameters
+    from .structs import codec
+    import glob
+    from .filters import add_filter_arguments
+    from .batch import OPERATIONS, expand_inputs, output_path, run_jobs
+    from .structs.file import numpy_available
     VERSION_STR = "1.0.0"
 
-    def input_filepath(path: str) -> str:
-        if not os.path.exists(os.path.realpath(path)):
-            print(f"ERROR: {path} dosn't exist or not accessible")
-            sys.exit(2)
-        return path
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        from importlib import import_module
+        module, function = COMMANDS[sys.argv[1]]
+        sys.exit(getattr(import_module('.' + module, __package__), function)(sys.argv[2:]))
 
-    parser = argparse.ArgumentParser(description=f"KiriKiri .xp3 archive unpack/repack tool v{VERSION_STR}")
+    parser = argparse.ArgumentParser(prog="xp3", description=f"KiriKiri .xp3 archive unpack/repack tool v{VERSION_STR}",
+                                     epilog="other commands (see xp3 <command> -h): " + ", ".join(COMMANDS))
     mode = parser.add_argument_group("operation mode").add_mutually_exclusive_group()
     mode.add_argument("-u", "--unpack", action="store_true", help="Unpack XP3 archive")
     mode.add_argument("-r", "--repack", action="store_true", help="Repack XP3 archive")
+    mode.add_argument("-l", "--list", action="store_true", help="List the files in XP3 archive")
+    mode.add_argument("-t", "--verify", action="store_true", help="Check the files in XP3 archive against their checksums")
     parser.add_argument("-s", "--silent", action="store_true", default=False)
     parser.add_argument("-k", "--key", default="", help="Archive XOR key")
     parser.add_argument("-f", "--flatten", action="store_true", default=False,
@@ -143,43 +248,80 @@ def main():
                         some games take only patches packed this way.
                         """)
     parser.add_argument("-i", "--index", action="store_true", help="Dump the file index of an archive")
+    parser.add_argument("-n", "--names", default=None,
+                        help="File with the real names of hashed files, saved by xp3 names recover")
     parser.add_argument("-c", "--cypher", choices=encryption_parameters.keys(), default="none",
                         help="Specify the cypher mode")
-    parser.add_argument("input", nargs='?', type=input_filepath, default="data.xp3", help="File to unpack or folder to repack (default: data.xp3)")
-    parser.add_argument("output", nargs='?', help="Output folder to unpack into or output file to repack into")
+    parser.add_argument("--max-compression", action="store_true", default=False,
+                        help="Try several deflate strategies for every file and keep the smallest result")
+    parser.add_argument("--strategy-cache", default=None,
+                        help="File to remember the best strategies in (default: ~/.cache/krkr-xp3/strategies.json)")
+    parser.add_argument("--cache", action="store_true", default=False,
+                        help="Keep the packed data of the files to repack only the changed ones next time")
+    parser.add_argument("--cache-dir", default=None, metavar="DIR",
+                        help="Folder of the build cache, implies --cache (default: ~/.cache/krkr-xp3/build)")
+    parser.add_argument("--cache-size", type=int, default=1024, metavar="MB",
+                        help="Size to keep the build cache under, least recently used files are removed (default: 1024)")
+    parser.add_argument("--estimate", action="store_true", default=False,
+                        help="""Only estimate the size of the repacked archive and the time packing takes
+                        from samples of the files, and list the files that take the longest""")
+    parser.add_argument("--segment-size", type=int, default=None, metavar="MB",
+                        help="""Split files larger than this into independently compressed segments,
+                        they are decompressed by several threads (default: one segment per file)""")
+    parser.add_argument("--io", choices=("sequential", "random", "once"), default=None,
+                        help="""Hints to the OS about the reads from the planned order of the files: read the next
+                        files ahead (sequential), only the file being read (random), or also drop the files already
+                        read from the page cache (once, for one pass unpacks of huge archives)""")
+    parser.add_argument("--convert-tlg", choices=("png",), default=None,
+                        help="Experimental: convert the TLG5 and TLG6 images to PNG while unpacking, in parallel (needs numpy). "
+                             "Not yet checked against images made by the KiriKiri tools, keep the originals")
+    add_filter_arguments(parser)
+    parser.add_argument("-z", "--zlib", choices=('auto',) + codec.BACKENDS, default="auto",
+                        help="Deflate implementation, zlib-ng and isal are used if installed (default: auto)")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="Number of archives to process at once (default: number of CPUs)")
+    parser.add_argument("-o", "--output", help="""Output folder to unpack into or output file to repack into,
+                        with several inputs each one gets a folder or file named after it inside the output folder""")
+    parser.add_argument("input", nargs='*', default=["data.xp3"],
+                        help="""Files to unpack or folders to repack (default: data.xp3), globs, folders with archives
+                        and HTTP(S) URLs of archives (read with range requests) are accepted. The old form with the output after a single input works too""")
 
     if len(sys.argv) < 2:
         parser.print_help(sys.stderr)
         sys.exit()
 
     args = parser.parse_args()
-    is_silent = args.silent
-    out = args.output
-    cypher = args.cypher
-    if args.key:
-        import codecs
-        cypher = "hiddenb"
-        encryption_parameters[cypher][1] = codecs.getdecoder("hex_codec")(args.key.replace("\\x",''))[0]
-
-    if args.unpack:
-        with XP3(args.input, 'r', is_silent) as xp3:
-            if not out:
-                out = os.path.splitext(args.input)[0]
-            if args.index:
-                if not is_silent:
-                    print("Dumping index of {}".format(out))
-                xp3.file_index.unpack(out)
-            else:
-                if not is_silent:
-                    print("Unpacking {} → {}".format(args.input, os.path.abspath(out)))
-                xp3.unpack(out, cypher)
-    elif args.repack:
-        if not out:
-            out = args.input + ".xp3"
-        with XP3(out, 'w', is_silent) as xp3:
-            if not is_silent:
-                print('Packing {} → {}'.format(os.path.abspath(args.input), out))
-            xp3.add_folder(args.input, args.flatten, cypher)
+    operation = next((operation for operation in OPERATIONS if getattr(args, operation)), None)
+    if not operation:
+        parser.print_help(sys.stderr)
+        sys.exit(2)
+
+    # Old form: xp3 -u data.xp3 data or xp3 -r data data.xp3
+    inputs = args.input
+    if not args.output and len(inputs) == 2 and not glob.has_magic(inputs[1]) \
+            and not (os.path.isdir(inputs[1]) if operation == 'repack' else os.path.isfile(inputs[1])):
+        inputs, args.output = inputs[:1], inputs[1]
+    try:
+        codec.set_backend(args.zlib)
+        inputs = expand_inputs(inputs, folders=operation == 'repack')
+    except ImportError:
+        print(f"ERROR: {args.zlib} is not installed")
+        sys.exit(2)
+    except FileNotFoundError as error:
+        print(f"ERROR: {error} dosn't exist or not accessible")
+        sys.exit(2)
+    if not inputs:
+        print("ERROR: no inputs found")
+        sys.exit(2)
+    if args.convert_tlg and not numpy_available():
+        print("ERROR: numpy is not installed")
+        sys.exit(2)
+
+    several = len(inputs) > 1
+    job_args = argparse.Namespace(**vars(args))
+    job_args.silent = args.silent or several  # Only the summary of each archive when running in parallel
+    jobs = [(operation, input, output_path(operation, input, args.output, several), job_args) for input in inputs]
+    sys.exit(run_jobs(jobs, args.jobs, args.silent))
 
 
 if __name__ == '__main__':
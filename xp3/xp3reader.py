@@ -3,13 +3,25 @@ from .structs import XP3Signature, XP3FileIndex, XP3File
 
 
 class XP3Reader:
-    def __init__(self, buffer, silent: bool = False, use_numpy: bool = True):
+    def __init__(self, buffer, silent: bool = False, use_numpy: bool = True, cache=None, io_policy: str = None):
+        """
+        :param cache: sharedcache.SharedCache to share the read files with other processes
+        :param io_policy: 'sequential', 'random' or 'once' to give the OS hints about the reads,
+                          see iopolicy.IOPolicy (ignored where posix_fadvise() isn't available)
+        """
         if isinstance(buffer, bytes):
             buffer = BytesIO(buffer)
 
         self.buffer = buffer
         self.silent = silent
         self.use_numpy = use_numpy
+        self.cache = cache
+        self.archive_id = None
+        if cache is not None:
+            from .sharedcache import archive_identity
+            self.archive_id = archive_identity(buffer)
+        self.trace = None
+        self.names = {}
 
         if XP3Signature != self.buffer.read(len(XP3Signature)):
             raise AssertionError('The data is not an XP3 file')
@@ -20,7 +32,15 @@ class XP3Reader:
         if not silent:
             print(', found {} file(s)'.format(len(self.file_index.entries)))
 
+        self.io_policy = None
+        if io_policy:
+            from .iopolicy import IOPolicy, fadvise_available
+            if fadvise_available(self.buffer):
+                self.io_policy = IOPolicy(self.buffer.fileno(), io_policy, self.file_index.entries)
+
     def close(self):
+        if self.io_policy:
+            self.io_policy.close()
         self.buffer.close()
 
     def __enter__(self):
@@ -40,7 +60,44 @@ class XP3Reader:
 
     def __getitem__(self, item):
         """Access a file by it's internal file path or position in file index"""
-        return XP3File(self.file_index[item], self.buffer, self.silent, self.use_numpy)
+        if isinstance(item, str) and item not in self.file_index.path_index:
+            # Encrypted archives may store a hash instead of the name
+            from .names import path_hash
+            name_hash = path_hash(item)
+            for key in (name_hash, name_hash.upper()):
+                if key in self.file_index.path_index:
+                    return XP3File(self.file_index[key], self.buffer, self.silent, self.use_numpy, item,
+                                   self.cache, self.archive_id, self.io_policy)
+            raise KeyError(item)
+        entry = self.file_index[item]
+        return XP3File(entry, self.buffer, self.silent, self.use_numpy, self.names.get(entry.file_path.lower()),
+                       self.cache, self.archive_id, self.io_policy)
+
+    def load_names(self, names):
+        """
+        Use the real names of the files stored under hashed names
+        :param names: Dictionary of hash -> path or path of a file saved by 'xp3 names recover'
+        """
+        if isinstance(names, str):
+            from .names import read_names
+            names = read_names(names)
+        self.names.update((name_hash.lower(), file_path) for name_hash, file_path in names.items())
 
     def open(self, item):
-        return self.__getitem__(item)
+        file = self.__getitem__(item)
+        if self.trace is not None:
+            self.trace.append(file.file_path)
+        return file
+
+    def plan(self, items):
+        """
+        Tell the I/O policy the order the files are going to be read in (default: the order of the file index)
+        :param items: Internal file paths or positions in the file index
+        """
+        if self.io_policy:
+            self.io_policy.plan([self[item] for item in items])
+
+    def start_trace(self) -> list:
+        """Start recording the paths of opened files in order, returns the list they are recorded into"""
+        self.trace = []
+        return self.trace
@@ -1,40 +1,87 @@
-import os, zlib, struct, hashlib
+import os, struct, shutil, tempfile
 from io import BytesIO
 from .structs import XP3FileIndex, XP3FileEncryption, XP3FileTime, XP3FileAdler, XP3FileSegments, XP3FileInfo, XP3File, \
-    XP3FileEntry, XP3Signature, encryption_parameters, KSScrambling
+    XP3FileEntry, XP3Signature, encryption_parameters, codec
+from .structs.file import xor_data
 
 VERSION = 2
+COPY_CHUNK_SIZE = 1 << 20  # Copy raw segments in 1 MiB chunks
+INDEX_SPOOL_SIZE = 16 << 20  # The serialized file entries are moved from memory to a temporary file past 16 MiB
+# Already compressed formats, stored as they are
+STORED_EXTENSIONS = ('.mp3', '.ogg', '.png', '.jpg', '.jpeg', '.pimg', '.tlg', '.webp', '.webm', '.wmv', '.mpg', '.avi', '.mp4')
 
 class XP3Writer:
-    def __init__(self, buffer: BytesIO = None, silent: bool = False, use_numpy: bool = True, scramble_mode: int = 0xFF):
+    def __init__(self, buffer: BytesIO = None, silent: bool = False, use_numpy: bool = True, scramble_mode: int = 0xFF,
+                 compressor=None, cache=None, segment_size: int = None, append: bool = False):
         """
         :param buffer: Buffer object to write data to
         :param silent: Supress prints
         :param use_numpy: Use Numpy for XORing if available
+        :param compressor: Function to make zlib streams with (default: level 9), e.g. compression.StrategySearch
+        :param cache: buildcache.BuildCache to take the packed data of unchanged files from
+        :param segment_size: Split larger files into independently compressed segments of this size,
+                             so they can be decompressed in parallel (default: one segment per file)
+        :param append: Add to the archive in the buffer (open for reading and writing), its files are kept
+                       unless removed, the header is only changed after the new file index is written
         """
         if not buffer:
             buffer = BytesIO()
         self.buffer = buffer
-        self.file_entries = []
+        self.entry_count = 0
         self.silent = silent
         self.use_numpy = use_numpy
         self.scramble_mode = scramble_mode
+        self.compressor = compressor
+        self.cache = cache
+        self.segment_size = segment_size
         self.buffer.seek(0)
-        self.buffer.write(XP3Signature)
-        if VERSION == 1:
+        self.append = append
+        self._existing = {}
+        if append:
+            if XP3Signature != self.buffer.read(len(XP3Signature)):
+                raise AssertionError('The data is not an XP3 file')
+            self._existing = {entry.file_path: entry for entry in XP3FileIndex.read_from(self.buffer)}
+            self.buffer.seek(0, os.SEEK_END)
+        else:
+            self.buffer.write(XP3Signature)
+            if VERSION == 1:
+                self.buffer.write(struct.pack('<Q', 0))  # File index offset placeholder
             self.buffer.write(struct.pack('<Q', 0))  # File index offset placeholder
-        self.buffer.write(struct.pack('<Q', 0))  # File index offset placeholder
-        self.buffer.write(struct.pack('<1I', 1))  # Minor version placeholder
+            self.buffer.write(struct.pack('<1I', 1))  # Minor version placeholder
         self.packed_up = False
-        self._filenames = []
+        self._filenames = set(self._existing)
+        self._index_spool = tempfile.SpooledTemporaryFile(INDEX_SPOOL_SIZE)
+        self._copied_segments = {}
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if not self.packed_up:
+        # An archive appended to keeps its previous index if the update failed
+        if not self.packed_up and not (exc_type and self.append):
             self.pack_up()
         self.buffer.close()
+        self._index_spool.close()
+
+    def iter_entries(self):
+        """
+        Iterate over the entries of the archive so far, the added ones are parsed back from the spool of the file index
+        on every call, they are copies: changing them doesn't change the archive
+        """
+        yield from list(self._existing.values())
+        position = 0
+        for _ in range(self.entry_count):
+            self._index_spool.seek(position)  # Files can be added between two entries
+            entry = XP3FileEntry.read_from(self._index_spool)
+            position = self._index_spool.tell()
+            yield entry
+
+    def remove(self, internal_filepath: str):
+        """Drop a file of the archive being appended to, its data stays in the archive until it is rebuilt"""
+        if self.packed_up:
+            raise Exception('Archive is already packed up')
+        del self._existing[internal_filepath]
+        self._filenames.discard(internal_filepath)
 
     def add(self, internal_filepath: str, file: bytes, encryption_type: str = None, timestamp: int = 0):
         """
@@ -51,14 +98,14 @@ class XP3Writer:
         if internal_filepath in self._filenames:
             raise FileExistsError(internal_filepath)
 
-        self._filenames.append(internal_filepath)
+        self._filenames.add(internal_filepath)
         file_entry, file, is_compressed = self._create_file_entry(
             internal_filepath=internal_filepath,
             uncompressed_data=file,
             offset=self.buffer.tell(),
             encryption_type=encryption_type,
             timestamp=timestamp)
-        self.file_entries.append(file_entry)
+        self._append_entry(file_entry)
 
         if not self.silent:
             if is_compressed:
@@ -68,6 +115,40 @@ class XP3Writer:
                 print(f'| Stored {internal_filepath} ({file_entry.segm.uncompressed_size} bytes)')
         self.buffer.write(file)
 
+    def add_entry(self, file_entry: XP3FileEntry, buffer):
+        """
+        Copy a file from another archive as is, without decompressing or decrypting it,
+        only the segment offsets are rewritten
+        :param file_entry: File entry from the index of the source archive
+        :param buffer: Buffer of the source archive
+        """
+        if self.packed_up:
+            raise Exception('Archive is already packed up')
+        if file_entry.file_path in self._filenames:
+            raise FileExistsError(file_entry.file_path)
+
+        self._filenames.add(file_entry.file_path)
+        segments = []
+        for segment in file_entry.segm:
+            # Segments shared by several entries stay shared in the copy
+            key = (id(buffer), segment.offset, segment.compressed_size)
+            offset = self._copied_segments.get(key)
+            if offset is None:
+                offset = self.buffer.tell()
+                self._copy_segment(buffer, segment.offset, segment.compressed_size)
+                self._copied_segments[key] = offset
+            segments.append(segment._replace(offset=offset))
+
+        self._append_entry(XP3FileEntry(
+            encryption=file_entry.encryption,
+            time=file_entry.time,
+            adlr=file_entry.adlr,
+            segm=XP3FileSegments(segments),
+            info=file_entry.info))
+
+        if not self.silent:
+            print(f'| Copied {file_entry.file_path} ({file_entry.info.compressed_size} bytes)')
+
     def pack_up(self) -> bytes:
         """
         Write the file index to the archive, returns the resulting archive if it can
@@ -77,10 +158,22 @@ class XP3Writer:
             if hasattr(self.buffer, 'getvalue'):
                 return self.buffer.getvalue()
 
+        if self._existing:
+            # The kept files of the archive appended to go first
+            spool = tempfile.SpooledTemporaryFile(INDEX_SPOOL_SIZE)
+            for entry in self._existing.values():
+                spool.write(entry.to_bytes())
+            self._index_spool.seek(0)
+            shutil.copyfileobj(self._index_spool, spool)
+            self._index_spool.close()
+            self._index_spool = spool
+            self.entry_count += len(self._existing)
+            self._existing = {}
+
         # Write the file index
-        file_index = XP3FileIndex.from_entries(self.file_entries).to_bytes()
         file_index_offset = self.buffer.tell()
-        self.buffer.write(file_index)
+        XP3FileIndex.write_index(self.buffer, self._index_spool)
+        self.buffer.flush()  # The index is in place before the header points to it
 
         # Go back to the header and write the offset
         self.buffer.seek(len(XP3Signature))
@@ -94,6 +187,21 @@ class XP3Writer:
         if hasattr(self.buffer, 'getvalue'):
             return self.buffer.getvalue()
 
+    def _append_entry(self, file_entry: XP3FileEntry):
+        self._index_spool.seek(0, os.SEEK_END)
+        self._index_spool.write(file_entry.to_bytes())
+        self.entry_count += 1
+
+    def _copy_segment(self, buffer, offset: int, size: int):
+        from .structs.file import pread
+        while size:
+            chunk = pread(buffer, offset, min(size, COPY_CHUNK_SIZE))
+            if not chunk:
+                raise AssertionError(f'Unexpected end of archive at {offset}')
+            self.buffer.write(chunk)
+            offset += len(chunk)
+            size -= len(chunk)
+
     def _create_file_entry(self, internal_filepath, uncompressed_data, offset, encryption_type: str = None,
                            timestamp: int = 0) -> (XP3FileEntry, bytes):
         """
@@ -111,47 +219,37 @@ class XP3Writer:
         if is_encrypted:
             enc_type, _, _, name = encryption_parameters[encryption_type]
 
-        if os.path.splitext(internal_filepath)[1] in ['.ks', '.tjs']:
-            if "scrambler" in enc_type:
-                mode = self.scramble_mode
-                if "scrambler0" in enc_type:
-                    mode = 0
-                elif "scrambler1" in enc_type:
-                    mode = 1
-                elif "scrambler2" in enc_type:
-                    mode = 2
-                with KSScrambling(uncompressed_data) as scrambled:
-                    sdata = scrambled.encode(mode)
-                    if sdata is not None:
-                        uncompressed_data = bytes(sdata)
-
-        adlr = XP3FileAdler.from_data(uncompressed_data)
+        key = packed = None
+        # Files split into segments aren't cached
+        if self.cache is not None and not (self.segment_size and len(uncompressed_data) > self.segment_size):
+            extension = os.path.splitext(internal_filepath)[1]
+            compression = type(self.compressor).__name__ if self.compressor else 9
+            master_key = encryption_parameters[encryption_type][1] if is_encrypted else b''
+            key = self.cache.key(uncompressed_data, encryption_type, master_key, self.scramble_mode, compression,
+                                 codec.backend_names()[0], extension)
+            packed = self.cache.get(key)
+        if packed:
+            adler32, uncompressed_size, is_compressed, data = packed
+            sizes = [(is_compressed, uncompressed_size, len(data))]
+        else:
+            adler32, sizes, data = self._pack_data(internal_filepath, uncompressed_data, encryption_type)
+            if key:
+                self.cache.put(key, adler32, sizes[0][1], sizes[0][0], data)
+        adlr = XP3FileAdler(adler32)
+        uncompressed_size = sum(size[1] for size in sizes)
+        compressed_size = len(data)
+        is_compressed = any(size[0] for size in sizes)
 
         encryption = path_hash = None
         if is_encrypted:
-            uncompressed_data = self.xor(uncompressed_data, adlr.value, encryption_type, self.use_numpy)
             if not "hidden" in enc_type:
                 encryption = XP3FileEncryption(adlr.value, internal_filepath, name)
-                path_hash = hashlib.md5(internal_filepath.lower().encode('utf-16le')).hexdigest()
+                from .names import path_hash as hash_path
+                path_hash = hash_path(internal_filepath)
             else:
                 path_hash = internal_filepath
                 is_encrypted = False
 
-        uncompressed_size = len(uncompressed_data)
-        if os.path.splitext(internal_filepath)[1] in ['.mp3', '.ogg', '.png', '.jpg', '.jpeg', '.pimg', '.tlg', '.webp', '.webm', '.wmv', '.mpg', '.avi', '.mp4']:
-            compressed_data = uncompressed_data
-        else:
-            compressed_data = zlib.compress(uncompressed_data, level=9)
-        compressed_size = len(compressed_data)
-
-        if compressed_size >= uncompressed_size:
-            data = uncompressed_data
-            compressed_size = uncompressed_size
-            is_compressed = False
-        else:
-            data = compressed_data
-            is_compressed = True
-
         time = XP3FileTime(timestamp)
         fp = internal_filepath if not is_encrypted else path_hash
         info = XP3FileInfo(is_encrypted=is_encrypted,
@@ -160,21 +258,68 @@ class XP3Writer:
                            file_path=fp
                            )
 
-        segment = XP3FileSegments.segment(
-            is_compressed=is_compressed,
-            offset=offset,
-            uncompressed_size=uncompressed_size,
-            compressed_size=compressed_size
-        )
-        segm = XP3FileSegments([segment])
+        segments = []
+        for segment_compressed, segment_size, segment_compressed_size in sizes:
+            segments.append(XP3FileSegments.segment(
+                is_compressed=segment_compressed,
+                offset=offset,
+                uncompressed_size=segment_size,
+                compressed_size=segment_compressed_size
+            ))
+            offset += segment_compressed_size
+        segm = XP3FileSegments(segments)
 
         file_entry = XP3FileEntry(encryption=encryption, time=time, adlr=adlr, segm=segm, info=info)
 
         return file_entry, data, is_compressed
 
+    def _pack_data(self, internal_filepath, uncompressed_data, encryption_type: str = None) -> tuple:
+        """
+        Scramble, encrypt and compress the data of a file
+        :return: adler32, list of (is compressed, uncompressed size, compressed size) of the segments
+                 and the data to write into buffer
+        """
+        enc_type = encryption_parameters[encryption_type][0] if encryption_type not in ('none', None) else ""
+
+        if os.path.splitext(internal_filepath)[1] in ['.ks', '.tjs']:
+            if "scrambler" in enc_type:
+                mode = self.scramble_mode
+                if "scrambler0" in enc_type:
+                    mode = 0
+                elif "scrambler1" in enc_type:
+                    mode = 1
+                elif "scrambler2" in enc_type:
+                    mode = 2
+                from .structs.scrambling import KSScrambling
+                with KSScrambling(uncompressed_data) as scrambled:
+                    sdata = scrambled.encode(mode)
+                    if sdata is not None:
+                        uncompressed_data = bytes(sdata)
+
+        adlr = XP3FileAdler.from_data(uncompressed_data)
+        if enc_type:
+            uncompressed_data = bytearray(uncompressed_data)
+            xor_data(uncompressed_data, adlr.value, encryption_type, self.use_numpy)
+
+        if os.path.splitext(internal_filepath)[1] in STORED_EXTENSIONS:
+            return adlr.value, [(False, len(uncompressed_data), len(uncompressed_data))], uncompressed_data
+
+        segment_size = self.segment_size or len(uncompressed_data) or 1
+        sizes, chunks = [], []
+        for start in range(0, max(len(uncompressed_data), 1), segment_size):
+            chunk = uncompressed_data if segment_size >= len(uncompressed_data) \
+                    else uncompressed_data[start:start + segment_size]
+            compressed_data = self.compressor(chunk) if self.compressor else codec.compress(chunk, level=9)
+            if len(compressed_data) >= len(chunk):
+                sizes.append((False, len(chunk), len(chunk)))
+                chunks.append(chunk)
+            else:
+                sizes.append((True, len(chunk), len(compressed_data)))
+                chunks.append(compressed_data)
+        return adlr.value, sizes, chunks[0] if len(chunks) == 1 else b''.join(chunks)
+
     @staticmethod
     def xor(data, adler32, encryption_type, use_numpy):
-        with BytesIO() as buffer:
-            buffer.write(data)
-            XP3File.xor(buffer, adler32, encryption_type, use_numpy)
-            return buffer.getvalue()
+        data = bytearray(data)
+        xor_data(data, adler32, encryption_type, use_numpy)
+        return bytes(data)